@@ -0,0 +1,85 @@
+# Association tables between a target cancer and the sites/histologies of co-occurring tumours
+# One aligned table per key column replaces the per-key Counter loops of each normalization
+
+#%% Imports
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+from internals import instrument
+from constants import COL_SEQ, COL_SURV
+
+#%% Functions
+
+def _codes(series: Series, categories: pd.Index) -> np.ndarray:
+    # Category codes of series against a shared set of categories, -1 for values not among them or NaN
+    if isinstance(series.dtype, pd.CategoricalDtype) and series.cat.categories.equals(categories):
+        return series.cat.codes.to_numpy() # Already aligned, e.g., df_rel sliced from df
+    return pd.Categorical(series, categories=categories).codes
+
+def _bincount(codes: np.ndarray, n: int, weights: np.ndarray = None) -> np.ndarray:
+    valid = codes >= 0
+    return np.bincount(codes[valid], weights=None if weights is None else weights[valid], minlength=n)
+
+@instrument()
+def buildAssociationTable(df: DataFrame, df_rel: DataFrame, key_col: str, first_col: str = COL_SEQ) -> DataFrame:
+    """
+    Returns DF indexed by the values of key_col (e.g., site or histology) with aligned counts and normalizations
+    
+    Columns:
+        count: records of key in df_rel (tumours co-occurring with the target cancer)
+        total: records of key in df
+        pct_incidence: count / total * 100, percentage of all tumours of key associated with the target cancer
+        surv_sum: sum of survival months of records of key in df (cumulative survival)
+        norm_cum: count / surv_sum
+        f_surv_sum: sum of survival months of records of key that were a patient's first record (first_col == 1)
+        norm_cum_first: count / f_surv_sum
+    Normalizations are NaN where the denominator is 0
+
+    Args:
+        df (DataFrame): Whole case listing, denominators are computed over it
+        df_rel (DataFrame): Records associated with the target cancer, e.g., non-GBM records of GBM patients
+        key_col (str): Column to tabulate, e.g., COL_SITE or COL_TYPE
+        first_col (str, optional): Record number column, 1 marks first tumours. Defaults to COL_SEQ.
+    """
+    if isinstance(df[key_col].dtype, pd.CategoricalDtype):
+        categories = df[key_col].cat.categories
+    else:
+        categories = pd.Index(pd.unique(df[key_col].dropna())).sort_values()
+    n = len(categories)
+    
+    codes = _codes(df[key_col], categories)
+    surv = pd.to_numeric(df[COL_SURV], errors="coerce").fillna(0).to_numpy(dtype=float) # NaN survival is skipped like groupby().sum()
+    is_first = (df[first_col] == 1).to_numpy()
+    
+    table = DataFrame({
+        "count": _bincount(_codes(df_rel[key_col], categories), n),
+        "total": _bincount(codes, n),
+        "surv_sum": _bincount(codes, n, surv),
+        "f_surv_sum": _bincount(codes[is_first], n, surv[is_first]),
+        }, index=pd.Index(categories, name=key_col))
+    return normalizeAssociationTable(table)
+
+def normalizeAssociationTable(table: DataFrame) -> DataFrame:
+    """
+    Adds pct_incidence, norm_cum and norm_cum_first to a DF holding count, total, surv_sum and f_surv_sum columns, returns it
+    
+    Args:
+        table (DataFrame): Counts and survival sums per key, e.g., from incremental aggregates
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table["pct_incidence"] = table["count"] / table["total"].replace(0, np.nan) * 100
+        table["norm_cum"] = table["count"] / table["surv_sum"].replace(0, np.nan)
+        table["norm_cum_first"] = table["count"] / table["f_surv_sum"].replace(0, np.nan)
+    return table
+
+def topK(table: DataFrame, col: str, k: int = 15) -> Series:
+    """
+    Returns the k largest values of col among keys with at least one associated record, in descending order
+
+    Args:
+        table (DataFrame): Output of buildAssociationTable()
+        col (str): Column to rank by, e.g., "count" or "pct_incidence"
+        k (int, optional): Number of keys. Defaults to 15.
+    """
+    return table.loc[table["count"] > 0, col].dropna().nlargest(k)
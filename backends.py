@@ -0,0 +1,301 @@
+# Pluggable execution backends for the cohort and aggregation stages
+# PandasBackend is the reference implementation on the in-memory frame, DuckDBBackend runs the same stages as lazy,
+# multi-threaded queries straight over the Parquet cache or CSV, spilling to disk beyond its memory budget
+# compareBackends() checks that a backend gives the same counts, ratios and survival sums as the reference
+
+#%% Imports
+import os
+from typing import Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+from internals import LOG, CACHE_DIR, loadCache, buildCache, instrument
+from strata import stratifiedIncidence, addRatios
+from constants import (COL_ID, COL_SITE, COL_TYPE, COL_HIST, COL_SURV, COL_RAD, COL_CHEMO, COL_SEQ, COL_ORD_PRIM,
+                       GBM_HIST_CODES, FIRST_PRIM_REGEX, NO_RAD_VALUES, NO_CHEMO_VALUES)
+
+COUNT_COLS = ["n_patients", "n_target", "n_first", "n_not_first", "n_second"]
+
+#%% Backends
+
+class PandasBackend:
+    """
+    Reference backend, runs every stage with pandas/NumPy on the frame loaded from the typed cache of source
+
+    Args:
+        source (Union[str, DataFrame]): Path to source CSV, or an already loaded case listing
+        cols (list[str], optional): Columns to load, all if empty. Defaults to [].
+        cache_dir (str, optional): Directory of the typed cache. Defaults to CACHE_DIR.
+    """
+    name = "pandas"
+
+    def __init__(self, source: Union[str, DataFrame], cols: list[str] = [], cache_dir: str = CACHE_DIR):
+        self.df = source if isinstance(source, DataFrame) else loadCache(source, cols=cols, cache_dir=cache_dir)
+
+    def incidence(self,
+                  strata: list[str] = [],
+                  hist_codes: list[int] = GBM_HIST_CODES,
+                  incidence_20y_first: float = 0.000556793,
+                  ) -> DataFrame:
+        """
+        Returns strata.stratifiedIncidence() table of strata columns
+        """
+        return stratifiedIncidence(self.df, strata, hist_codes=hist_codes, incidence_20y_first=incidence_20y_first)
+
+    def _relatedMask(self, hist_codes: list[int], rad_values: list[str], chemo_values: list[str]) -> np.ndarray:
+        is_target = self.df[COL_HIST].isin(hist_codes)
+        untreated = (is_target & self.df[COL_RAD].isin(rad_values) & self.df[COL_CHEMO].isin(chemo_values)).to_numpy()
+        return self.df[COL_ID].isin(self.df[COL_ID].to_numpy()[untreated]).to_numpy() & ~is_target.to_numpy()
+
+    def counts(self,
+               key_col: str,
+               related: bool = False,
+               hist_codes: list[int] = GBM_HIST_CODES,
+               rad_values: list[str] = NO_RAD_VALUES,
+               chemo_values: list[str] = NO_CHEMO_VALUES,
+               ) -> Series:
+        """
+        Returns number of records per value of key_col, as Counter(df[key_col]), sorted by count then key
+        If related, only counts non-target records of patients with an untreated target cancer (df_gbm_rel)
+        """
+        values = self.df[key_col]
+        if related:
+            values = values[self._relatedMask(hist_codes, rad_values, chemo_values)]
+        counts = values.value_counts(sort=False)
+        return _sortCounts(counts[counts > 0]) # Unobserved categories aren't in a Counter
+
+    def nuniqueRelated(self,
+                       hist_codes: list[int] = GBM_HIST_CODES,
+                       rad_values: list[str] = NO_RAD_VALUES,
+                       chemo_values: list[str] = NO_CHEMO_VALUES,
+                       ) -> int:
+        """
+        Returns number of patients with an untreated target cancer
+        """
+        untreated = (self.df[COL_HIST].isin(hist_codes) & self.df[COL_RAD].isin(rad_values) & self.df[COL_CHEMO].isin(chemo_values))
+        return int(self.df.loc[untreated, COL_ID].nunique())
+
+    def survivalSums(self, key_col: str, first_only: bool = False) -> Series:
+        """
+        Returns sum of survival months per value of key_col (cumulative survival), over first tumours only if first_only
+        """
+        df = self.df.loc[self.df[COL_SEQ] == 1] if first_only else self.df
+        sums = df.groupby(key_col, observed=True)[COL_SURV].sum()
+        return sums.sort_values(ascending=False)
+
+class DuckDBBackend:
+    """
+    Runs the stages as DuckDB queries over the typed Parquet cache (or the CSV directly), which are planned lazily, read only the
+    columns they use, run on all cores and spill to temp_dir instead of exceeding memory_limit
+
+    Args:
+        source (str): Path to source CSV
+        use_cache (bool, optional): Query the typed Parquet cache, building it if needed. Otherwise the CSV is scanned directly,
+        which never materialises it in pandas. Defaults to True.
+        threads (int, optional): Number of threads. Defaults to number of CPUs.
+        memory_limit (str, optional): Memory budget of DuckDB, e.g., "4GB". Defaults to "4GB".
+        temp_dir (str, optional): Directory for spilled intermediates. Defaults to "data/cache/duckdb_tmp/".
+        cache_dir (str, optional): Directory of the typed cache. Defaults to CACHE_DIR.
+    """
+    name = "duckdb"
+
+    def __init__(self,
+                 source: str,
+                 use_cache: bool = True,
+                 threads: int = None,
+                 memory_limit: str = "4GB",
+                 temp_dir: str = os.path.join(CACHE_DIR, "duckdb_tmp"),
+                 cache_dir: str = CACHE_DIR,
+                 ):
+        import duckdb # Optional, only needed for this backend
+        self.con = duckdb.connect()
+        self.con.execute(F"SET threads = {threads or os.cpu_count()}")
+        self.con.execute(F"SET memory_limit = '{memory_limit}'")
+        os.makedirs(temp_dir, exist_ok=True)
+        self.con.execute(F"SET temp_directory = '{_escape(temp_dir)}'")
+        if use_cache:
+            scan = F"read_parquet('{_escape(buildCache(source, cache_dir=cache_dir))}')"
+        else:
+            scan = F"read_csv('{_escape(source)}', all_varchar = true)" # Typed below, as buildCache() does
+        # Same coercions as the typed cache: non-numeric histology and survival become NULL
+        self.con.execute(F"""CREATE VIEW records AS SELECT * REPLACE (
+            TRY_CAST({_quote(COL_HIST)} AS INTEGER) AS {_quote(COL_HIST)},
+            TRY_CAST({_quote(COL_SURV)} AS DOUBLE) AS {_quote(COL_SURV)},
+            TRY_CAST({_quote(COL_SEQ)} AS INTEGER) AS {_quote(COL_SEQ)}
+            ) FROM {scan}""")
+
+    def query(self, sql: str, params: list = []) -> DataFrame:
+        return self.con.execute(sql, params).df()
+
+    def incidence(self,
+                  strata: list[str] = [],
+                  hist_codes: list[int] = GBM_HIST_CODES,
+                  incidence_20y_first: float = 0.000556793,
+                  ) -> DataFrame:
+        """
+        Returns strata.stratifiedIncidence() table of strata columns, strata with missing values are dropped like groupby()
+        """
+        cols = ", ".join(_quote(col) for col in strata)
+        group = F"{cols}, " if strata else ""
+        not_null = " AND ".join(F"{_quote(col)} IS NOT NULL" for col in strata) or "TRUE"
+        table = self.query(F"""
+            WITH pairs AS (
+                SELECT {group}
+                    bool_or(COALESCE({_quote(COL_HIST)} IN ({_inList(hist_codes)}), FALSE)) AS target,
+                    bool_or(COALESCE({_quote(COL_HIST)} IN ({_inList(hist_codes)}), FALSE)
+                            AND COALESCE(regexp_matches({_quote(COL_ORD_PRIM)}, ?), FALSE)) AS first
+                FROM records WHERE {not_null}
+                GROUP BY {group}{_quote(COL_ID)})
+            SELECT {group}
+                count(*) AS n_patients,
+                count(*) FILTER (WHERE target) AS n_target,
+                count(*) FILTER (WHERE first) AS n_first,
+                count(*) FILTER (WHERE NOT first) AS n_not_first,
+                count(*) FILTER (WHERE target AND NOT first) AS n_second
+            FROM pairs {"GROUP BY " + cols if strata else ""} {"ORDER BY " + cols if strata else ""}""", [FIRST_PRIM_REGEX])
+        if not strata:
+            table.insert(0, "Stratum", "All")
+        table[COUNT_COLS] = table[COUNT_COLS].astype(np.int64)
+        return addRatios(table, incidence_20y_first)
+
+    def _relatedSql(self, hist_codes: list[int], rad_values: list[str], chemo_values: list[str]) -> tuple[str, list]:
+        # Non-target records of patients with an untreated target cancer, NULL histology counts as non-target like ~isin()
+        sql = F"""
+            SELECT records.* FROM records
+            SEMI JOIN (SELECT {_quote(COL_ID)} FROM records
+                       WHERE {_quote(COL_HIST)} IN ({_inList(hist_codes)})
+                       AND {_quote(COL_RAD)} IN ({", ".join("?" * len(rad_values))})
+                       AND {_quote(COL_CHEMO)} IN ({", ".join("?" * len(chemo_values))})) AS untreated
+            USING ({_quote(COL_ID)})
+            WHERE NOT COALESCE({_quote(COL_HIST)} IN ({_inList(hist_codes)}), FALSE)"""
+        return sql, list(rad_values) + list(chemo_values)
+
+    def counts(self,
+               key_col: str,
+               related: bool = False,
+               hist_codes: list[int] = GBM_HIST_CODES,
+               rad_values: list[str] = NO_RAD_VALUES,
+               chemo_values: list[str] = NO_CHEMO_VALUES,
+               ) -> Series:
+        """
+        Returns number of records per value of key_col, sorted by count then key, see PandasBackend.counts()
+        """
+        source, params = self._relatedSql(hist_codes, rad_values, chemo_values) if related else ("SELECT * FROM records", [])
+        table = self.query(F"""SELECT {_quote(key_col)} AS key, count(*) AS n FROM ({source})
+                               WHERE {_quote(key_col)} IS NOT NULL GROUP BY key""", params)
+        return _sortCounts(table.set_index("key")["n"].rename_axis(key_col).rename("count"))
+
+    def nuniqueRelated(self,
+                       hist_codes: list[int] = GBM_HIST_CODES,
+                       rad_values: list[str] = NO_RAD_VALUES,
+                       chemo_values: list[str] = NO_CHEMO_VALUES,
+                       ) -> int:
+        """
+        Returns number of patients with an untreated target cancer
+        """
+        table = self.query(F"""SELECT count(DISTINCT {_quote(COL_ID)}) AS n FROM records
+                               WHERE {_quote(COL_HIST)} IN ({_inList(hist_codes)})
+                               AND {_quote(COL_RAD)} IN ({", ".join("?" * len(rad_values))})
+                               AND {_quote(COL_CHEMO)} IN ({", ".join("?" * len(chemo_values))})""",
+                           list(rad_values) + list(chemo_values))
+        return int(table["n"].iloc[0])
+
+    def survivalSums(self, key_col: str, first_only: bool = False) -> Series:
+        """
+        Returns sum of survival months per value of key_col, see PandasBackend.survivalSums()
+        """
+        where = F"WHERE {_quote(COL_SEQ)} = 1" if first_only else ""
+        table = self.query(F"""SELECT {_quote(key_col)} AS key, COALESCE(sum({_quote(COL_SURV)}), 0) AS surv
+                               FROM records {where} GROUP BY key HAVING key IS NOT NULL""")
+        return table.set_index("key")["surv"].rename_axis(key_col).rename(COL_SURV).sort_values(ascending=False)
+
+BACKENDS = {"pandas": PandasBackend, "duckdb": DuckDBBackend}
+
+def getBackend(name: str, source: Union[str, DataFrame], **kwargs):
+    """
+    Returns backend of name on source
+
+    Args:
+        name (str): Key of BACKENDS
+        source (Union[str, DataFrame]): Path to source CSV (a loaded DF is only accepted by the pandas backend)
+        **kwargs: Options of the backend class, e.g., memory_limit of DuckDBBackend
+    """
+    if name not in BACKENDS:
+        raise ValueError(F"Unknown backend {name}, choose from {list(BACKENDS)}")
+    return BACKENDS[name](source, **kwargs)
+
+#%% Helpers
+
+def _quote(col: str) -> str:
+    return '"' + col.replace('"', '""') + '"'
+
+def _escape(text: str) -> str:
+    return text.replace("'", "''")
+
+def _inList(codes: list[int]) -> str:
+    return ", ".join(str(int(code)) for code in codes)
+
+def _sortCounts(counts: Series) -> Series:
+    # Order of Counter.most_common() is insertion order for ties, which differs between backends, so ties are sorted by key
+    counts = counts.astype(np.int64)
+    order = np.lexsort((counts.index.astype(str), -counts.to_numpy()))
+    return counts.iloc[order]
+
+#%% Parity
+
+def _mismatches(op: str, reference: Series, other: Series, rtol: float) -> DataFrame:
+    # Rows where two results keyed on their index differ, floats compared with relative tolerance
+    reference.index, other.index = reference.index.astype(str), other.index.astype(str)
+    merged = pd.concat({"reference": reference, "other": other}, axis=1)
+    ref, oth = merged["reference"].to_numpy(dtype=float), merged["other"].to_numpy(dtype=float)
+    same = np.isclose(ref, oth, rtol=rtol, atol=0, equal_nan=True)
+    diff = merged[~same].reset_index(names="key")
+    diff.insert(0, "op", op)
+    return diff
+
+@instrument()
+def compareBackends(reference, other,
+                    strata_list: list[list[str]] = [[]],
+                    key_cols: list[str] = [COL_SITE, COL_TYPE],
+                    hist_codes: list[int] = GBM_HIST_CODES,
+                    rtol: float = 1e-9,
+                    ) -> DataFrame:
+    """
+    Returns DF of every differing value between two backends (empty if they agree): per-stratum counts and ratios,
+    record counts of all and related records, and survival sums, per key column
+    Counts and ratios must match exactly, survival sums within rtol since the summation order differs
+
+    Args:
+        reference: Reference backend, usually PandasBackend
+        other: Backend to check
+        strata_list (list[list[str]], optional): Strata column lists to compare incidence tables of. Defaults to [[]] (whole data).
+        key_cols (list[str], optional): Columns to compare counts and survival sums of. Defaults to [COL_SITE, COL_TYPE].
+        hist_codes (list[int], optional): Histology codes of target cancer. Defaults to GBM_HIST_CODES.
+        rtol (float, optional): Relative tolerance of survival sums. Defaults to 1e-9.
+    """
+    diffs = []
+    for strata in strata_list:
+        ref_table = reference.incidence(strata, hist_codes=hist_codes)
+        other_table = other.incidence(strata, hist_codes=hist_codes)
+        key = strata or ["Stratum"]
+        for table in (ref_table, other_table): # Keyed on the stratum values as text, dtypes of strata differ between backends
+            table.index = table[key].astype(str).agg(" | ".join, axis=1)
+        name = "incidence[" + ", ".join(strata) + "]"
+        for col in COUNT_COLS + ["incidence_sec", "ratio", "ratio_any"]:
+            diffs.append(_mismatches(F"{name}.{col}", ref_table[col], other_table[col], rtol=0 if col in COUNT_COLS else rtol))
+    for key_col in key_cols:
+        for related in (False, True):
+            name = F"counts[{key_col}{', related' if related else ''}]"
+            diffs.append(_mismatches(name, reference.counts(key_col, related, hist_codes),
+                                     other.counts(key_col, related, hist_codes), rtol=0))
+        for first_only in (False, True):
+            name = F"survivalSums[{key_col}{', first' if first_only else ''}]"
+            diffs.append(_mismatches(name, reference.survivalSums(key_col, first_only), other.survivalSums(key_col, first_only), rtol))
+    n_related = {"reference": reference.nuniqueRelated(hist_codes), "other": other.nuniqueRelated(hist_codes)}
+    if n_related["reference"] != n_related["other"]:
+        diffs.append(DataFrame([{"op": "nuniqueRelated", "key": "", **n_related}]))
+    diffs = pd.concat(diffs, ignore_index=True)
+    LOG.info(F"Backend parity {reference.name} vs {other.name}: {len(diffs)} differing values")
+    return diffs
@@ -0,0 +1,235 @@
+# Synthetic SEER-shaped data generator and benchmark harness for the pipeline stages
+# Real SEER case listings can't be shared, so benchmarks run on generated data with realistic shape and cardinalities
+# Usage: python benchmark.py --rows 100000 1000000 --out bench.json
+
+#%% Imports
+import os, sys, time, argparse, tempfile, tracemalloc
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from constants import (COL_AGE, COL_SEX, COL_DIA_YEAR, COL_SITE, COL_SITE_LABELED, COL_HIST, COL_TYPE, COL_SURV,
+                       COL_RAD, COL_CHEMO, COL_ID, COL_SEQ, COL_ORD_PRIM, GBM_HIST_CODES, AGE_BINS)
+
+#%% Constants
+AGE_WEIGHTS = [1, 2, 2, 2, 4, 6, 9, 13, 19, 28, 42, 70, 110, 150, 180, 175, 160, 120, 80] # Roughly SEER incidence by age
+COMMON_SITES = {"Prostate": "C61.9-Prostate gland", "Breast": "C50.9-Breast, NOS", "Lung and Bronchus": "C34.9-Lung, NOS",
+                "Urinary Bladder": "C67.9-Bladder, NOS", "Melanoma of the Skin": "C44.5-Skin of trunk",
+                "Kidney and Renal Pelvis": "C64.9-Kidney, NOS", "NHL - Nodal": "C77.9-Lymph node, NOS",
+                "Corpus Uteri": "C54.1-Endometrium", "Thyroid": "C73.9-Thyroid gland", "Sigmoid Colon": "C18.7-Sigmoid colon"}
+N_SITES = 100 # SEER site recode has ~100 levels
+N_TYPES = 1000 # ICD-O-3 hist/behav has ~1000 levels in SEER 17
+RAD_VALUES = ["None/Unknown", "Beam radiation", "Radioactive implants (includes brachytherapy) (1988+)",
+              "Combination of beam with implants or isotopes", "Refused (1988+)", "Recommended, unknown if administered",
+              "Radioisotopes (1988+)", "Radiation, NOS  method or source not specified"]
+RAD_WEIGHTS = [73, 19, 3.5, 1.6, 0.8, 0.7, 0.6, 0.5]
+ORDINALS = ["1st", "2nd", "3rd"] + [F"{i}th" for i in range(4, 10)]
+
+#%% Generator
+
+def _zipfWeights(n: int, a: float = 1.1) -> np.ndarray:
+    weights = 1 / np.arange(1, n + 1) ** a
+    return weights / weights.sum()
+
+def generateSeerData(n_rows: int = 100_000,
+                     seed: int = 0,
+                     gbm_prevalence: float = 0.007,
+                     missing_prior: float = 0.11,
+                     ) -> DataFrame:
+    """
+    Returns synthetic case listing with the columns used by the pipeline and SEER-like shape
+    Patients have 1-9 records (most have one), records are numbered by COL_SEQ with matching COL_ORD_PRIM strings,
+    and a fraction of patients start at their 2nd primary (prior primary diagnosed outside SEER)
+
+    Args:
+        n_rows (int, optional): Number of records. Defaults to 100_000.
+        seed (int, optional): Random seed. Defaults to 0.
+        gbm_prevalence (float, optional): Fraction of records that are GBM, ~0.7% in SEER RPD 17 Nov 2021. Defaults to 0.007.
+        missing_prior (float, optional): Fraction of multi-primary patients whose first SEER record is their 2nd primary. Defaults to 0.11.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Records per patient, geometric so ~75% of patients have one record
+    n_per_pt = rng.geometric(0.75, size=n_rows)
+    n_per_pt = np.minimum(n_per_pt, len(ORDINALS))
+    n_pts = int(np.searchsorted(np.cumsum(n_per_pt), n_rows)) + 1
+    n_per_pt = n_per_pt[:n_pts]
+    n_per_pt[-1] -= n_per_pt.sum() - n_rows # Trim last patient to hit n_rows exactly
+
+    pt_ids = rng.choice(np.arange(n_pts * 10), size=n_pts, replace=False) # Sparse, unordered IDs like SEER
+    pt_num = np.repeat(np.arange(n_pts), n_per_pt)
+    seq = np.arange(n_rows) - np.repeat(np.cumsum(n_per_pt) - n_per_pt, n_per_pt) + 1 # 1-based position within patient
+
+    # Sequence number strings, offset by one for patients missing a prior primary
+    offset = np.repeat(rng.random(n_pts) < missing_prior, n_per_pt).astype(int)
+    total = np.repeat(n_per_pt, n_per_pt) + offset
+    order = np.minimum(seq + offset, len(ORDINALS))
+    ord_labels = np.array([F"{ORDINALS[i - 1]} of {max(i, 2)} or more primaries" for i in range(1, len(ORDINALS) + 1)])
+    ord_prim = np.where(total == 1, "One primary only", ord_labels[order - 1])
+
+    # Site and histology, GBM records get brain site and a GBM code
+    site_names = list(COMMON_SITES) + [F"Site {i}" for i in range(len(COMMON_SITES), N_SITES - 1)] + ["Brain"]
+    site_idx = rng.choice(N_SITES - 1, size=n_rows, p=_zipfWeights(N_SITES - 1))
+    type_codes = np.sort(rng.choice(np.arange(8000, 9990), size=N_TYPES, replace=False))
+    type_codes = type_codes[~np.isin(type_codes, GBM_HIST_CODES)]
+    hist = type_codes[rng.choice(len(type_codes), size=n_rows, p=_zipfWeights(len(type_codes)))]
+    is_gbm = rng.random(n_rows) < gbm_prevalence
+    hist[is_gbm] = rng.choice(GBM_HIST_CODES, size=is_gbm.sum(), p=[0.93, 0.02, 0.03, 0.02])
+    site_idx[is_gbm] = N_SITES - 1
+    sites = np.array(site_names)[site_idx]
+    labeled = np.array([COMMON_SITES.get(name, F"C{i:02d}.9-{name}") for i, name in enumerate(site_names)])[site_idx]
+
+    # Demographics and outcomes, age rises with each later record of a patient
+    base_age = rng.choice(len(AGE_BINS), size=n_pts, p=np.array(AGE_WEIGHTS) / sum(AGE_WEIGHTS))
+    age = np.minimum(base_age[pt_num] + (seq - 1), len(AGE_BINS) - 1)
+    sex = np.array(["Male", "Female"])[rng.integers(0, 2, size=n_pts)][pt_num]
+    surv = rng.exponential(60, size=n_rows).round().clip(0, 239)
+    surv[is_gbm] = rng.exponential(12, size=is_gbm.sum()).round()
+    surv_str = surv.astype(int).astype(str).astype(object)
+    surv_str[rng.random(n_rows) < 0.01] = "Unknown" # Non-numeric survival, coerced to NaN on load
+
+    return DataFrame({
+        COL_ID: pt_ids[pt_num],
+        COL_AGE: np.array(AGE_BINS)[age],
+        COL_SEX: sex,
+        COL_DIA_YEAR: np.minimum(2000 + rng.integers(0, 20, size=n_pts)[pt_num] + (seq - 1), 2019),
+        COL_SITE: sites,
+        COL_HIST: hist,
+        COL_TYPE: [F"{code}/3: Histology {code}" for code in hist],
+        COL_SITE_LABELED: labeled,
+        COL_RAD: rng.choice(RAD_VALUES, size=n_rows, p=np.array(RAD_WEIGHTS) / sum(RAD_WEIGHTS)),
+        COL_CHEMO: np.where(rng.random(n_rows) < 0.17, "Yes", "No/Unknown"),
+        COL_SURV: surv_str,
+        COL_ORD_PRIM: ord_prim,
+        COL_SEQ: seq,
+        })
+
+#%% Harness
+
+def timeStage(func: Callable, *args, **kwargs) -> tuple[object, dict]:
+    """
+    Returns result of func(*args, **kwargs) and dict of its wall time (s) and peak traced memory (MiB)
+    Peak memory is measured with tracemalloc, which sees NumPy/pandas allocations but not Arrow's memory pool
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {"seconds": round(seconds, 4), "peak_mib": round(peak / 1024**2, 2)}
+
+def runBenchmarks(n_rows: int = 100_000, seed: int = 0) -> DataFrame:
+    """
+    Returns DF of time and peak memory of each pipeline stage on a synthetic case listing of n_rows records
+
+    Args:
+        n_rows (int, optional): Number of records to generate. Defaults to 100_000.
+        seed (int, optional): Random seed of the generator. Defaults to 0.
+    """
+    from internals import loadCache, compactDtypes
+    from indexing import PatientIndex
+    from strata import stratifiedIncidence, targetCohorts
+    from bootstrap import bootstrapTable
+    from stages import stageCounters, stageSurvival, stageFirstSurvival, stageAssociation
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, F"synthetic_{n_rows}.csv")
+        generateSeerData(n_rows, seed=seed).to_csv(csv_path, index=False)
+
+        raw, results["csv_parse"] = timeStage(pd.read_csv, csv_path)
+        _, results["compact_dtypes"] = timeStage(compactDtypes, raw)
+        del raw
+        _, results["cache_build"] = timeStage(loadCache, csv_path, cache_dir=tmp_dir)
+        df, results["cache_load"] = timeStage(loadCache, csv_path, cache_dir=tmp_dir)
+        index, results["patient_index"] = timeStage(PatientIndex, df)
+        _, results["incidence"] = timeStage(stratifiedIncidence, df)
+        _, results["cohorts"] = timeStage(targetCohorts, df, index=index)
+        _, results["strata_age"] = timeStage(stratifiedIncidence, df, [COL_AGE])
+        _, results["strata_sex"] = timeStage(stratifiedIncidence, df, [COL_SEX])
+        year_table, results["strata_age_sex_year"] = timeStage(stratifiedIncidence, df, [COL_AGE, COL_SEX, COL_DIA_YEAR])
+        _, results["bootstrap"] = timeStage(bootstrapTable, year_table, n_resamples=1000)
+        _, results["counters"] = timeStage(stageCounters, df)
+        _, results["association"] = timeStage(stageAssociation, df)
+        _, results["survival"] = timeStage(stageSurvival, df)
+        _, results["first_survival"] = timeStage(stageFirstSurvival, df)
+
+    table = DataFrame(results).T
+    table.index.name = "stage"
+    table.insert(0, "rows", n_rows)
+    return table.reset_index()
+
+def runBackendBenchmarks(n_rows: int = 100_000, seed: int = 0, backends: list[str] = ["duckdb"]) -> DataFrame:
+    """
+    Returns DF of time and peak memory of the cohort and aggregation stages on each backend, raises if any backend's
+    results differ from the pandas reference (backends.compareBackends())
+
+    Args:
+        n_rows (int, optional): Number of records to generate. Defaults to 100_000.
+        seed (int, optional): Random seed of the generator. Defaults to 0.
+        backends (list[str], optional): Keys of backends.BACKENDS to check against pandas. Defaults to ["duckdb"].
+    """
+    from backends import getBackend, compareBackends
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, F"synthetic_{n_rows}.csv")
+        generateSeerData(n_rows, seed=seed).to_csv(csv_path, index=False)
+        options = {"pandas": {"cache_dir": tmp_dir}, "duckdb": {"cache_dir": tmp_dir, "temp_dir": os.path.join(tmp_dir, "duckdb_tmp")}}
+        reference = getBackend("pandas", csv_path, **options["pandas"])
+        for name in dict.fromkeys(["pandas"] + list(backends)):
+            backend, setup = timeStage(getBackend, name, csv_path, **options.get(name, {}))
+            timings = {"setup": setup,
+                       "incidence": timeStage(backend.incidence)[1],
+                       "strata_age_sex_year": timeStage(backend.incidence, [COL_AGE, COL_SEX, COL_DIA_YEAR])[1],
+                       "counts_related": timeStage(backend.counts, COL_SITE, True)[1],
+                       "survival": timeStage(backend.survivalSums, COL_TYPE)[1]}
+            results.extend({"backend": name, "stage": stage, "rows": n_rows, **timing} for stage, timing in timings.items())
+            if name != "pandas":
+                diffs = compareBackends(reference, backend, strata_list=[[], [COL_AGE], [COL_SEX], [COL_AGE, COL_SEX, COL_DIA_YEAR]])
+                if len(diffs):
+                    raise AssertionError(F"Backend {name} differs from pandas:\n{diffs.head(20).to_string(index=False)}")
+    return DataFrame(results)
+
+def compareBaseline(table: DataFrame, baseline: DataFrame, tolerance: float = 0.25) -> DataFrame:
+    """
+    Returns rows of table that are more than tolerance slower than the same stage and size in baseline
+
+    Args:
+        table (DataFrame): Output of runBenchmarks()
+        baseline (DataFrame): Earlier output of runBenchmarks()
+        tolerance (float, optional): Allowed fractional slowdown. Defaults to 0.25.
+    """
+    merged = table.merge(baseline, on=["stage", "rows"], suffixes=("", "_baseline"))
+    merged["slowdown"] = merged["seconds"] / merged["seconds_baseline"] - 1
+    return merged[merged["slowdown"] > tolerance]
+
+#%% Main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic SEER-shaped data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000], help="Dataset sizes to benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="", help="Write results as JSON records to this path")
+    parser.add_argument("--baseline", default="", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--backends", nargs="*", default=None, help="Check parity and time these backends against pandas instead")
+    args = parser.parse_args()
+
+    if args.backends is not None:
+        table = pd.concat([runBackendBenchmarks(n_rows, seed=args.seed, backends=args.backends or ["duckdb"]) for n_rows in args.rows],
+                          ignore_index=True)
+        print(table.to_string(index=False))
+        sys.exit(0)
+    table = pd.concat([runBenchmarks(n_rows, seed=args.seed) for n_rows in args.rows], ignore_index=True)
+    print(table.to_string(index=False))
+    from internals import peakRssMib
+    print(F"Peak RSS of run: {peakRssMib()} MiB")
+    if args.out:
+        table.to_json(args.out, orient="records", indent=2)
+    if args.baseline:
+        regressions = compareBaseline(table, pd.read_json(args.baseline))
+        if len(regressions):
+            print(F"Regressions over baseline:\n{regressions.to_string(index=False)}")
+            sys.exit(1)
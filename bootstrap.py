@@ -0,0 +1,142 @@
+# Patient-level bootstrap and permutation inference for the non-first target cancer ratio of every stratum
+# The ratio only depends on how many of a stratum's patients fall into each of three categories (first target primary,
+# non-first target cancer, neither), so resampling patients with replacement is a multinomial draw of those category
+# counts and permuting patients between strata is a multivariate hypergeometric draw of them. Both are drawn for all
+# resamples at once as integer count matrices, which is exactly equivalent to summing a patients x resamples weight matrix
+
+#%% Imports
+from typing import Union
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pandas import DataFrame, Series
+
+from internals import LOG, instrument
+from strata import stratifiedIncidence
+from constants import GBM_HIST_CODES
+
+RESAMPLE_BLOCK = 500 # Resamples drawn from one random stream, streams are tied to blocks rather than workers
+
+#%% Functions
+
+def _categoryCounts(table: DataFrame) -> np.ndarray:
+    # Strata x 3 patient counts: first target primary, non-first target cancer, neither
+    n_second = table["n_second"].to_numpy(dtype=np.int64)
+    return np.column_stack([table["n_first"].to_numpy(dtype=np.int64), n_second,
+                            table["n_not_first"].to_numpy(dtype=np.int64) - n_second])
+
+def _incidenceSec(counts: np.ndarray) -> np.ndarray:
+    # n_second / n_not_first over the last axis of category counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return counts[..., 1] / (counts[..., 1] + counts[..., 2])
+
+def _resampleChunk(counts: np.ndarray, sizes: list[int], seeds: list[np.random.SeedSequence], permute: bool) -> tuple[np.ndarray, np.ndarray]:
+    # Worker: resample blocks of the given sizes, each from its own stream, concatenated in block order
+    results = [_resampleBlock(counts, size, seed, permute) for size, seed in zip(sizes, seeds)]
+    return np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results])
+
+def _resampleBlock(counts: np.ndarray, n_resamples: int, seed: np.random.SeedSequence, permute: bool) -> tuple[np.ndarray, np.ndarray]:
+    # Bootstrap incidence_sec (n_resamples x strata) and permutation differences of each stratum vs the rest
+    rng = np.random.default_rng(seed)
+    n_patients = counts.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pvals = np.where(n_patients[:, None] > 0, counts / n_patients[:, None], [1, 0, 0]) # Empty strata draw nothing
+    boot = _incidenceSec(rng.multinomial(n_patients, pvals, size=(n_resamples, len(counts))))
+
+    perm = np.full((n_resamples, len(counts)), np.nan)
+    if permute and len(counts) > 1:
+        pooled = counts.sum(axis=0)
+        for i, n_stratum in enumerate(n_patients): # Each draw is vectorized over resamples, loop is over strata only
+            if n_stratum == 0 or n_stratum == pooled.sum():
+                continue
+            inside = rng.multivariate_hypergeometric(pooled, n_stratum, size=n_resamples)
+            perm[:, i] = _incidenceSec(inside) - _incidenceSec(pooled - inside)
+    return boot, perm
+
+@instrument()
+def bootstrapIncidence(df: DataFrame,
+                       strata: list[Union[str, Series]] = [],
+                       hist_codes: list[int] = GBM_HIST_CODES,
+                       incidence_20y_first: float = 0.000556793,
+                       n_resamples: int = 10_000,
+                       alpha: float = 0.05,
+                       seed: int = 0,
+                       max_workers: int = 1,
+                       permute: bool = True,
+                       ) -> DataFrame:
+    """
+    Returns strata.stratifiedIncidence() table with bootstrap CIs and p-values of the non-first target cancer ratio
+    Patients are resampled with replacement within each stratum, resamples can be split across worker processes
+
+    Added columns:
+        ratio_lo, ratio_hi: percentile bootstrap CI of ratio at level 1 - alpha
+        ratio_se: bootstrap standard error of ratio
+        p_ratio: two-sided bootstrap p-value of ratio = 1 (non-first rate equal to reference first-primary rate)
+        p_perm: two-sided permutation p-value of incidence_sec in stratum equal to incidence_sec in all other strata,
+        i.e., the rate comparison otherwise done by chi-squared. NaN if there is only one stratum
+
+    Args:
+        df (DataFrame): Case listing
+        strata (list[Union[str, Series]], optional): Columns or Series aligned with df to stratify by. Defaults to [].
+        hist_codes (list[int], optional): Histology codes of target cancer. Defaults to GBM_HIST_CODES.
+        incidence_20y_first (float, optional): Reference 20 year incidence of target cancer as first cancer. Defaults to 0.000556793.
+        n_resamples (int, optional): Number of bootstrap and permutation resamples. Defaults to 10_000.
+        alpha (float, optional): 1 - confidence level of the CI. Defaults to 0.05.
+        seed (int, optional): Random seed, results are reproducible for a given seed whatever max_workers is. Defaults to 0.
+        max_workers (int, optional): Number of worker processes, None for number of CPUs. Defaults to 1, i.e., in this process,
+        which is as fast for typical strata counts and safe to call from scripts without a __main__ guard.
+        permute (bool, optional): Also compute permutation p-values between strata. Defaults to True.
+    """
+    table = stratifiedIncidence(df, strata, hist_codes=hist_codes, incidence_20y_first=incidence_20y_first)
+    return bootstrapTable(table, incidence_20y_first, n_resamples=n_resamples, alpha=alpha, seed=seed,
+                          max_workers=max_workers, permute=permute)
+
+def bootstrapTable(table: DataFrame,
+                   incidence_20y_first: float = 0.000556793,
+                   n_resamples: int = 10_000,
+                   alpha: float = 0.05,
+                   seed: int = 0,
+                   max_workers: int = 1,
+                   permute: bool = True,
+                   ) -> DataFrame:
+    """
+    Adds bootstrap CI and p-value columns to an existing strata.stratifiedIncidence() table, see bootstrapIncidence()
+    Only the per-stratum patient counts are needed, so df isn't rescanned
+
+    Args:
+        table (DataFrame): Output of strata.stratifiedIncidence()
+        incidence_20y_first (float, optional): Reference incidence the table was built with. Defaults to 0.000556793.
+    """
+    counts = _categoryCounts(table)
+    # One independent stream per block of RESAMPLE_BLOCK resamples, blocks are then split between tasks, so the resamples
+    # drawn only depend on seed and n_resamples and not on the number of workers
+    n_blocks = max(1, -(-n_resamples // RESAMPLE_BLOCK))
+    block_sizes = np.diff(np.minimum(np.arange(n_blocks + 1) * RESAMPLE_BLOCK, n_resamples))
+    block_seeds = np.random.SeedSequence(seed).spawn(n_blocks)
+    n_chunks = max(1, min(max_workers or 1_000_000, n_blocks, 64))
+    chunks = np.array_split(np.arange(n_blocks), n_chunks) # Contiguous blocks per task, results stay in block order
+
+    if n_chunks == 1:
+        results = [_resampleChunk(counts, block_sizes, block_seeds, permute)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_resampleChunk, [counts] * n_chunks, [block_sizes[chunk].tolist() for chunk in chunks],
+                                        [[block_seeds[i] for i in chunk] for chunk in chunks], [permute] * n_chunks))
+    boot = np.concatenate([result[0] for result in results]) / incidence_20y_first
+    perm = np.concatenate([result[1] for result in results])
+
+    table = table.copy()
+    with np.errstate(invalid="ignore"):
+        table["ratio_lo"], table["ratio_hi"] = np.nanpercentile(boot, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        table["ratio_se"] = np.nanstd(boot, axis=0, ddof=1)
+        n_valid = np.sum(~np.isnan(boot), axis=0)
+        tail = np.minimum(np.sum(boot <= 1, axis=0), np.sum(boot >= 1, axis=0))
+        table["p_ratio"] = np.minimum(1, 2 * (tail + 1) / (n_valid + 1)) # +1 so p is never 0 with finite resamples
+
+        pooled = counts.sum(axis=0)
+        observed = _incidenceSec(counts) - _incidenceSec(pooled - counts)
+        n_perm = np.sum(~np.isnan(perm), axis=0)
+        extreme = np.sum(np.abs(perm) >= np.abs(observed) - 1e-12, axis=0)
+        table["p_perm"] = np.where(n_perm > 0, (extreme + 1) / (n_perm + 1), np.nan)
+    LOG.info(F"Bootstrapped {len(table)} strata with {n_resamples} resamples in {n_chunks} chunks")
+    return table
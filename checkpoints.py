@@ -0,0 +1,224 @@
+# Content-addressed store for intermediate results of the pipeline
+# Results are keyed on the hashes of their input files, their filter parameters and the source of the code that produced them,
+# including the project functions and classes that code calls
+
+#%% Imports
+import os, json, time, hashlib, inspect, shutil
+from collections import Counter
+from typing import Callable
+
+import pandas as pd
+from pandas import DataFrame, Series
+
+from internals import LOG, hashFileCached
+
+CHECKPOINT_DIR = "data/checkpoints/"
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__)) # Only code of modules in this directory is hashed
+
+#%% Functions
+
+def _isProjectCode(obj) -> bool:
+    try:
+        path = inspect.getsourcefile(obj)
+    except TypeError: # Builtins and C extensions
+        return False
+    return path is not None and os.path.dirname(os.path.abspath(path)) == PROJECT_DIR
+
+def _callees(obj) -> list:
+    # Project functions and classes that obj (a function, or the methods and bases of a class) references through its module globals
+    if inspect.isclass(obj):
+        members = [getattr(member, "__func__", getattr(member, "fget", member)) for member in vars(obj).values()] # Unwrap static/class methods and properties
+        funcs = [inspect.unwrap(member) for member in members if inspect.isfunction(member)]
+        refs = list(obj.__bases__)
+    else:
+        funcs, refs = [inspect.unwrap(obj)], []
+    for func in funcs:
+        codes = [func.__code__]
+        while codes: # Nested functions, lambdas and comprehensions have their own code objects
+            code = codes.pop()
+            codes.extend(const for const in code.co_consts if inspect.iscode(const))
+            for name in code.co_names:
+                ref = func.__globals__.get(name)
+                if inspect.ismodule(ref) and _isProjectCode(ref): # e.g., strata.stratifiedIncidence
+                    refs.extend(getattr(ref, attr) for attr in code.co_names if hasattr(ref, attr))
+                elif ref is not None:
+                    refs.append(ref)
+    return [ref for ref in refs if (inspect.isfunction(ref) or inspect.isclass(ref)) and _isProjectCode(inspect.unwrap(ref))]
+
+def codeVersion(*funcs: Callable) -> str:
+    """
+    Returns hash of the source code of funcs and of every project function and class they call, directly or through other
+    project code, so editing a helper (e.g., PatientIndex.expand) also changes the version
+    Callees are found through module globals, functions imported inside a function body should be passed explicitly
+
+    Args:
+        funcs (Callable): Functions whose source is hashed
+    """
+    seen = {}
+    pending = list(funcs)
+    while pending:
+        obj = inspect.unwrap(pending.pop())
+        name = F"{obj.__module__}.{obj.__qualname__}"
+        if name not in seen:
+            seen[name] = inspect.getsource(obj)
+            pending.extend(_callees(obj))
+    digest = hashlib.blake2b(digest_size=8)
+    for name in sorted(seen): # Independent of the order callees were found in
+        digest.update(name.encode())
+        digest.update(seen[name].encode())
+    return digest.hexdigest()
+
+def _toFrame(value) -> tuple[str, DataFrame]:
+    # Converts a supported value into a DataFrame that can be written as Parquet, along with its kind for restoring
+    if isinstance(value, Counter):
+        return "counter", DataFrame({"key": list(value.keys()), "count": list(value.values())})
+    if isinstance(value, Series):
+        return "series", value.to_frame(name=value.name if value.name is not None else "value")
+    if isinstance(value, DataFrame):
+        return "frame", value
+    raise TypeError(F"Unsupported checkpoint value type: {type(value)}")
+
+def _fromFrame(kind: str, df: DataFrame):
+    if kind == "counter":
+        return Counter(dict(zip(df["key"], df["count"])))
+    if kind == "series":
+        return df.iloc[:, 0]
+    return df
+
+#%% Classes
+
+class CheckpointStore:
+    """
+    On-disk store of DataFrames, Series and Counters (or a list/dict of them), one Parquet file per part
+    Entries are evicted least-recently-used first once the store exceeds max_bytes
+    """
+    def __init__(self, store_dir: str = CHECKPOINT_DIR, max_bytes: int = 2 * 1024**3):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(store_dir, "index.json")
+        os.makedirs(store_dir, exist_ok=True)
+        self.index: dict[str, dict] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                self.index = json.load(file)
+
+    def _saveIndex(self):
+        with open(self.index_path, "w") as file:
+            json.dump(self.index, file, indent=2)
+
+    def makeKey(self, name: str, inputs: list[str] = [], params: dict = {}, code: str = "") -> str:
+        """
+        Returns key of a result from its name, the contents of its input files, its parameters and its code version
+
+        Args:
+            name (str): Name of the result, e.g., "counters"
+            inputs (list[str], optional): Paths of input files, hashed by content. Defaults to [].
+            params (dict, optional): JSON-serializable filter parameters. Defaults to {}.
+            code (str, optional): Code version, e.g., from codeVersion(). Defaults to "".
+        """
+        parts = {"name": name,
+                 "inputs": [hashFileCached(path, self.store_dir) for path in inputs], # Hash manifest is kept in the store
+                 "params": params,
+                 "code": code,
+                 }
+        digest = hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+        return F"{name}_{digest}"
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def get(self, key: str, default=None):
+        """
+        Returns stored value of key, or default if key is not stored
+
+        Args:
+            key (str): Key from makeKey()
+            default (optional): Value returned if key is missing. Defaults to None.
+        """
+        if key not in self.index:
+            return default
+        entry = self.index[key]
+        parts = {part: _fromFrame(kind, pd.read_parquet(os.path.join(self.store_dir, key, F"{part}.parquet")))
+                 for part, kind in entry["parts"].items()}
+        entry["last_access"] = time.time()
+        self._saveIndex()
+        if entry["layout"] == "list":
+            return [parts[str(i)] for i in range(len(parts))]
+        if entry["layout"] == "dict":
+            return parts
+        return parts["value"]
+
+    def put(self, key: str, value):
+        """
+        Stores value under key, then evicts least-recently-used entries if the store is over max_bytes
+
+        Args:
+            key (str): Key from makeKey()
+            value: DataFrame, Series or Counter, or a list/dict of them
+        """
+        if isinstance(value, (list, tuple)):
+            layout, items = "list", {str(i): item for i, item in enumerate(value)}
+        elif isinstance(value, dict) and not isinstance(value, Counter):
+            layout, items = "dict", {str(part): item for part, item in value.items()}
+        else:
+            layout, items = "single", {"value": value}
+        
+        entry_dir = os.path.join(self.store_dir, key)
+        os.makedirs(entry_dir, exist_ok=True)
+        parts = {}
+        for part, item in items.items():
+            kind, df = _toFrame(item)
+            df.to_parquet(os.path.join(entry_dir, F"{part}.parquet"))
+            parts[part] = kind
+        n_bytes = sum(os.path.getsize(os.path.join(entry_dir, file_name)) for file_name in os.listdir(entry_dir))
+        self.index[key] = {"name": key.rsplit("_", 1)[0], "layout": layout, "parts": parts, "bytes": n_bytes,
+                           "created": time.time(), "last_access": time.time()}
+        self._evict()
+        self._saveIndex()
+
+    def _evict(self):
+        total = sum(entry["bytes"] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda key: self.index[key]["last_access"]):
+            if total <= self.max_bytes or len(self.index) == 1: # Always keep the most recent entry
+                break
+            total -= self.index[key]["bytes"]
+            shutil.rmtree(os.path.join(self.store_dir, key), ignore_errors=True)
+            del self.index[key]
+            LOG.info(F"Evicted checkpoint {key}")
+
+    def load(self, name: str, func: Callable, inputs: list[str] = [], params: dict = {}):
+        """
+        Returns value stored by checkpoint() for the same name, func, inputs and params, for consumers that don't recompute
+        Raises KeyError if it isn't stored, e.g., because the inputs or code changed since it was computed
+
+        Args:
+            name (str): Name of the result
+            func (Callable): Function that produced the result
+            inputs (list[str], optional): Paths of input files of the result. Defaults to [].
+            params (dict, optional): JSON-serializable filter parameters of the result. Defaults to {}.
+        """
+        key = self.makeKey(name, inputs=inputs, params=params, code=codeVersion(func))
+        if key not in self:
+            raise KeyError(F"No checkpoint of {name} from {func.__name__} for inputs {inputs} and params {params} with the "
+                           F"current code, run the step that computes it first (e.g., processing.py)")
+        LOG.info(F"Loaded checkpoint {key}")
+        return self.get(key)
+
+    def checkpoint(self, name: str, func: Callable, *args, inputs: list[str] = [], params: dict = {}, **kwargs):
+        """
+        Returns func(*args, **kwargs), read from the store if the same inputs, params and code produced it before
+
+        Args:
+            name (str): Name of the result
+            func (Callable): Function producing the result, its source is part of the key
+            inputs (list[str], optional): Paths of input files of the result. Defaults to [].
+            params (dict, optional): JSON-serializable filter parameters of the result. Defaults to {}.
+        """
+        key = self.makeKey(name, inputs=inputs, params=params, code=codeVersion(func))
+        if key in self:
+            LOG.info(F"Loaded checkpoint {key}")
+            return self.get(key)
+        value = func(*args, **kwargs)
+        self.put(key, value)
+        LOG.info(F"Saved checkpoint {key}")
+        return value
@@ -0,0 +1,226 @@
+# Command-line entry point that runs the pipeline from a config file, without the interactive cell workflow
+# Data is loaded and indexed once, then every target cancer in the config is run against it
+# Usage: python cli.py config.toml [--input data.csv] [--targets gbm ...] [--log-dir logs/]
+# Heavy modules are imported inside functions so --help and config errors return immediately
+
+#%% Imports
+import os, re, sys, json, argparse
+
+from constants import (COL_AGE, COL_SEX, COL_DIA_YEAR, COL_SITE, COL_SITE_LABELED, COL_HIST, COL_TYPE, COL_SURV, COL_RAD,
+                       COL_CHEMO, COL_ID, COL_SEQ, COL_ORD_PRIM, GBM_HIST_CODES, DERIVED_COLS) # No internal or third-party imports, cheap
+
+DEFAULT_CONFIG = {
+    "input": "data/SEER RPD 17 Nov 2021.csv",
+    "output_dir": "data/runs/",
+    "format": "parquet", # Format of exported DFs, see internals.EXPORT_FORMATS
+    "n_encatchment": 81885000, # SEER RPD 17 Nov 2021 should have ~81,885,000 total encatchment
+    "strata": [[COL_AGE], [COL_SEX]], # Each entry is one stratified incidence table
+    "bootstrap": 0, # Bootstrap resamples for CIs of stratum ratios, 0 to skip
+    "backend": "pandas", # Runs the incidence and strata tables, see backends.BACKENDS, "duckdb" queries the input instead of the loaded frame
+    "targets": [{
+        "name": "gbm",
+        "label": "GBM", # Name of the cancer in figure file names and labels, the target name if null, not inherited
+        "hist_codes": GBM_HIST_CODES,
+        "incidence_20y_first": 0.000556793, # 0 or omitted to derive from the data and n_encatchment, not inherited
+        "outputs": ["incidence", "strata", "cohorts", "association", "figures", "models"],
+    }],
+}
+OUTPUTS = ["incidence", "strata", "cohorts", "association", "figures", "models"]
+LOAD_COLS = [COL_ID, COL_AGE, COL_SEX, COL_DIA_YEAR, COL_SITE, COL_SITE_LABELED, COL_HIST, COL_TYPE, COL_SURV,
+             COL_RAD, COL_CHEMO, COL_SEQ, COL_ORD_PRIM] + DERIVED_COLS # Same as processing.py
+
+#%% Config
+
+def loadConfig(path: str = "") -> dict:
+    """
+    Returns DEFAULT_CONFIG updated with the JSON or TOML config at path, target entries inherit unset keys from the default target
+    except label and incidence_20y_first, which is derived from the data if omitted
+
+    Args:
+        path (str, optional): Path to .json or .toml config, defaults only if empty. Defaults to "".
+    """
+    config = {key: value for key, value in DEFAULT_CONFIG.items() if key != "targets"}
+    user_config = {}
+    if path:
+        if path.endswith(".toml"):
+            import tomllib # Python 3.11+
+            with open(path, "rb") as file:
+                user_config = tomllib.load(file)
+        else:
+            with open(path, "r") as file:
+                user_config = json.load(file)
+    unknown = set(user_config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(F"Unknown config keys: {sorted(unknown)}")
+    config.update({key: value for key, value in user_config.items() if key != "targets"})
+
+    default_target = DEFAULT_CONFIG["targets"][0]
+    config["targets"] = [{**default_target, "label": None, "incidence_20y_first": 0, **target}
+                         for target in user_config.get("targets", [default_target])]
+    for target in config["targets"]:
+        invalid = set(target["outputs"]) - set(OUTPUTS)
+        if invalid:
+            raise ValueError(F"Unknown outputs of target {target['name']}: {sorted(invalid)}, choose from {OUTPUTS}")
+    if len({target["name"] for target in config["targets"]}) != len(config["targets"]):
+        raise ValueError("Target names must be unique, they name the output directories")
+    strata_names = [strataName(strata) for strata in config["strata"]]
+    if len(set(strata_names)) != len(strata_names):
+        raise ValueError(F"Strata must be unique, they name the output files: {strata_names}")
+    return config
+
+def strataName(strata: list[str]) -> str:
+    """
+    Returns output name of a stratified incidence table from the full column names, e.g., "strata_sex_year_of_diagnosis"
+
+    Args:
+        strata (list[str]): Columns of one entry of config["strata"]
+    """
+    return "strata_" + "_".join(re.sub(R"\W+", "_", col).strip("_").lower() for col in strata)
+
+#%% Pipeline
+
+def runTarget(df, pt_index, cohorts, backend, target: dict, config: dict, exporter) -> dict:
+    """
+    Runs the outputs of one target cancer on already loaded data, returns dict of its results
+
+    Args:
+        df (DataFrame): Case listing
+        pt_index (PatientTimeline): Index built from df
+        cohorts (Cohorts): Cohort evaluator of df, shared between targets so common masks are reused
+        backend: Execution backend of the incidence and strata tables (backends.getBackend()), shared between targets
+        target (dict): Entry of config["targets"]
+        config (dict): Output of loadConfig()
+        exporter (Exporter): Background writer of exported DFs
+    """
+    from internals import LOG, stage
+    from cohort import histology, UNTREATED
+    from strata import targetCohorts
+
+    name, outputs = target["name"], target["outputs"]
+    out_dir = os.path.join(config["output_dir"], name)
+    os.makedirs(out_dir, exist_ok=True)
+    results = {}
+    with stage(F"target_{name}", rows_in=len(df)):
+        target_spec = histology(target["hist_codes"])
+        incidence_20y_first = target["incidence_20y_first"]
+        # Counts don't depend on the reference incidence, so a placeholder is used until it is known
+        overall = backend.incidence([], hist_codes=target["hist_codes"], incidence_20y_first=incidence_20y_first or 1)
+        if not incidence_20y_first: # Derive from the data as reportCancerIncidence() does
+            n_first_overall = int(overall["n_target"].iloc[0] - overall["n_second"].iloc[0])
+            incidence_20y_first = n_first_overall / config["n_encatchment"]
+            LOG.info(F"{name}: fraction of encatchment with primary target cancer: {incidence_20y_first}")
+            overall = backend.incidence([], hist_codes=target["hist_codes"], incidence_20y_first=incidence_20y_first)
+
+        if "incidence" in outputs:
+            LOG.info(F"{name}: >>> Ratio: {overall['ratio'].iloc[0]} <<<\n{overall.to_string()}")
+            exporter.export(overall, os.path.join(out_dir, "incidence"))
+            results["incidence"] = overall
+
+        if "strata" in outputs:
+            for strata in config["strata"]:
+                table = backend.incidence(strata, hist_codes=target["hist_codes"], incidence_20y_first=incidence_20y_first)
+                if config["bootstrap"]:
+                    from bootstrap import bootstrapTable
+                    table = bootstrapTable(table, incidence_20y_first, n_resamples=config["bootstrap"])
+                strata_name = strataName(strata)
+                LOG.info(F"{name}: {strata_name}\n{table.to_string()}")
+                exporter.export(table, os.path.join(out_dir, strata_name))
+                results[strata_name] = table
+
+        target_cohorts = targetCohorts(df, target["hist_codes"], index=pt_index) if {"cohorts", "models"} & set(outputs) else {}
+        if "cohorts" in outputs:
+            for cohort_name, df_cohort in target_cohorts.items():
+                exporter.export(df_cohort, os.path.join(out_dir, cohort_name))
+
+        if "association" in outputs or "figures" in outputs:
+            from association import buildAssociationTable
+            df_rel = cohorts.frame((target_spec & UNTREATED).patients() & ~target_spec) # Other tumours of untreated target patients
+            site_table = buildAssociationTable(df, df_rel, COL_SITE)
+            type_table = buildAssociationTable(df, df_rel, COL_TYPE)
+            exporter.export(site_table.reset_index(), os.path.join(out_dir, "site_assoc"))
+            exporter.export(type_table.reset_index(), os.path.join(out_dir, "type_assoc"))
+            results["association"] = {"site": site_table, "type": type_table}
+            if "figures" in outputs:
+                from plotting import renderFigures, makeFigureSpecs
+                specs = makeFigureSpecs(target["label"] or name)
+                results["figures"] = renderFigures(site_table, type_table, specs=specs, out_dir=os.path.join(out_dir, "figures"),
+                                                   max_workers=None) # One process per figure, safe behind the __main__ guard
+
+        if "models" in outputs:
+            from regression import fitModels, COL_OUTCOME
+            from cohort import FIRST_PRIMARY
+            df_firsts = cohorts.frame(FIRST_PRIMARY).copy()
+            df_firsts[COL_OUTCOME] = df_firsts[COL_ID].isin(target_cohorts["second"][COL_ID])
+            models = fitModels(df_firsts)
+            for model_name, (coefs, _) in models.items():
+                exporter.export(coefs.reset_index(names="term"), os.path.join(out_dir, F"model_{model_name}"))
+            results["models"] = models
+    return results
+
+def runConfig(config: dict) -> dict[str, dict]:
+    """
+    Loads and indexes the input once, then runs every target of config on it, returns dict of target name to results
+
+    Args:
+        config (dict): Output of loadConfig()
+    """
+    from internals import LOG, loadCache, stage
+    from indexing import PatientTimeline
+    from cohort import Cohorts
+    from exporting import Exporter
+    from backends import getBackend
+
+    strata_cols = [col for strata in config["strata"] for col in strata]
+    cols = LOAD_COLS + [col for col in dict.fromkeys(strata_cols) if col not in LOAD_COLS]
+    df = loadCache(config["input"], cols=cols) # Only columns used by the outputs are read from the cache
+    with stage("patient_index", rows_in=len(df)):
+        pt_index = PatientTimeline(df)
+    cohorts = Cohorts(df, index=pt_index)
+    backend = getBackend(config["backend"], df if config["backend"] == "pandas" else config["input"]) # Pandas reuses the loaded frame
+    results = {}
+    with Exporter(fmt=config["format"]) as exporter:
+        for target in config["targets"]:
+            LOG.info(F"Running target {target['name']} (histology codes {target['hist_codes']})")
+            results[target["name"]] = runTarget(df, pt_index, cohorts, backend, target, config, exporter)
+    LOG.info(F"Finished {len(results)} targets, {cohorts.n_evaluated} cohort masks evaluated")
+    return results
+
+#%% Main
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Run the SEER target cancer pipeline from a config file")
+    parser.add_argument("config", nargs="?", default="", help="JSON or TOML config, built-in defaults if omitted")
+    parser.add_argument("--input", default="", help="Override input CSV of the config")
+    parser.add_argument("--output-dir", default="", help="Override output directory of the config")
+    parser.add_argument("--backend", default="", help="Override backend of the config, e.g., duckdb")
+    parser.add_argument("--targets", nargs="+", default=[], help="Only run these target names of the config")
+    parser.add_argument("--log-dir", default="", help="Directory of the log file and trace")
+    parser.add_argument("--no-log-file", action="store_true", help="Log to the console only, without log or trace files")
+    parser.add_argument("--print-config", action="store_true", help="Print resolved config and exit")
+    args = parser.parse_args(argv)
+
+    config = loadConfig(args.config)
+    if args.input:
+        config["input"] = args.input
+    if args.output_dir:
+        config["output_dir"] = args.output_dir
+    if args.backend:
+        config["backend"] = args.backend
+    if args.targets:
+        missing = set(args.targets) - {target["name"] for target in config["targets"]}
+        if missing:
+            parser.error(F"Targets not in config: {sorted(missing)}")
+        config["targets"] = [target for target in config["targets"] if target["name"] in args.targets]
+    if args.print_config:
+        print(json.dumps(config, indent=2))
+        return
+
+    # Read by internals when first imported, i.e., by runConfig()
+    if args.no_log_file:
+        os.environ["GBM_LOG_FILE"] = "0"
+    if args.log_dir:
+        os.environ["GBM_LOG_DIR"] = args.log_dir
+    runConfig(config)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+# Declarative cohort definitions composed from record-level predicates, evaluated to row masks with memoization
+# Specs are immutable and hashable, so any cohort built from the same predicates reuses the masks already computed for them
+
+#%% Imports
+import numpy as np
+from pandas import DataFrame
+
+from internals import LOG, regexMask, firstPrimaryMask
+from indexing import PatientIndex
+from constants import (COL_AGE, COL_AGE_ORD, COL_SEX, COL_SITE_LABELED, COL_HIST, COL_RAD, COL_CHEMO, COL_ORD_PRIM,
+                       GBM_HIST_CODES, FIRST_PRIM_REGEX, AGE_BINS, NO_RAD_VALUES, NO_CHEMO_VALUES)
+
+#%% Specs
+
+class CohortSpec:
+    """
+    Base of cohort specs, combine with & (and), | (or), ~ (not) and .patients() (all records of matching patients)
+    Specs compare and hash by their key, so equal definitions share one cached mask in Cohorts
+    """
+    key: tuple = ()
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        raise NotImplementedError
+
+    def patients(self) -> "Patients":
+        return Patients(self)
+
+    def __and__(self, other: "CohortSpec") -> "And":
+        return And(self, other)
+
+    def __or__(self, other: "CohortSpec") -> "Or":
+        return Or(self, other)
+
+    def __invert__(self) -> "CohortSpec":
+        return self.spec if isinstance(self, Not) else Not(self)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CohortSpec) and self.key == other.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __repr__(self):
+        return F"{type(self).__name__}{self.key[1:]}"
+
+class Values(CohortSpec):
+    """
+    Records whose col is one of values, as df[col].isin(values)
+    """
+    def __init__(self, col: str, values: list):
+        self.col = col
+        self.values = tuple(sorted(set(values), key=repr)) # Order of values doesn't change the cohort
+        self.key = ("values", col, self.values)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        return cohorts.df[self.col].isin(self.values).to_numpy(dtype=bool)
+
+class Matches(CohortSpec):
+    """
+    Records whose col matches regex pattern, as df[col].str.contains(pattern, na=False)
+    """
+    def __init__(self, col: str, pattern: str):
+        self.col = col
+        self.pattern = pattern
+        self.key = ("matches", col, pattern)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        return regexMask(cohorts.df[self.col], self.pattern) # Regex runs once per distinct value
+
+class FirstPrimary(CohortSpec):
+    """
+    Records that were a first primary, from the precomputed COL_IS_FIRST column when df has it
+    """
+    key = ("first_primary", COL_ORD_PRIM, FIRST_PRIM_REGEX)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        return firstPrimaryMask(cohorts.df)
+
+    def __repr__(self):
+        return "FirstPrimary()"
+
+class Ages(CohortSpec):
+    """
+    Records in any of the age bins of AGE_BINS, compared as ordinals on the precomputed COL_AGE_ORD column when df has it
+    """
+    def __init__(self, bins: list[str]):
+        unknown = set(bins) - set(AGE_BINS)
+        if unknown:
+            raise ValueError(F"Unknown age bins {sorted(unknown)}, choose from {AGE_BINS}")
+        self.bins = tuple(sorted(set(bins), key=AGE_BINS.index))
+        self.key = ("ages", self.bins)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        if COL_AGE_ORD in cohorts.df.columns:
+            return np.isin(cohorts.df[COL_AGE_ORD].to_numpy(), [AGE_BINS.index(age_bin) for age_bin in self.bins])
+        return cohorts.df[COL_AGE].isin(self.bins).to_numpy(dtype=bool)
+
+class And(CohortSpec):
+    def __init__(self, *specs: CohortSpec):
+        flat = []
+        for spec in specs: # Nested Ands are flattened so a & (b & c) == (a & b) & c
+            flat.extend(spec.specs if isinstance(spec, And) else [spec])
+        self.specs = tuple(sorted(set(flat), key=lambda spec: repr(spec.key))) # Order of terms doesn't change the cohort
+        self.key = ("and",) + tuple(spec.key for spec in self.specs)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        mask = cohorts.mask(self.specs[0]).copy()
+        for spec in self.specs[1:]:
+            mask &= cohorts.mask(spec)
+        return mask
+
+    def __repr__(self):
+        return "(" + " & ".join(repr(spec) for spec in self.specs) + ")"
+
+class Or(CohortSpec):
+    def __init__(self, *specs: CohortSpec):
+        flat = []
+        for spec in specs:
+            flat.extend(spec.specs if isinstance(spec, Or) else [spec])
+        self.specs = tuple(sorted(set(flat), key=lambda spec: repr(spec.key)))
+        self.key = ("or",) + tuple(spec.key for spec in self.specs)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        mask = cohorts.mask(self.specs[0]).copy()
+        for spec in self.specs[1:]:
+            mask |= cohorts.mask(spec)
+        return mask
+
+    def __repr__(self):
+        return "(" + " | ".join(repr(spec) for spec in self.specs) + ")"
+
+class Not(CohortSpec):
+    def __init__(self, spec: CohortSpec):
+        self.spec = spec
+        self.key = ("not", spec.key)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        return ~cohorts.mask(self.spec)
+
+    def __repr__(self):
+        return F"~{self.spec!r}"
+
+class Patients(CohortSpec):
+    """
+    All records of patients with at least one record in spec, gathered through the PatientIndex of Cohorts
+    """
+    def __init__(self, spec: CohortSpec):
+        self.spec = spec.spec if isinstance(spec, Patients) else spec # Expanding twice is the same as expanding once
+        self.key = ("patients", self.spec.key)
+
+    def evaluate(self, cohorts: "Cohorts") -> np.ndarray:
+        return cohorts.index.expand(cohorts.mask(self.spec))
+
+    def __repr__(self):
+        return F"Patients({self.spec!r})"
+
+#%% Predicates used by the pipeline
+
+def histology(codes: list[int] = GBM_HIST_CODES) -> Values:
+    return Values(COL_HIST, codes)
+
+def firstPrimary() -> "FirstPrimary":
+    return FirstPrimary()
+
+def untreated(rad_values: list[str] = NO_RAD_VALUES, chemo_values: list[str] = NO_CHEMO_VALUES) -> And:
+    return Values(COL_RAD, rad_values) & Values(COL_CHEMO, chemo_values)
+
+def ages(bins: list[str]) -> Ages:
+    return Ages(bins)
+
+def agesFrom(youngest: str) -> Ages:
+    return Ages(AGE_BINS[AGE_BINS.index(youngest):])
+
+def sex(value: str) -> Values:
+    return Values(COL_SEX, [value])
+
+def site(labels: list[str], col: str = COL_SITE_LABELED) -> Values:
+    return Values(col, labels)
+
+GBM = histology(GBM_HIST_CODES)
+FIRST_PRIMARY = firstPrimary()
+UNTREATED = untreated()
+
+#%% Evaluation
+
+class Cohorts:
+    """
+    Evaluates cohort specs against one DF, caching the mask of every spec and sub-spec evaluated
+    Masks are boolean arrays over rows of df and are read-only since they are shared between cohorts
+    """
+    def __init__(self, df: DataFrame, index: PatientIndex = None):
+        self.df = df
+        self._index = index
+        self._masks: dict[CohortSpec, np.ndarray] = {}
+        self.n_evaluated = 0 # Number of specs evaluated rather than served from cache
+
+    @property
+    def index(self) -> PatientIndex:
+        if self._index is None: # Only built when a patient-level spec is evaluated
+            self._index = PatientIndex(self.df)
+        return self._index
+
+    def mask(self, spec: CohortSpec) -> np.ndarray:
+        """
+        Returns boolean array over rows of df selecting records in spec
+
+        Args:
+            spec (CohortSpec): Cohort definition
+        """
+        if spec not in self._masks:
+            mask = np.asarray(spec.evaluate(self), dtype=bool)
+            mask.setflags(write=False)
+            self._masks[spec] = mask
+            self.n_evaluated += 1
+        return self._masks[spec]
+
+    def frame(self, spec: CohortSpec) -> DataFrame:
+        """
+        Returns records of df in spec
+
+        Args:
+            spec (CohortSpec): Cohort definition
+        """
+        return self.df[self.mask(spec)]
+
+    def nunique(self, spec: CohortSpec) -> int:
+        """
+        Returns number of patients with at least one record in spec
+
+        Args:
+            spec (CohortSpec): Cohort definition
+        """
+        return self.index.nunique(self.mask(spec))
+
+    def describe(self, spec: CohortSpec) -> dict[str, int]:
+        """
+        Returns and logs number of records and patients in spec
+
+        Args:
+            spec (CohortSpec): Cohort definition
+        """
+        counts = {"records": int(np.count_nonzero(self.mask(spec))), "patients": self.nunique(spec)}
+        LOG.info(F"Cohort {spec!r}: {counts['records']} records, {counts['patients']} patients")
+        return counts
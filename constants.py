@@ -0,0 +1,39 @@
+# Column labels and codes shared across the SEER pipeline modules
+# Kept free of internal imports so any module (including internals) can import from here without circular imports
+
+#%% Columns
+COL_AGE = "Age recode with <1 year olds"
+COL_SEX = "Sex"
+COL_DIA_YEAR = "Year of diagnosis"
+COL_SITE = "Site recode ICD-O-3/WHO 2008"
+COL_SITE_LABELED = "Primary Site - labeled"
+COL_HIST = "Histologic Type ICD-O-3"
+COL_TYPE = "ICD-O-3 Hist/behav"
+COL_SURV = "Survival months"
+COL_RAD = "Radiation recode"
+COL_CHEMO = "Chemotherapy recode (yes, no/unk)"
+COL_MO_TX = "Months from diagnosis to treatment"
+COL_ID = "Patient ID"
+COL_SEQ = "Record number recode" # Sequentially numbers a person's tumors within each SEER submission. Order is based on date of diagnosis and then sequence #. 
+COL_FIRST_PRIM = "First malignant primary indicator" # First MALIGNANT cancer; does not necessarily mean first cancer as could have many prior non-malignant neoplasm
+COL_PRIMARY = "Primary by international rules" # Whether its primary or mets
+COL_ORD_PRIM = "Sequence number" # Order of the primary AT THE TIME OF DIAGNOSIS, should only have 1-2 primaries when first diagnosed (rarely should you be walking in with 3+ primaries without being diagnosed) FIXME UNSURE HOW IT CHANGES WITH EACH ENTRY, SHOULD DOUBLE CHECK FOR A SPECIFIC PATIENT WITH MULTIPLE ENTRIES
+
+#%% Codes and values
+GBM_HIST_CODES = [9440, 9441, 9442, 9445]
+FIRST_PRIM_REGEX = 'One primary only|1st of 2 or more primaries' # Matches COL_ORD_PRIM values of a first primary
+AGE_BINS = ["00 years", "01-04 years", "05-09 years", "10-14 years", "15-19 years", "20-24 years", "25-29 years",
+            "30-34 years", "35-39 years", "40-44 years", "45-49 years", "50-54 years", "55-59 years", "60-64 years",
+            "65-69 years", "70-74 years", "75-79 years", "80-84 years", "85+ years"] # COL_AGE values in age order
+NO_RAD_VALUES = ['None/Unknown', 'Refused (1988+)']
+NO_CHEMO_VALUES = ['No/Unknown']
+
+#%% Dtypes for the typed cache
+CAT_COLS = [COL_AGE, COL_SEX, COL_SITE, COL_TYPE, COL_ORD_PRIM, COL_RAD, COL_CHEMO] # Low-cardinality text columns stored as categoricals
+INT_COLS = [COL_HIST] # Stored as nullable integers
+NUM_COLS = [COL_SURV] # Coerced to float, non-numerics become NaN
+
+#%% Derived columns added by internals.compactDtypes()
+COL_IS_FIRST = "is_first_primary" # COL_ORD_PRIM matches FIRST_PRIM_REGEX, saves rerunning the regex on every filter
+COL_AGE_ORD = "age_ordinal" # 0-based position of COL_AGE in AGE_BINS, -1 if missing or not a known bin
+DERIVED_COLS = [COL_IS_FIRST, COL_AGE_ORD]
@@ -0,0 +1,54 @@
+# Background writer for DataFrame exports so the analysis doesn't block on disk I/O
+
+#%% Imports
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from pandas import DataFrame
+
+from internals import LOG, writeFrame
+
+#%% Classes
+
+class Exporter:
+    """
+    Writes DataFrames on a background thread pool, defaulting to Parquet
+    Frames passed to export() should not be modified afterwards until wait() returns
+    Can be used as a context manager, which waits for all pending writes on exit
+    """
+    def __init__(self, fmt: str = "parquet", max_workers: int = 2):
+        self.fmt = fmt
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self.pending: list[Future] = []
+
+    def export(self, df: DataFrame, path_stem: str, fmt: str = None) -> Future:
+        """
+        Queues df to be written to path_stem plus the extension of fmt, returns Future of the path written
+
+        Args:
+            df (DataFrame): DF to write
+            path_stem (str): Output path without extension
+            fmt (str, optional): One of internals.EXPORT_FORMATS, Excel ("xlsx") only when explicitly requested. Defaults to self.fmt.
+        """
+        future = self.executor.submit(writeFrame, df, path_stem, fmt or self.fmt)
+        self.pending.append(future)
+        return future
+
+    def wait(self) -> list[str]:
+        """
+        Blocks until all queued writes finish, returns paths written and re-raises the first write error
+        """
+        paths = [future.result() for future in self.pending]
+        self.pending = []
+        for path in paths:
+            LOG.info(F"Exported {path}")
+        return paths
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
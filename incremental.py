@@ -0,0 +1,228 @@
+# Incremental maintenance of the pipeline aggregates when a new SEER release or correction delta arrives
+# Only records in the delta and the records of the patients they touch are re-aggregated, the rest of history is untouched
+# and stays on disk in partitions that are neither read nor rewritten
+
+#%% Imports
+import os, json
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+from internals import LOG, instrument, firstPrimaryMask
+from association import normalizeAssociationTable
+from constants import (COL_ID, COL_SEQ, COL_SITE, COL_TYPE, COL_HIST, COL_SURV, COL_RAD, COL_CHEMO, COL_ORD_PRIM,
+                       GBM_HIST_CODES, NO_RAD_VALUES, NO_CHEMO_VALUES)
+
+INCREMENTAL_DIR = "data/incremental/"
+RECORD_COLS = [COL_ID, COL_SEQ, COL_SITE, COL_TYPE, COL_HIST, COL_SURV, COL_RAD, COL_CHEMO, COL_ORD_PRIM]
+KEY_COLS = {"site": COL_SITE, "type": COL_TYPE}
+N_PARTITIONS = 256 # Stored records are split by patient ID, an update only reads and rewrites the partitions of patients it touches
+
+#%% Classes
+
+class IncrementalState:
+    """
+    Mergeable aggregates of the pipeline, persisted in state_dir and updated from delta files of new or corrected records
+    Records are keyed on (COL_ID, COL_SEQ), a delta record with an existing key replaces the stored one
+
+    Stored state:
+        records/part_NNNN.parquet: narrow per-record columns needed to retract a record's contributions when it is replaced,
+        partitioned by COL_ID % n_partitions so all records of a patient are in one partition. Partitions are read on first use
+        aggregates: per-site/type record counts, survival sums, first-tumour survival sums and counts of
+        non-target records of patients with an untreated target cancer (the "count" column of association tables), and
+        the whole-dataset record and patient counts of incidence()
+    """
+    def __init__(self,
+                 state_dir: str = INCREMENTAL_DIR,
+                 hist_codes: list[int] = GBM_HIST_CODES,
+                 rad_values: list[str] = NO_RAD_VALUES,
+                 chemo_values: list[str] = NO_CHEMO_VALUES,
+                 n_partitions: int = N_PARTITIONS,
+                 ):
+        self.state_dir = state_dir
+        self.params = {"hist_codes": list(hist_codes), "rad_values": list(rad_values), "chemo_values": list(chemo_values)}
+        self.n_partitions = n_partitions
+        self._records: dict[int, DataFrame] = {} # Partitions read or updated so far
+        self._dirty: set[int] = set() # Partitions changed since the last save()
+        self.aggregates: dict[str, Series] = {}
+        if os.path.exists(os.path.join(state_dir, "meta.json")):
+            self.load()
+
+    #%% Persistence
+    def save(self):
+        """
+        Writes the partitions changed since the last save and the aggregates, unchanged partitions aren't rewritten
+        """
+        os.makedirs(os.path.join(self.state_dir, "records"), exist_ok=True)
+        for part in sorted(self._dirty):
+            self._records[part].to_parquet(self._partitionPath(part), index=False)
+        LOG.info(F"Saved {len(self._dirty)} of {self.n_partitions} record partitions")
+        self._dirty.clear()
+        aggregates = pd.concat({name: series.rename("value") for name, series in self.aggregates.items()}, names=["aggregate", "key"])
+        aggregates.reset_index().to_parquet(os.path.join(self.state_dir, "aggregates.parquet"), index=False)
+        with open(os.path.join(self.state_dir, "meta.json"), "w") as file:
+            json.dump({"params": self.params, "n_partitions": self.n_partitions, "n_records": self.n_records}, file, indent=2)
+
+    def load(self):
+        """
+        Reads the aggregates of the saved state, record partitions are only read when an update touches them
+        """
+        with open(os.path.join(self.state_dir, "meta.json"), "r") as file:
+            meta = json.load(file)
+        if meta["params"] != self.params:
+            raise ValueError(F"State in {self.state_dir} was built with {meta['params']}, not {self.params}")
+        if meta.get("n_partitions") != self.n_partitions:
+            raise ValueError(F"State in {self.state_dir} has {meta.get('n_partitions')} partitions, not {self.n_partitions}, rebuild it")
+        self._records, self._dirty = {}, set()
+        aggregates = pd.read_parquet(os.path.join(self.state_dir, "aggregates.parquet"))
+        self.aggregates = {name: group.set_index("key")["value"].rename_axis(None) for name, group in aggregates.groupby("aggregate")}
+
+    def _partitionPath(self, part: int) -> str:
+        return os.path.join(self.state_dir, "records", F"part_{part:04d}.parquet")
+
+    def _partitionOf(self, ids) -> np.ndarray:
+        return np.asarray(ids, dtype=np.int64) % self.n_partitions
+
+    def _partition(self, part: int) -> DataFrame:
+        if part not in self._records:
+            path = self._partitionPath(part)
+            self._records[part] = pd.read_parquet(path) if os.path.exists(path) else DataFrame(columns=RECORD_COLS + ["first_prim"])
+        return self._records[part]
+
+    @property
+    def records(self) -> DataFrame:
+        """
+        All stored records, reads every partition
+        """
+        return _concat([self._partition(part) for part in range(self.n_partitions)])
+
+    @property
+    def flags(self) -> DataFrame:
+        """
+        Per-patient first-primary state (target, target_first, target_untreated) indexed by patient ID, recomputed from all records
+        """
+        return self._patientAggregates(self.records)[0]
+
+    @property
+    def n_records(self) -> int:
+        return int(self.aggregates.get("totals", Series(dtype=float)).get("n_records", 0))
+
+    #%% Contributions
+    def _prepare(self, df: DataFrame) -> DataFrame:
+        # Narrow, typed copy of records; key columns as strings so aggregates from different files align
+        # Missing values stay NA rather than becoming "nan", so groupby() drops them like buildAssociationTable() does
+        records = df[RECORD_COLS].copy()
+        records[COL_SURV] = pd.to_numeric(records[COL_SURV], errors="coerce")
+        for col in [COL_SITE, COL_TYPE, COL_RAD, COL_CHEMO, COL_ORD_PRIM]:
+            records[col] = records[col].astype("string")
+        records["first_prim"] = firstPrimaryMask(df) # Same row order as records
+        return records.drop_duplicates(subset=[COL_ID, COL_SEQ], keep="last") # Last record of a key within a delta wins
+
+    def _recordAggregates(self, records: DataFrame) -> dict[str, Series]:
+        # Contributions that only depend on each record itself
+        aggregates = {}
+        is_first = records[COL_SEQ] == 1
+        for name, col in KEY_COLS.items():
+            aggregates[F"total_{name}"] = records.groupby(col)[COL_SURV].size().astype(float)
+            aggregates[F"surv_{name}"] = records.groupby(col)[COL_SURV].sum()
+            aggregates[F"f_surv_{name}"] = records[is_first].groupby(col)[COL_SURV].sum()
+        return aggregates
+
+    def _patientAggregates(self, records: DataFrame) -> tuple[DataFrame, dict[str, Series]]:
+        # Contributions that depend on all records of a patient, records must hold every record of the patients involved
+        is_target = records[COL_HIST].isin(self.params["hist_codes"])
+        untreated = (is_target
+                     & records[COL_RAD].isin(self.params["rad_values"])
+                     & records[COL_CHEMO].isin(self.params["chemo_values"]))
+        flags = DataFrame({"target": is_target, "target_first": is_target & records["first_prim"], "target_untreated": untreated,
+                           COL_ID: records[COL_ID]}).groupby(COL_ID).any()
+        rel = records[records[COL_ID].map(flags["target_untreated"]).to_numpy(dtype=bool) & ~is_target.to_numpy()]
+        aggregates = {F"rel_{name}": rel.groupby(col).size().astype(float) for name, col in KEY_COLS.items()}
+        aggregates["totals"] = Series({"n_records": len(records), "n_patients": len(flags),
+                                       "n_target": flags["target"].sum(), "n_first": flags["target_first"].sum(),
+                                       "n_second": (flags["target"] & ~flags["target_first"]).sum()}, dtype=float)
+        return flags, aggregates
+
+    def _apply(self, aggregates: dict[str, Series], sign: int):
+        for name, series in aggregates.items():
+            current = self.aggregates.get(name, Series(dtype=float))
+            self.aggregates[name] = current.add(sign * series, fill_value=0)
+
+    #%% Update
+    @instrument("incremental_update")
+    def update(self, df_delta: DataFrame) -> np.ndarray:
+        """
+        Merges new or corrected records into the state, returns IDs of affected patients
+        Costs one pass over the delta plus the stored partitions of the patients it touches, which are rewritten by the next save()
+
+        Args:
+            df_delta (DataFrame): Case listing of new or corrected records, e.g., a new SEER release year
+        """
+        delta = self._prepare(df_delta)
+        affected = pd.unique(delta[COL_ID])
+        parts = np.unique(self._partitionOf(affected))
+
+        stored = {part: self._partition(part) for part in parts}
+        aff_masks = {part: records[COL_ID].isin(affected).to_numpy() for part, records in stored.items()}
+        old_aff = _concat([records[aff_masks[part]] for part, records in stored.items()])
+        delta_keys = pd.MultiIndex.from_frame(delta[[COL_ID, COL_SEQ]])
+        replaced = pd.MultiIndex.from_frame(old_aff[[COL_ID, COL_SEQ]]).isin(delta_keys)
+
+        # Retract contributions of replaced records and of the affected patients' previous state
+        self._apply(self._recordAggregates(old_aff[replaced]), -1)
+        _, old_patient_aggs = self._patientAggregates(old_aff)
+        self._apply(old_patient_aggs, -1)
+
+        # Add contributions of the delta and of the affected patients' new state
+        new_aff = _concat([old_aff[~replaced], delta])
+        self._apply(self._recordAggregates(delta), 1)
+        _, new_patient_aggs = self._patientAggregates(new_aff)
+        self._apply(new_patient_aggs, 1)
+
+        new_parts = self._partitionOf(new_aff[COL_ID])
+        for part, records in stored.items():
+            self._records[part] = _concat([records[~aff_masks[part]], new_aff[new_parts == part]])
+        self._dirty.update(parts.tolist())
+        LOG.info(F"Incremental update: {len(delta)} delta records, {len(affected)} affected patients in {len(parts)} partitions, "
+                 F"{int(replaced.sum())} records replaced")
+        return affected
+
+    #%% Outputs
+    def associationTable(self, key: str = "site") -> DataFrame:
+        """
+        Returns association table in the layout of association.buildAssociationTable() from the stored aggregates
+
+        Args:
+            key (str, optional): "site" or "type". Defaults to "site".
+        """
+        table = DataFrame({"count": self.aggregates.get(F"rel_{key}", Series(dtype=float)),
+                           "total": self.aggregates[F"total_{key}"],
+                           "surv_sum": self.aggregates[F"surv_{key}"],
+                           "f_surv_sum": self.aggregates.get(F"f_surv_{key}", Series(dtype=float)),
+                           }).fillna(0)
+        table = table[table["total"] > 0] # Keys whose records were all replaced
+        table.index.name = KEY_COLS[key]
+        return normalizeAssociationTable(table)
+
+    def incidence(self, incidence_20y_first: float = 0.000556793) -> dict[str, float]:
+        """
+        Returns whole-dataset counts and ratio of the target cancer, same as the single row of strata.stratifiedIncidence(df)
+
+        Args:
+            incidence_20y_first (float, optional): Reference 20 year incidence of target cancer as first cancer. Defaults to 0.000556793.
+        """
+        totals = self.aggregates.get("totals", Series(dtype=float))
+        n_patients, n_first, n_second = (int(totals.get(name, 0)) for name in ["n_patients", "n_first", "n_second"])
+        n_not_first = n_patients - n_first
+        incidence_sec = n_second / n_not_first if n_not_first else np.nan
+        return {"n_patients": n_patients, "n_target": int(totals.get("n_target", 0)), "n_first": n_first,
+                "n_not_first": n_not_first, "n_second": n_second, "incidence_sec": incidence_sec,
+                "ratio": incidence_sec / incidence_20y_first}
+
+def _concat(frames: list[DataFrame]) -> DataFrame:
+    # Concatenates frames, skipping empty ones so placeholder partitions don't turn typed columns into object
+    non_empty = [frame for frame in frames if len(frame)]
+    if not non_empty:
+        return frames[0].iloc[:0] if frames else DataFrame(columns=RECORD_COLS + ["first_prim"])
+    return pd.concat(non_empty, ignore_index=True)
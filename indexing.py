@@ -0,0 +1,188 @@
+#%% Imports
+import numpy as np
+from pandas import DataFrame
+
+from constants import COL_ID, COL_SEQ
+
+#%% Classes
+
+class PatientIndex:
+    """
+    CSR-style mapping from each patient to the positions of their rows in a DF
+    Built once by sorting on patient ID, afterwards "all records of these patients" is a gather rather than an isin() scan
+    Row positions are positional (iloc) and only valid for the DF the index was built from
+    """
+    def __init__(self, df: DataFrame, id_col: str = COL_ID):
+        ids = df[id_col].to_numpy()
+        self.n_rows = len(ids)
+        self.order = self._sortOrder(df, ids) # Row positions grouped by patient
+        sorted_ids = ids[self.order]
+        starts = np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1 # Positions where a new patient starts
+        self.offsets = np.concatenate([[0], starts, [self.n_rows]]).astype(np.int64) # Rows of patient i are order[offsets[i]:offsets[i+1]]
+        self.patients = sorted_ids[self.offsets[:-1]] # Patient ID of each patient number
+        self.counts = np.diff(self.offsets)
+        self.row_patient = np.empty(self.n_rows, dtype=np.int64) # Patient number of each row
+        self.row_patient[self.order] = np.repeat(np.arange(len(self.patients)), self.counts)
+
+    def _sortOrder(self, df: DataFrame, ids: np.ndarray) -> np.ndarray:
+        return np.argsort(ids, kind="stable") # Stable to keep original row order within patients
+
+    @property
+    def n_patients(self) -> int:
+        return len(self.patients)
+
+    def patientMask(self, row_mask: np.ndarray) -> np.ndarray:
+        """
+        Returns boolean array over patient numbers, True for patients with at least one row in row_mask
+
+        Args:
+            row_mask (np.ndarray): Boolean array over rows
+        """
+        pt_mask = np.zeros(self.n_patients, dtype=bool)
+        pt_mask[self.row_patient[np.asarray(row_mask, dtype=bool)]] = True
+        return pt_mask
+
+    def nunique(self, row_mask: np.ndarray) -> int:
+        """
+        Returns number of unique patients with at least one row in row_mask, equivalent to df[row_mask][COL_ID].nunique()
+
+        Args:
+            row_mask (np.ndarray): Boolean array over rows
+        """
+        return int(np.count_nonzero(self.patientMask(row_mask)))
+
+    def expand(self, row_mask: np.ndarray) -> np.ndarray:
+        """
+        Returns boolean array over rows selecting all records of patients with at least one row in row_mask
+        Equivalent to df[COL_ID].isin(df[row_mask][COL_ID]) but gathers per-patient flags instead of hashing every row
+
+        Args:
+            row_mask (np.ndarray): Boolean array over rows
+        """
+        return self.patientMask(row_mask)[self.row_patient]
+
+    def rows(self, patient_nums: np.ndarray) -> np.ndarray:
+        """
+        Returns row positions of the given patient numbers (not patient IDs), grouped by patient
+
+        Args:
+            patient_nums (np.ndarray): Integer array of patient numbers, i.e., positions in self.patients
+        """
+        patient_nums = np.asarray(patient_nums, dtype=np.int64)
+        lengths = self.counts[patient_nums]
+        starts = np.repeat(self.offsets[patient_nums], lengths)
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) # Position within each patient's block
+        return self.order[starts + within]
+
+    def patientNums(self, patient_ids) -> np.ndarray:
+        """
+        Returns patient numbers of the given patient IDs, IDs not in the index are dropped
+
+        Args:
+            patient_ids: Iterable of patient IDs
+        """
+        patient_ids = np.unique(np.asarray(list(patient_ids)))
+        pos = np.searchsorted(self.patients, patient_ids) # self.patients is sorted since it comes from the sorted IDs
+        found = pos < self.n_patients
+        found[found] = self.patients[pos[found]] == patient_ids[found]
+        return pos[found]
+
+    def take(self, df: DataFrame, patient_ids) -> DataFrame:
+        """
+        Returns all records of the given patient IDs from df, df must be the DF the index was built from
+
+        Args:
+            df (DataFrame): DF the index was built from
+            patient_ids: Iterable of patient IDs
+        """
+        return df.iloc[np.sort(self.rows(self.patientNums(patient_ids)))] # Sort to keep original row order
+
+class PatientTimeline(PatientIndex):
+    """
+    PatientIndex whose rows are ordered by COL_SEQ within each patient, i.e., each patient's tumours in order of diagnosis
+    Sequence questions (first target tumour, tumours after it, intervals between primaries, last record) are answered with
+    one pass over the sorted arrays instead of a df[df[COL_ID] == pt_id] lookup per patient
+    Per-patient results are arrays over patient numbers (positions in self.patients), per-row results are arrays over rows of df
+    """
+    def __init__(self, df: DataFrame, id_col: str = COL_ID, seq_col: str = COL_SEQ):
+        self.seq_col = seq_col
+        super().__init__(df, id_col)
+        self.row_position = np.empty(self.n_rows, dtype=np.int64) # 0-based position of each row within its patient's timeline
+        self.row_position[self.order] = np.arange(self.n_rows) - np.repeat(self.offsets[:-1], self.counts)
+
+    def _sortOrder(self, df: DataFrame, ids: np.ndarray) -> np.ndarray:
+        return np.lexsort((df[self.seq_col].to_numpy(), ids)) # By ID, then sequence within ID
+
+    def firstRows(self) -> np.ndarray:
+        """
+        Returns row position of each patient's earliest record
+        """
+        return self.order[self.offsets[:-1]]
+
+    def lastRows(self) -> np.ndarray:
+        """
+        Returns row position of each patient's latest record, e.g., df.iloc[timeline.lastRows()][COL_SEQ] is the max record number
+        """
+        return self.order[self.offsets[1:] - 1]
+
+    def firstPosition(self, row_mask: np.ndarray) -> np.ndarray:
+        """
+        Returns 0-based timeline position of each patient's earliest row in row_mask, -1 for patients without any
+
+        Args:
+            row_mask (np.ndarray): Boolean array over rows, e.g., target cancer records
+        """
+        sorted_mask = np.asarray(row_mask, dtype=bool)[self.order]
+        hits = np.flatnonzero(sorted_mask) # Sorted positions, so the first hit of each patient comes first
+        hit_patients = self.row_patient[self.order[hits]]
+        first_pos = np.full(self.n_patients, -1, dtype=np.int64)
+        patients, first_hit = np.unique(hit_patients, return_index=True)
+        first_pos[patients] = hits[first_hit] - self.offsets[patients]
+        return first_pos
+
+    def after(self, row_mask: np.ndarray) -> np.ndarray:
+        """
+        Returns boolean array over rows selecting records that come after their patient's earliest row in row_mask,
+        e.g., tumours diagnosed after GBM
+
+        Args:
+            row_mask (np.ndarray): Boolean array over rows
+        """
+        first_pos = self.firstPosition(row_mask)[self.row_patient]
+        return (first_pos >= 0) & (self.row_position > first_pos)
+
+    def before(self, row_mask: np.ndarray) -> np.ndarray:
+        """
+        Returns boolean array over rows selecting records that come before their patient's earliest row in row_mask
+
+        Args:
+            row_mask (np.ndarray): Boolean array over rows
+        """
+        first_pos = self.firstPosition(row_mask)[self.row_patient]
+        return self.row_position < first_pos # Patients without a row in row_mask have first_pos -1
+
+    def countAfter(self, row_mask: np.ndarray) -> np.ndarray:
+        """
+        Returns number of records after each patient's earliest row in row_mask, -1 for patients without any
+
+        Args:
+            row_mask (np.ndarray): Boolean array over rows
+        """
+        first_pos = self.firstPosition(row_mask)
+        return np.where(first_pos >= 0, self.counts - first_pos - 1, -1)
+
+    def intervals(self, values: np.ndarray) -> np.ndarray:
+        """
+        Returns per-row difference of values from the patient's previous record, NaN for each patient's first record
+        With year of diagnosis this is the interval between consecutive primaries
+
+        Args:
+            values (np.ndarray): Numeric array over rows, e.g., df[COL_DIA_YEAR]
+        """
+        sorted_values = np.asarray(values, dtype=float)[self.order]
+        sorted_diff = np.empty(self.n_rows)
+        sorted_diff[1:] = np.diff(sorted_values)
+        sorted_diff[self.offsets[:-1]] = np.nan # First record of each patient has no previous record
+        diff = np.empty(self.n_rows)
+        diff[self.order] = sorted_diff
+        return diff
@@ -1,10 +1,15 @@
 #%% Imports
-from typing import Union
-import os, csv, sys
+from typing import Union, Iterator
+import os, re, csv, sys, json, hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
+from constants import CAT_COLS, INT_COLS, NUM_COLS, COL_AGE, COL_ORD_PRIM, COL_IS_FIRST, COL_AGE_ORD, FIRST_PRIM_REGEX, AGE_BINS
+
 # Probably should not have internal imports for global_functions to avoid circular imports 
 #%% Logging 
 import logging, os, sys
@@ -21,33 +26,450 @@ LOG.addHandler(ch)
 
 # Logging file output stream
 date_time = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-if os.path.exists("archive/logs/"):
+if os.environ.get("GBM_LOG_DIR"): # Lets batch runs keep logs out of the working directory
+    log_dir = os.path.join(os.environ["GBM_LOG_DIR"], "")
+elif os.path.exists("archive/logs/"):
     log_dir = "archive/logs/"
 else:
     log_dir = "" # Use root dir
-# fh = logging.FileHandler(F"{log_dir}{date_time}.log", "w")
-fh = logging.FileHandler(F"{log_dir}{date_time}.log", "w")
-fh.setLevel(logging.DEBUG) # Log info all the way down to DEBUG level  
-fh.setFormatter(formatter)
-LOG.addHandler(fh)
+
+def addLogFile(path: str = "", level: int = logging.DEBUG) -> logging.FileHandler:
+    """
+    Adds a file output stream to LOG and returns it, the file is only created once the first message is logged
+
+    Args:
+        path (str, optional): Path of log file. Defaults to a timestamped file in log_dir.
+        level (int, optional): Lowest level written to file. Defaults to logging.DEBUG.
+    """
+    path = path or F"{log_dir}{date_time}.log"
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    handler = logging.FileHandler(path, "w", delay=True) # Delay so importing internals doesn't create a file
+    handler.setLevel(level) # Log info all the way down to DEBUG level
+    handler.setFormatter(formatter)
+    LOG.addHandler(handler)
+    return handler
+
+fh = None
+LOG_TO_FILE = os.environ.get("GBM_LOG_FILE", "1") != "0" # Set GBM_LOG_FILE=0 to log to the console only, without log or trace files
+if LOG_TO_FILE:
+    fh = addLogFile()
+#%% Instrumentation
+import time, atexit, functools, contextlib, cProfile, pstats, io, multiprocessing
+try:
+    import resource # Unix only
+except ImportError:
+    resource = None
+
+TRACE: list[dict] = [] # One record per instrumented stage, written as JSON next to the log file at exit
+TRACE_PATH = F"{log_dir}{date_time}_trace.json"
+PROFILE_STAGES = set(filter(None, os.environ.get("GBM_PROFILE_STAGES", "").split(","))) # Stage names to run under cProfile
+
+def peakRssMib() -> Union[float, None]:
+    """
+    Returns peak resident set size of this process so far in MiB, None if it can't be measured on this platform
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == "darwin" else peak / 1024 # Bytes on macOS, KiB on Linux
+    try:
+        import psutil # Optional, only used where resource isn't available (Windows)
+        return psutil.Process().memory_info().peak_wset / 1024**2
+    except (ImportError, AttributeError):
+        return None
+
+def _nRows(obj) -> Union[int, None]:
+    # Row count of DFs/Series/arrays, None for anything else
+    if isinstance(obj, (DataFrame, pd.Series, np.ndarray)):
+        return len(obj)
+    return None
+
+@contextlib.contextmanager
+def stage(name: str, rows_in: int = None, profile: Union[bool, str] = False):
+    """
+    Context manager that logs wall time, CPU time, peak RSS growth and row counts of the enclosed block to LOG and TRACE
+    Set record["rows_out"] inside the block to log output rows
+    
+    name: Name of the stage in logs and trace
+    rows_in: Number of input rows
+    profile: True to run the block under cProfile and log its top functions, also enabled by listing name in GBM_PROFILE_STAGES
+    """
+    record = {"stage": name, "start": datetime.now().isoformat(timespec="seconds"), "rows_in": rows_in, "rows_out": None}
+    profiler = cProfile.Profile() if (profile or name in PROFILE_STAGES) else None
+    rss_start = peakRssMib()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+        rss_end = peakRssMib()
+        record.update({"wall_s": round(time.perf_counter() - wall_start, 4),
+                       "cpu_s": round(time.process_time() - cpu_start, 4),
+                       "peak_rss_delta_mib": round(rss_end - rss_start, 2) if rss_start is not None else None,
+                       "peak_rss_mib": round(rss_end, 2) if rss_end is not None else None,
+                       })
+        TRACE.append(record)
+        LOG.info(F"Stage {name}: {record['wall_s']}s wall, {record['cpu_s']}s CPU, +{record['peak_rss_delta_mib']} MiB peak RSS, "
+                 F"rows {record['rows_in']} -> {record['rows_out']}")
+        if profiler:
+            profile_path = F"{log_dir}{date_time}_{name}.prof"
+            profiler.dump_stats(profile_path) # Open with snakeviz or pstats for the full profile
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(20)
+            LOG.debug(F"Profile of {name} ({profile_path}):\n{summary.getvalue()}")
+
+def instrument(name: str = "", profile: Union[bool, str] = False):
+    """
+    Decorator version of stage(), rows_in is the length of the first DF/Series/array argument and rows_out the length of the result
+    profile="line" uses line_profiler on the decorated function if it is installed, otherwise falls back to cProfile
+    
+    name: Name of the stage, defaults to the function name
+    profile: False, True (cProfile) or "line"
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rows_in = next((_nRows(arg) for arg in args if _nRows(arg) is not None), None)
+            if profile == "line":
+                try:
+                    from line_profiler import LineProfiler
+                except ImportError:
+                    LOG.warning("line_profiler not installed, using cProfile instead")
+                else:
+                    line_profiler = LineProfiler(func)
+                    with stage(stage_name, rows_in=rows_in) as record:
+                        result = line_profiler.runcall(func, *args, **kwargs)
+                        record["rows_out"] = _nRows(result)
+                    summary = io.StringIO()
+                    line_profiler.print_stats(stream=summary)
+                    LOG.debug(F"Line profile of {stage_name}:\n{summary.getvalue()}")
+                    return result
+            with stage(stage_name, rows_in=rows_in, profile=bool(profile)) as record:
+                result = func(*args, **kwargs)
+                record["rows_out"] = _nRows(result)
+            return result
+        return wrapper
+    return decorator
+
+def writeTrace(path: str = ""):
+    """
+    Writes TRACE as JSON to path (TRACE_PATH if empty), called automatically at exit if any stage was recorded and LOG_TO_FILE
+    Worker processes (e.g., of stages.runStages) don't write, their stages are logged but not traced
+    """
+    if TRACE and multiprocessing.parent_process() is None:
+        with open(path or TRACE_PATH, "w") as file:
+            json.dump(TRACE, file, indent=2)
+
+if LOG_TO_FILE:
+    atexit.register(writeTrace)
+
 #%% Functions 
 
-def mergeDfSlices(prefix: str, dir: str = os.getcwd()):
+EXCEL_MAX_ROWS = 1_048_575 # Excel sheet limit minus header row
+EXPORT_FORMATS = {"parquet": ".parquet", "feather": ".feather", "csv.gz": ".csv.gz", "csv": ".csv", "xlsx": ".xlsx"}
+
+def writeFrame(df: DataFrame, path_stem: str, fmt: str = "parquet") -> str:
     """
-    Merges Excel and CSV of a certain root prefix in a given directory into one Excel file in the same directory
+    Writes df to path_stem plus the extension of fmt, returns path written
+    Excel is slow to write and capped at ~1M rows, so it should only be used for small frames meant to be opened by hand
+
+    Args:
+        df (DataFrame): DF to write
+        path_stem (str): Output path without extension
+        fmt (str, optional): One of EXPORT_FORMATS. Defaults to "parquet".
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(F"Unknown export format {fmt}, expected one of {list(EXPORT_FORMATS)}")
+    path = path_stem + EXPORT_FORMATS[fmt]
+    if fmt == "parquet":
+        df.to_parquet(path)
+    elif fmt == "feather":
+        df.reset_index().to_feather(path) # Feather only stores default indices
+    elif fmt in ("csv", "csv.gz"):
+        df.to_csv(path) # Compression inferred from extension
+    elif fmt == "xlsx":
+        if len(df) > EXCEL_MAX_ROWS:
+            raise ValueError(F"{len(df)} rows exceed the Excel limit of {EXCEL_MAX_ROWS}, use a binary format instead")
+        df.to_excel(path)
+    return path
+
+def _dtypeKind(dtype) -> str:
+    # Coarse dtype family used to decide whether slices can be concatenated without silently turning columns into objects
+    if pd.api.types.is_bool_dtype(dtype):
+        return "bool"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return "numeric" # int/float differences between slices are expected, e.g., from NaNs, and upcast on concat
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(dtype) or pd.api.types.is_object_dtype(dtype):
+        return "text"
+    return str(dtype)
+
+def _allNa(series: pd.Series) -> bool:
+    # Columns without any value are read as float64 NaN (or object) whatever they would hold, so they carry no dtype
+    return bool(series.isna().all())
+
+def checkSchema(reference: DataFrame, df: DataFrame, name: str = ""):
+    """
+    Raises ValueError if df doesn't have the same columns (in the same order) and dtype families as reference
+    Columns that are all NA in either DF match any dtype, e.g., a slice where nobody had a value in an otherwise text column
+    
+    Args:
+        reference (DataFrame): DF with the expected schema, e.g., the first slice or _schemaSample() of the slices so far
+        df (DataFrame): DF to check
+        name (str, optional): Name of df used in the error message, e.g., its file name. Defaults to "".
+    """
+    if list(df.columns) != list(reference.columns):
+        missing = [col for col in reference.columns if col not in df.columns]
+        extra = [col for col in df.columns if col not in reference.columns]
+        raise ValueError(F"Columns of {name} don't match: missing {missing}, extra {extra} (or different order)")
+    mismatched = {col: (str(reference[col].dtype), str(df[col].dtype)) for col in df.columns
+                  if not (_allNa(reference[col]) or _allNa(df[col])) and _dtypeKind(reference[col].dtype) != _dtypeKind(df[col].dtype)}
+    if mismatched:
+        raise ValueError(F"Column dtypes of {name} don't match (expected, found): {mismatched}")
+
+def _schemaSample(df: DataFrame, sample: DataFrame = None) -> DataFrame:
+    # One row with the first value of each column, so later slices can be checked without keeping earlier ones in memory
+    # Columns that were all NA in every slice so far stay NA, and take their value (and dtype) from the first slice that has one
+    columns = {col: (sample[col] if sample is not None and not _allNa(sample[col]) else df[col].dropna().iloc[:1]).reset_index(drop=True)
+               for col in df.columns}
+    return DataFrame(columns).reindex(range(1))
+
+def _arrowTable(df: DataFrame, schema, name: str):
+    # Table of df cast to schema, all-NA columns are passed as None so they cast to any type rather than only to float
+    import pyarrow as pa
+    df = df.assign(**{col: pd.Series([None] * len(df), index=df.index, dtype=object) for col in df.columns if _allNa(df[col])})
+    try:
+        return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as error:
+        raise ValueError(F"{name} can't be cast to the schema of the merged file: {error}")
+
+def _readSlices(paths: list[str], max_workers: int = None) -> Iterator[DataFrame]:
+    # Yields importData() of each path in order while reading up to max_workers slices ahead on a thread pool
+    # Bounded lookahead keeps at most max_workers + 1 slices in memory when the consumer is slower than the readers
+    max_workers = max_workers or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for path in paths:
+            futures.append(executor.submit(importData, path))
+            if len(futures) > max_workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def mergeDfSlices(prefix: str,
+                  dir: str = os.getcwd(),
+                  fmt: str = "parquet",
+                  max_workers: int = None,
+                  stream: bool = False,
+                  ) -> str:
+    """
+    Merges Excel and CSV of a certain root prefix in a given directory into one file in the same directory, returns its path
+    Slices are read concurrently, checked for matching columns and dtypes, and concatenated once in file name order
 
     Args:
         prefix (str): Prefix of filenames to be merged, will be used to search 
         dir (str, optional): Relative path to directory containing files to be merged Defaults to os.getcwd().
+        fmt (str, optional): Output format, one of EXPORT_FORMATS. Defaults to "parquet".
+        max_workers (int, optional): Number of slices read at once. Defaults to min(8, number of CPUs).
+        stream (bool, optional): Write each slice to the output as it is read instead of holding all slices in memory, 
+        Parquet only. Defaults to False.
     """
     root, dirs, files = list(os.walk(dir))[0] # os.walk yields generator that should only get one item, use index 0 to obtain it
-    df_merged = pd.DataFrame()
-    for file_name in files:
-        if file_name.startswith(prefix) and file_name.endswith((".xlsx", ".xls", ".csv")):
-            df = importData(os.path.join(dir, file_name)) # Has support for both XLS and CSV
-            df_merged = pd.concat([df_merged, df])
+    paths = [os.path.join(dir, file_name) for file_name in sorted(files)
+             if file_name.startswith(prefix) and file_name.endswith((".xlsx", ".xls", ".csv"))]
+    if not paths:
+        LOG.warning(F"No slices with prefix {prefix} found in {dir}")
+        return ""
+    path_stem = os.path.join(dir, f"{prefix}_merged")
+    
+    if stream:
+        if fmt != "parquet":
+            raise ValueError("Streaming merge only supports Parquet output")
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        out_path = path_stem + EXPORT_FORMATS[fmt]
+        writer = None
+        sample = None
+        pending = [] # Slices read before the schema is known, i.e., while some column has been all NA in every slice
+        complete = False
+        try:
+            for path, df in zip(paths, _readSlices(paths, max_workers)):
+                if sample is not None:
+                    checkSchema(sample, df, path)
+                sample = _schemaSample(df, sample)
+                if writer is None:
+                    pending.append((path, df))
+                    if sample.isna().any(axis=None) and len(pending) < len(paths):
+                        continue
+                    # Arrow type of each column from the first slice that has values in it
+                    fields = [next((pa.Table.from_pandas(slice_df[[col]], preserve_index=False).schema.field(col)
+                                    for _, slice_df in pending if not _allNa(slice_df[col])),
+                                   pa.field(col, pa.null())) for col in df.columns]
+                    writer = pq.ParquetWriter(out_path, pa.schema(fields))
+                    for pending_path, pending_df in pending:
+                        writer.write_table(_arrowTable(pending_df, writer.schema, pending_path))
+                    pending = []
+                else:
+                    writer.write_table(_arrowTable(df, writer.schema, path)) # Cast to schema of the first slices
+            complete = True
+        finally: # A failed merge closes the writer and removes the partial file rather than leaving a truncated one behind
+            if writer is not None:
+                writer.close()
+                if not complete:
+                    os.remove(out_path)
+        return out_path
+    
+    dfs = list(_readSlices(paths, max_workers))
+    sample = _schemaSample(dfs[0])
+    for path, df in zip(paths[1:], dfs[1:]):
+        checkSchema(sample, df, path)
+        sample = _schemaSample(df, sample)
+    df_merged = pd.concat(dfs, ignore_index=True) # Single concat, copying in a loop is quadratic in the number of slices
+    return writeFrame(df_merged, path_stem, fmt=fmt)
+
+TEXT_REGEX = r"[A-Za-z]" # Cells must contain at least one letter to count as non-empty text
+
+def regexMask(series: pd.Series, pattern: str, case: bool = True) -> np.ndarray:
+    """
+    Returns boolean array of series.str.contains(pattern) with NaN as False, evaluating the regex once per distinct value 
+    rather than once per row. Uses the codes of categorical series directly, other series are factorized first
+
+    Args:
+        series (pd.Series): Text column to match
+        pattern (str): Regex pattern
+        case (bool, optional): Case sensitive matching. Defaults to True.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, uniques = pd.factorize(series) # NaN gets code -1
+    matched = pd.Series(uniques).astype(str).str.contains(pattern, regex=True, case=case).to_numpy(dtype=bool)
+    matched = np.append(matched, False) # Code -1 (NaN) indexes this last entry
+    return matched[codes]
+
+def firstPrimaryMask(df: DataFrame) -> np.ndarray:
+    """
+    Returns boolean array of records that were a first primary, read from COL_IS_FIRST if df has it (see compactDtypes()),
+    otherwise matched from COL_ORD_PRIM with FIRST_PRIM_REGEX
+
+    Args:
+        df (DataFrame): Case listing
+    """
+    if COL_IS_FIRST in df.columns:
+        return df[COL_IS_FIRST].to_numpy(dtype=bool)
+    return regexMask(df[COL_ORD_PRIM], FIRST_PRIM_REGEX)
+
+def compactDtypes(df: DataFrame,
+                  max_cat_ratio: float = 0.5,
+                  derive: bool = True,
+                  ) -> tuple[DataFrame, DataFrame]:
+    """
+    Returns copy of df with compact dtypes and DF of memory per column before and after, the report is also logged
+    Integers are downcast to the smallest type holding their range (nullable integers stay nullable), text columns with
+    few distinct values become categoricals so each distinct string is stored once. Floats are kept as float64 since
+    survival sums would lose precision in float32
+
+    Args:
+        df (DataFrame): Case listing
+        max_cat_ratio (float, optional): Largest ratio of distinct values to rows of a text column converted to categorical. Defaults to 0.5.
+        derive (bool, optional): Add DERIVED_COLS (COL_IS_FIRST, COL_AGE_ORD) if their source columns are present. Defaults to True.
+    """
+    before = df.memory_usage(index=False, deep=True)
+    dtypes_before = df.dtypes.astype(str)
+    compact = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series.dtype):
+            pass
+        elif isinstance(series.dtype, pd.api.extensions.ExtensionDtype) and pd.api.types.is_integer_dtype(series.dtype):
+            if series.notna().any(): # Nullable integers, downcast keeping NA
+                low, high = series.min(), series.max()
+                for dtype in ["Int8", "Int16", "Int32"]:
+                    if np.iinfo(dtype.lower()).min <= low and high <= np.iinfo(dtype.lower()).max:
+                        series = series.astype(dtype)
+                        break
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            series = pd.to_numeric(series, downcast="integer")
+        elif ((series.dtype == object or pd.api.types.is_string_dtype(series.dtype))
+              and not isinstance(series.dtype, pd.CategoricalDtype)
+              and series.nunique() <= max_cat_ratio * len(series)):
+            series = series.astype("category")
+        compact[col] = series
+    df = DataFrame(compact, index=df.index)
+
+    if derive:
+        if COL_ORD_PRIM in df.columns:
+            df[COL_IS_FIRST] = regexMask(df[COL_ORD_PRIM], FIRST_PRIM_REGEX) # Regex runs once per distinct value, here only
+        if COL_AGE in df.columns: # Fixed positions in AGE_BINS, so ordinals mean the same bin whichever bins df contains
+            age = df[COL_AGE] if isinstance(df[COL_AGE].dtype, pd.CategoricalDtype) else df[COL_AGE].astype("category")
+            positions = [AGE_BINS.index(str(value)) if str(value) in AGE_BINS else -1 for value in age.cat.categories]
+            df[COL_AGE_ORD] = np.array(positions + [-1], dtype=np.int8)[age.cat.codes.to_numpy()] # Code -1 (NaN) indexes the last entry
+
+    after = df.memory_usage(index=False, deep=True)
+    report = DataFrame({"dtype_before": dtypes_before, "dtype_after": df.dtypes.astype(str),
+                        "mib_before": before / 1024**2, "mib_after": after / 1024**2}).round(3)
+    report["mib_saved"] = report["mib_before"].fillna(0) - report["mib_after"]
+    LOG.info(F"Compacted dtypes: {before.sum() / 1024**2:.1f} MiB -> {after.sum() / 1024**2:.1f} MiB\n{report.to_string()}")
+    return df, report
+
+class FilterPlan:
+    """
+    Screens of importData() compiled into a single boolean mask, so filtered rows are only materialised once
+    Duplicate screens are applied in order, each one only looking at rows kept by the previous ones, 
+    then row-wise screens (text and regex filter) are ANDed in
+    
+    screen_dupl: list of columns to check for duplicates between rows, keeps first occurrence of each value in every column in turn
+    screen_text: list of columns that must contain non-empty text
+    filt: REGEX string to filter cell, case insensitive
+    filt_col: String of column to apply filter to
+    """
+    def __init__(self,
+                 screen_dupl: list[str] = [],
+                 screen_text: list[str] = [],
+                 filt_col: str = "",
+                 filt: str = "",
+                 ):
+        self.screen_dupl = list(screen_dupl)
+        self.screen_text = list(screen_text)
+        self.filt_col = filt_col if filt else ""
+        self.filt = filt if filt_col else ""
 
-    df_merged.to_excel(os.path.join(dir, f"{prefix}_merged.xlsx"))
+    def __bool__(self) -> bool:
+        return bool(self.screen_dupl or self.screen_text or self.filt_col)
+
+    @property
+    def columns(self) -> list[str]:
+        # Columns the plan reads
+        return list(dict.fromkeys(self.screen_dupl + self.screen_text + ([self.filt_col] if self.filt_col else [])))
+
+    def mask(self, df: DataFrame, seen: dict[str, set] = None) -> np.ndarray:
+        """
+        Returns boolean array over rows of df that pass all screens
+
+        Args:
+            df (DataFrame): DF to screen
+            seen (dict[str, set], optional): Values per screen_dupl column kept from earlier chunks of the same file, 
+            updated in place with values kept from df. Defaults to None.
+        """
+        mask = np.ones(len(df), dtype=bool)
+        for col in self.screen_dupl: # Drop duplicates for every column mentioned, built-in behaviour is to look at combination of columns
+            kept = np.flatnonzero(mask)
+            values = df[col].iloc[kept]
+            dupl = values.duplicated().to_numpy().copy() # Copy since to_numpy() can return a read-only view
+            if seen is not None:
+                dupl |= values.isin(seen.setdefault(col, set())).to_numpy()
+                seen[col].update(values[~dupl].tolist())
+            mask[kept[dupl]] = False
+        for col in self.screen_text: # Only allow non-empty strings through
+            mask &= regexMask(df[col], TEXT_REGEX)
+        if self.filt_col: # Regex searches .lower() str of cell for case insensitivity
+            mask &= regexMask(df[self.filt_col], TEXT_REGEX) & regexMask(df[self.filt_col], self.filt, case=False)
+        return mask
 
 def importData(file_path: Union[str, bytes, os.PathLike],
                cols: list[str] = [],
@@ -56,10 +478,11 @@ def importData(file_path: Union[str, bytes, os.PathLike],
                filt_col: str = "",
                filt: str = "",
                skiprows: int = 0,
+               plan: FilterPlan = None,
                ) -> DataFrame:
     """
     Returns entire processed DF based on imported Excel data filterd using preliminary str filter
-    If 
+    Screens are compiled into a FilterPlan and evaluated as one mask, if cols is given only cols and screened columns are read
     
     file_path: Filepath to Excel file containing data
     cols: Labels of columns to import, will import all if empty 
@@ -68,12 +491,17 @@ def importData(file_path: Union[str, bytes, os.PathLike],
     filt: REGEX string to filter cell
     filt_col: String of column to apply filter to
     skiprows: number of rows to skip when processing data
+    plan: FilterPlan to use instead of screen_dupl, screen_text, filt_col and filt
     """
+    if plan is None:
+        plan = FilterPlan(screen_dupl, screen_text, filt_col, filt)
+    usecols = list(dict.fromkeys(cols + plan.columns)) if cols else None # Only read needed columns
+    
     # Import function 
     if (file_path.endswith(".xls") or file_path.endswith(".xlsx")):
-        df = pd.read_excel(file_path, skiprows = skiprows)
+        df = pd.read_excel(file_path, skiprows = skiprows, usecols = usecols)
     elif (file_path.endswith(".csv")):
-        df = pd.read_csv(file_path, skiprows = skiprows)
+        df = pd.read_csv(file_path, skiprows = skiprows, usecols = usecols)
     elif (file_path == ""):
         LOG.warning("Empty file path, returning empty DataFrame")
         return DataFrame() # Return empty dataframe to maintain type consistency
@@ -81,20 +509,181 @@ def importData(file_path: Union[str, bytes, os.PathLike],
         LOG.warning("Invalid filetype, returning empty DataFrame")
         return DataFrame() # Return empty dataframe to maintain type consistency
     
-    # Extra pre-processing functions
-    if screen_dupl:
-        for col in screen_dupl: # Drop duplicates for every column mentioned, built-in behaviour is to look at combination of columns: https://stackoverflow.com/questions/23667369/drop-all-duplicate-rows-across-multiple-columns-in-python-pandas
-            df = df.drop_duplicates(subset=[col])
-    if screen_text:
-        for col in screen_text: # Go through every screen_text col and check that it has a non-empty string
-            df = df.dropna(subset=[col]) 
-            df = df[df[col].str.contains(r"[A-Za-z]", regex=True) == True] # Only allow non-empty strings through
-    if filt_col and filt: # If both fields are not empty
-        df = df[df[filt_col].str.contains(r"[A-Za-z]", regex=True) == True] # Only allow non-empty strings through
-        df = df.loc[df[filt_col].str.contains(filt, regex=True, case=False) == True] # Filters abstracts based on a str using regex, regex searches probably searches .lower() str of cell for case insensitivity
-    if screen_dupl or screen_text or (filt_col and filt): # Only reset index if one of these previous operations has been done
-        df: DataFrame = df.reset_index(drop=True) # to re-index dataframe so it becomes iterable again, drop variable to avoid old index being added as a column
+    if plan: # Only the final subset is materialised, and the index only reset if a screen was applied
+        df: DataFrame = df[plan.mask(df)].reset_index(drop=True) # to re-index dataframe so it becomes iterable again, drop variable to avoid old index being added as a column
     if cols: # If cols is not empty, will filter df through cols, otherwise leave df unchanged
         df = df[cols] 
         
-    return df
\ No newline at end of file
+    return df
+
+def iterData(file_path: Union[str, bytes, os.PathLike],
+             chunksize: int = 1_000_000,
+             cols: list[str] = [],
+             screen_dupl: list[str] = [],
+             screen_text: list[str] = [],
+             filt_col: str = "",
+             filt: str = "",
+             skiprows: int = 0,
+             dtype: dict = {},
+             plan: FilterPlan = None,
+             ) -> Iterator[DataFrame]:
+    """
+    Streaming version of importData(), yields processed chunks of at most chunksize rows so peak memory is bounded by
+    chunk size rather than file size. Concatenating all chunks gives the same rows as importData() with the same arguments
+    Supports CSV (pandas chunked reader) and Parquet (pyarrow batch reader) files
+    
+    file_path: Filepath to CSV or Parquet file containing data
+    chunksize: Maximum number of rows read per chunk
+    cols: Labels of columns to keep, will keep all if empty. Only these and screened columns are read from the file
+    screen_dupl: Same as importData(), values seen in earlier chunks are tracked so duplicates across chunks are also dropped
+    screen_text: Same as importData()
+    filt: Same as importData()
+    filt_col: Same as importData()
+    skiprows: Number of rows to skip when processing data (CSV only)
+    dtype: Dtypes passed to the CSV reader, e.g., {col: "category"}
+    plan: Same as importData()
+    """
+    if plan is None:
+        plan = FilterPlan(screen_dupl, screen_text, filt_col, filt)
+    read_cols = list(dict.fromkeys(cols + plan.columns)) if cols else [] # Read only the columns that are kept or screened
+    
+    if file_path.endswith(".csv"):
+        reader = pd.read_csv(file_path, chunksize=chunksize, skiprows=skiprows, usecols=read_cols or None, dtype=dtype or None)
+    elif file_path.endswith(".parquet"):
+        import pyarrow.parquet as pq # Only needed for Parquet sources
+        batches = pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=read_cols or None)
+        reader = (batch.to_pandas() for batch in batches)
+    else:
+        LOG.warning("Invalid filetype for streaming, no chunks returned")
+        return
+    
+    seen: dict[str, set] = {} # Values already kept per screen_dupl column
+    for df in reader:
+        if plan:
+            df = df[plan.mask(df, seen=seen)]
+        if cols:
+            df = df[cols]
+        yield df
+
+#%% Typed columnar cache
+
+CACHE_DIR = "data/cache/"
+CACHE_VERSION = 3 # Part of cache file names, bump when the cached layout changes so older caches are rebuilt
+
+def hashFile(file_path: Union[str, bytes, os.PathLike], block_size: int = 1 << 20) -> str:
+    """
+    Returns hex digest of file contents, read in blocks so large CSVs don't need to fit in memory
+
+    Args:
+        file_path (Union[str, bytes, os.PathLike]): Path to file to hash
+        block_size (int, optional): Number of bytes read per block. Defaults to 1 MiB.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hashFileCached(file_path: str, cache_dir: str) -> str:
+    # Re-hashing a multi-GB CSV on every load is slow, so hashes are remembered against file size and mtime
+    # Any change to either triggers a re-hash
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+    
+    stat = os.stat(file_path)
+    key = os.path.abspath(file_path)
+    entry = manifest.get(key, {})
+    if entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        return entry["digest"]
+    
+    digest = hashFile(file_path)
+    manifest[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "digest": digest}
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    return digest
+
+def _settingsDigest(cat_cols: list[str], int_cols: list[str], num_cols: list[str]) -> str:
+    # Hash of the settings the cached dtypes and DERIVED_COLS are built from, so editing FIRST_PRIM_REGEX, AGE_BINS or the
+    # column lists in constants.py rebuilds the cache instead of loading stale is_first_primary/age_ordinal columns
+    settings = [FIRST_PRIM_REGEX, list(AGE_BINS), sorted(cat_cols), sorted(int_cols), sorted(num_cols)]
+    return hashlib.blake2b(json.dumps(settings).encode(), digest_size=4).hexdigest()
+
+def coerceTypes(df: DataFrame, int_cols: list[str] = INT_COLS, num_cols: list[str] = NUM_COLS) -> DataFrame:
+    """
+    Coerces the columns of df that are present to the dtypes of the typed cache in place and returns df, so data read another
+    way (e.g., streamed in chunks) compares the same as data loaded from the cache
+
+    Args:
+        df (DataFrame): Case listing or chunk of it
+        int_cols (list[str], optional): Columns to convert to nullable integers, non-numerics become NA. Defaults to INT_COLS.
+        num_cols (list[str], optional): Columns to convert to floats, non-numerics become NaN. Defaults to NUM_COLS.
+    """
+    for col in int_cols:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int32")
+    for col in num_cols:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce") # Coerce converts non-numerics into NaN
+    return df
+
+def buildCache(file_path: str,
+               cache_dir: str = CACHE_DIR,
+               cat_cols: list[str] = CAT_COLS,
+               int_cols: list[str] = INT_COLS,
+               num_cols: list[str] = NUM_COLS,
+               ) -> str:
+    """
+    Parses CSV once into a typed Parquet cache keyed on the hash of the CSV contents, returns path of the cache
+    Cache is rebuilt automatically when CSV contents or the typing settings (column lists, FIRST_PRIM_REGEX, AGE_BINS) change,
+    stale caches of the same CSV are removed
+
+    Args:
+        file_path (str): Path to source CSV
+        cache_dir (str, optional): Directory to store cache files. Defaults to CACHE_DIR.
+        cat_cols (list[str], optional): Columns to store as categoricals. Defaults to CAT_COLS.
+        int_cols (list[str], optional): Columns to store as nullable integers. Defaults to INT_COLS.
+        num_cols (list[str], optional): Columns to coerce to floats, non-numerics become NaN. Defaults to NUM_COLS.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    digest = hashFileCached(file_path, cache_dir)
+    settings = _settingsDigest(cat_cols, int_cols, num_cols)
+    cache_path = os.path.join(cache_dir, F"{stem}_{digest}_v{CACHE_VERSION}_{settings}.parquet")
+    if os.path.exists(cache_path):
+        return cache_path
+    
+    LOG.info(F"Building cache for {file_path}")
+    header = pd.read_csv(file_path, nrows=0).columns # Only dtype columns that are actually present
+    dtypes = {col: "category" for col in cat_cols if col in header}
+    df = coerceTypes(pd.read_csv(file_path, dtype=dtypes), int_cols=int_cols, num_cols=num_cols)
+    df, _ = compactDtypes(df) # Downcast, intern remaining text and add DERIVED_COLS once, loads get them for free
+    
+    # Remove caches built from previous versions of the same CSV, and the Arrow copies of them from stages.buildArrowCache()
+    # Only exact {stem}_<digest>_v<N>_<settings> names match, so caches of other CSVs whose names start with stem are kept
+    stale = re.compile(RF"{re.escape(stem)}_[0-9a-f]{{32}}(_v\d+)?(_[0-9a-f]{{8}})?\.(parquet|arrow)")
+    for file_name in os.listdir(cache_dir):
+        if stale.fullmatch(file_name):
+            os.remove(os.path.join(cache_dir, file_name))
+    df.to_parquet(cache_path, index=False)
+    LOG.info(F"Cached {len(df)} rows to {cache_path}")
+    return cache_path
+
+@instrument("load_cache")
+def loadCache(file_path: str,
+              cols: list[str] = [],
+              cache_dir: str = CACHE_DIR,
+              ) -> DataFrame:
+    """
+    Returns DF of CSV read from its typed Parquet cache, building the cache first if missing or out of date
+
+    Args:
+        file_path (str): Path to source CSV
+        cols (list[str], optional): Labels of columns to read, will read all if empty. Defaults to [].
+        cache_dir (str, optional): Directory to store cache files. Defaults to CACHE_DIR.
+    """
+    cache_path = buildCache(file_path, cache_dir=cache_dir)
+    return pd.read_parquet(cache_path, columns=cols or None) # Parquet is columnar, unread columns are never parsed
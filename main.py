@@ -1,34 +1,26 @@
 #%%
-import pickle
 from typing import Iterable
 from collections import Counter
 
 import pandas as pd
 from pandas import DataFrame, Series
-import matplotlib.pyplot as plt
 
-#%%
-with open("data/counters.dat", "rb") as file:
-    counters: list[Counter] = pickle.load(file)
-    site_counter, type_counter = counters
+from checkpoints import CheckpointStore
+from plotting import renderAssociationFigure
+from stages import stageCounters
+from constants import GBM_HIST_CODES, NO_RAD_VALUES, NO_CHEMO_VALUES
 
+ROOT_PATH = R"data/SEER RPD 17 Nov 2021.csv" # Same input and counter filters as processing.py
+COUNTER_PARAMS = {"hist_codes": GBM_HIST_CODES, "rad": NO_RAD_VALUES, "chemo": NO_CHEMO_VALUES}
 
 #%%
+# [all_site_cnt, all_type_cnt, gbm_site_cnt, gbm_type_cnt] written by processing.py, raises KeyError if it hasn't been run on this input
+counters: list[Counter] = CheckpointStore().load("counters", stageCounters, inputs=[ROOT_PATH], params=COUNTER_PARAMS)
+_, _, site_counter, type_counter = counters
 
-site_data = list(zip(*site_counter.most_common(15))) # list(zip(*var)) to transpose
-type_data = list(zip(*type_counter.most_common(15))) # list(zip(*var)) to transpose
-
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 7.5))
-ax1.bar(site_data[0], site_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax1.set_xticklabels(ax1.get_xticklabels(), rotation=90, ha="right")
-ax1.set_ylabel("Number of GBM cases")
-ax1.set_xlabel("Tumour site of associated malignancy")
 
-ax2.bar(type_data[0], type_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax2.set_xticklabels(ax2.get_xticklabels(), rotation=90, ha="right")
-ax2.set_ylabel("Number of GBM cases")
-ax2.set_xlabel("Tumour ICD-O-3 histology code of associated malignancy")
+#%%
 
-plt.savefig("figures/GBM_associations.png", bbox_inches="tight")
\ No newline at end of file
+site_data = pd.Series(dict(site_counter.most_common(15)))
+type_data = pd.Series(dict(type_counter.most_common(15)))
+renderAssociationFigure(site_data, type_data, "Number of GBM cases", "Number of GBM cases", "figures/GBM_associations.png")
@@ -0,0 +1,162 @@
+# Headless batch rendering of the association figures from association tables
+# Figures are drawn with the Agg canvas directly (no pyplot state), so variants can also render in parallel worker processes
+
+#%% Imports
+import os, json, hashlib
+from typing import Union
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from pandas import DataFrame, Series
+
+from internals import LOG, instrument
+from association import topK
+
+FIGURE_DIR = "figures/"
+SITE_XLABEL = "Tumour site of associated malignancy"
+TYPE_XLABEL = "Tumour ICD-O-3 histology code of associated malignancy"
+
+def makeFigureSpecs(target_name: str = "GBM") -> dict[str, dict]:
+    """
+    Returns file name (without extension) to association table column and y labels of the site and histology panels
+    of every figure variant, named and labelled after the target cancer
+
+    Args:
+        target_name (str, optional): Name of target cancer in file names and labels. Defaults to "GBM".
+    """
+    cum_site_ylabel = F"Incidence of tumours at site associated with {target_name} normalized by cumulative survival of associated tumour"
+    cum_type_ylabel = F"Incidence of tumour histology associated with {target_name} normalized by cumulative survival of associated tumour"
+    return {
+        F"{target_name}_assoc": {"col": "count",
+                                 "site_ylabel": F"Number of {target_name} cases", "type_ylabel": F"Number of {target_name} cases"},
+        F"{target_name}_assoc_norm": {"col": "pct_incidence",
+                                      "site_ylabel": F"Percentage of tumours at site associated with {target_name}",
+                                      "type_ylabel": F"Percentage of tumours with same histology code associated with {target_name}"},
+        F"{target_name}_assoc_norm_cum": {"col": "norm_cum", "site_ylabel": cum_site_ylabel, "type_ylabel": cum_type_ylabel},
+        F"{target_name}_assoc_norm_cum_first": {"col": "norm_cum_first", "site_ylabel": cum_site_ylabel, "type_ylabel": cum_type_ylabel},
+    }
+
+FIGURE_SPECS = makeFigureSpecs("GBM")
+
+#%% Functions
+
+def renderAssociationFigure(site_data: Series, type_data: Series, site_ylabel: str, type_ylabel: str, out_path: str) -> str:
+    """
+    Renders 1x2 bar figure of site and histology values to out_path, returns out_path
+    Tick labels are set explicitly, so no draw is needed before rotating them
+
+    Args:
+        site_data (Series): Bar heights indexed by site
+        type_data (Series): Bar heights indexed by histology
+        site_ylabel (str): Y label of the site panel
+        type_ylabel (str): Y label of the histology panel
+        out_path (str): Path of the image file
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(15, 7.5))
+    FigureCanvasAgg(fig) # Headless canvas, independent of the pyplot backend
+    ax1, ax2 = fig.subplots(1, 2)
+    for ax, data, ylabel, xlabel in [(ax1, site_data, site_ylabel, SITE_XLABEL), (ax2, type_data, type_ylabel, TYPE_XLABEL)]:
+        ax.bar(range(len(data)), data.to_numpy())
+        ax.set_xticks(range(len(data)))
+        ax.set_xticklabels(data.index.astype(str), rotation=90, ha="right")
+        ax.set_ylabel(ylabel)
+        ax.set_xlabel(xlabel)
+    fig.savefig(out_path, bbox_inches="tight")
+    return out_path
+
+def _figureHash(site_data: Series, type_data: Series, spec: dict) -> str:
+    # Hash of everything drawn in a figure, unchanged data means the existing image is still valid
+    digest = hashlib.blake2b(digest_size=16)
+    for data in (site_data, type_data):
+        digest.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    digest.update(json.dumps(spec, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def _hashPath(out_path: str) -> str:
+    # Hash of the last render is kept next to each image rather than in one shared file, so figures rendered by
+    # concurrent processes (e.g., the figure stages of stages.runStages) never overwrite each other's entries
+    return os.path.join(os.path.dirname(out_path), F".{os.path.basename(out_path)}.hash")
+
+def _figureJob(site_table: DataFrame, type_table: DataFrame, name: str, spec: dict, out_dir: str, k: int, force: bool) -> Union[tuple, None]:
+    # Returns (hash, renderAssociationFigure() args) of a figure, None if its image is up to date
+    site_data, type_data = topK(site_table, spec["col"], k), topK(type_table, spec["col"], k)
+    out_path = os.path.join(out_dir, F"{name}.png")
+    figure_hash = _figureHash(site_data, type_data, spec)
+    if not force and os.path.exists(out_path) and os.path.exists(_hashPath(out_path)):
+        with open(_hashPath(out_path), "r") as file:
+            if file.read() == figure_hash:
+                LOG.info(F"Figure unchanged, skipped: {out_path}")
+                return None
+    return figure_hash, (site_data, type_data, spec["site_ylabel"], spec["type_ylabel"], out_path)
+
+def _writeHash(out_path: str, figure_hash: str):
+    with open(_hashPath(out_path), "w") as file:
+        file.write(figure_hash)
+
+@instrument()
+def renderFigures(site_table: DataFrame,
+                  type_table: DataFrame,
+                  specs: dict[str, dict] = FIGURE_SPECS,
+                  out_dir: str = FIGURE_DIR,
+                  k: int = 15,
+                  max_workers: int = 1,
+                  force: bool = False,
+                  ) -> list[str]:
+    """
+    Renders every figure variant in specs from the association tables, returns paths rendered
+    Figures whose plotted data and labels haven't changed since their last render are skipped
+
+    Args:
+        site_table (DataFrame): Association table of sites from association.buildAssociationTable()
+        type_table (DataFrame): Association table of histologies
+        specs (dict[str, dict], optional): File name (without extension) to spec of each figure. Defaults to FIGURE_SPECS.
+        out_dir (str, optional): Directory of the images. Defaults to FIGURE_DIR.
+        k (int, optional): Number of bars per panel. Defaults to 15.
+        max_workers (int, optional): Number of worker processes, None for one per figure to render. Defaults to 1, i.e., in
+        this process, which is safe to call from scripts without a __main__ guard.
+        force (bool, optional): Render even if unchanged. Defaults to False.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = {name: _figureJob(site_table, type_table, name, spec, out_dir, k, force) for name, spec in specs.items()}
+    jobs = {name: job for name, job in jobs.items() if job is not None}
+    if not jobs:
+        return []
+
+    if max_workers == 1:
+        paths = [renderAssociationFigure(*args) for _, args in jobs.values()]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or len(jobs)) as executor:
+            futures = {name: executor.submit(renderAssociationFigure, *args) for name, (_, args) in jobs.items()}
+            paths = [future.result() for future in futures.values()]
+    for path, (figure_hash, _) in zip(paths, jobs.values()):
+        _writeHash(path, figure_hash)
+    return paths
+
+def renderSpec(tables: dict[str, DataFrame],
+               name: str,
+               specs: dict[str, dict] = FIGURE_SPECS,
+               out_dir: str = FIGURE_DIR,
+               k: int = 15,
+               force: bool = False,
+               ) -> str:
+    """
+    Renders a single figure of specs in the current process unless it is unchanged since its last render, returns its path
+
+    Args:
+        tables (dict[str, DataFrame]): Association tables under "site" and "type"
+        name (str): Key of specs
+        specs (dict[str, dict], optional): File name (without extension) to spec of each figure. Defaults to FIGURE_SPECS.
+        out_dir (str, optional): Directory of the image. Defaults to FIGURE_DIR.
+        k (int, optional): Number of bars per panel. Defaults to 15.
+        force (bool, optional): Render even if unchanged. Defaults to False.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    job = _figureJob(tables["site"], tables["type"], name, specs[name], out_dir, k, force)
+    if job is None:
+        return os.path.join(out_dir, F"{name}.png")
+    figure_hash, args = job
+    out_path = renderAssociationFigure(*args)
+    _writeHash(out_path, figure_hash)
+    return out_path
@@ -1,48 +1,55 @@
 # Full pipeline 
 
 #%%
-import pickle, os
+import os
 from typing import Iterable
-from collections import Counter
 
 
+import numpy as np
 import pandas as pd
 from pandas import DataFrame, Series
 import matplotlib.pyplot as plt
 
-from internals import LOG
+from internals import LOG, loadCache, stage, instrument, firstPrimaryMask
+from indexing import PatientIndex, PatientTimeline
+from strata import stratifiedIncidence, targetCohorts, addRatios
+from cohort import Cohorts, GBM, FIRST_PRIMARY, UNTREATED, agesFrom, site
+from bootstrap import bootstrapTable
+from regression import fitModels
+from plotting import renderFigures
+from stages import stageCounters, stageSurvival, stageFirstSurvival, stageAssociation
+from checkpoints import CheckpointStore
+from exporting import Exporter
+from streaming import streamCounters
+from constants import (COL_AGE, COL_SEX, COL_DIA_YEAR, COL_SITE, COL_SITE_LABELED, COL_HIST, COL_TYPE, COL_SURV,
+                       COL_RAD, COL_CHEMO, COL_ID, COL_SEQ, COL_ORD_PRIM, GBM_HIST_CODES,
+                       NO_RAD_VALUES, NO_CHEMO_VALUES, DERIVED_COLS)
 
 
 #%% Constants
 ROOT_PATH = R"C:\Users\steve\Downloads\ZLocal\SEER RPD 17 Nov 2021.csv"
 ROOT_PATH = R"data/SEER RPD 17 Nov 2021.csv"
 ROOT_NAME = os.path.splitext(ROOT_PATH)[0]
-COUNTERS_PATH = R"data/counters.dat"
-COL_AGE = "Age recode with <1 year olds"
-COL_SEX = "Sex"
-COL_DIA_YEAR = "Year of diagnosis"
-COL_SITE = "Site recode ICD-O-3/WHO 2008"
-COL_HIST = "Histologic Type ICD-O-3"
-COL_TYPE = "ICD-O-3 Hist/behav"
-COL_SURV = "Survival months"
-COL_RAD = "Radiation recode"
-COL_CHEMO = "Chemotherapy recode (yes, no/unk)"
-COL_MO_TX = "Months from diagnosis to treatment"
-COL_ID = "Patient ID"
-COL_SEQ = "Record number recode" # Sequentially numbers a person's tumors within each SEER submission. Order is based on date of diagnosis and then sequence #. 
-COL_FIRST_PRIM = "First malignant primary indicator" # First MALIGNANT cancer; does not necessarily mean first cancer as could have many prior non-malignant neoplasm
-COL_PRIMARY = "Primary by international rules" # Whether its primary or mets
-COL_ORD_PRIM = "Sequence number" # Order of the primary AT THE TIME OF DIAGNOSIS, should only have 1-2 primaries when first diagnosed (rarely should you be walking in with 3+ primaries without being diagnosed) FIXME UNSURE HOW IT CHANGES WITH EACH ENTRY, SHOULD DOUBLE CHECK FOR A SPECIFIC PATIENT WITH MULTIPLE ENTRIES
-GBM_HIST_CODES = [9440, 9441, 9442, 9445]
 
 EXPORT_CHECKPOINTS = 0
+EXPORT_FORMAT = "parquet" # Format of exported DFs, "xlsx" only for small frames meant to be opened by hand
+BACKEND = "pandas" # Runs the incidence, counter and survival stages of runStages(), see backends.BACKENDS
+COUNTER_PARAMS = {"hist_codes": GBM_HIST_CODES, "rad": NO_RAD_VALUES, "chemo": NO_CHEMO_VALUES} # Filters of the site/type counters
+
+store = CheckpointStore() # Intermediate results keyed on input file hash, parameters and code version
+exporter = Exporter(fmt=EXPORT_FORMAT) # Writes exports in the background, call exporter.wait() to block until written
+
+LOAD_COLS = [COL_ID, COL_AGE, COL_SEX, COL_DIA_YEAR, COL_SITE, COL_SITE_LABELED, COL_HIST, COL_TYPE, COL_SURV,
+             COL_RAD, COL_CHEMO, COL_SEQ, COL_ORD_PRIM] + DERIVED_COLS # Only columns used by the analysis are read from the cache
 
 #%% Load CSV
-df = pd.read_csv(ROOT_PATH)
-df[COL_SURV] = pd.to_numeric(df[COL_SURV], errors="coerce") # Coerce converts non-numerics into NaN
+df = loadCache(ROOT_PATH, cols=LOAD_COLS) # Typed Parquet cache, CSV is only parsed again when its contents change
 n_encatchment = 81885000 # SEER RPD 17 Nov 2021 should have ~81,885,000 total encatchment
 n_years = 20 # Also remember that SEER RPD 17 Nov 2021 is cumulative over 20 years 
-n_total = df[COL_ID].nunique()
+with stage("patient_index", rows_in=len(df)):
+    pt_index = PatientTimeline(df) # Built once, shared by patient-level and tumour sequence queries on the full df
+n_total = pt_index.n_patients
+cohorts = Cohorts(df, index=pt_index) # Masks of cohort specs, cached so overlapping cohorts reuse them
 
 if 0: # Visualize variable space of df
     for col in df.columns:
@@ -50,7 +57,7 @@ if 0: # Visualize variable space of df
         LOG.info(df[col].unique())
 #%% Get GBM records
 
-df_gbm = df.loc[df[COL_HIST].isin(GBM_HIST_CODES)] # df.isin() method used since "in" operator doesn't work in this context
+df_gbm = cohorts.frame(GBM)
 n_gbm = df_gbm[COL_ID].nunique()
 
 LOG.info(F'Number of patients: {n_gbm}') 
@@ -58,58 +65,57 @@ LOG.info(F'Fraction of encatchment with GBM: {n_gbm / n_encatchment}\nn = {n_gbm
 LOG.info(F'GBM rate per 100 000 per year: {n_gbm / (n_encatchment / 100000) / n_years}') # Should be roughly 3.19
 
 if EXPORT_CHECKPOINTS:
-    df_gbm.to_excel(F"{ROOT_NAME}_gbm.xlsx")
+    exporter.export(df_gbm, F"{ROOT_NAME}_gbm")
 
 
 #%%
 
+@instrument()
 def reportCancerIncidence(df: DataFrame,
            hist_codes = GBM_HIST_CODES,
            prefix = "gbm",
            incidence_20y_first = 0.000556793,
            export_dfs = False,
+           index: PatientIndex = None,
            ):
     # Get primary and secondary rates for a target cancer in a DataFrame
     # Target cancer by histology codes
     # frac_gen is prevalence of target cancer as first cancer (all occurences minus secondary ocurrences)
     # frac_gen calculated by (n_gbm - n_gbm_sec) / n_encatchment
+    # index is a PatientIndex built from df, built here if not given (e.g., for subsets of df)
+    if index is None:
+        index = PatientIndex(df)
     
-    df_target_cancer = df.loc[df[COL_HIST].isin(hist_codes)] # df.isin() method used since "in" operator doesn't work in this context
+    is_target = df[COL_HIST].isin(hist_codes).to_numpy() # df.isin() method used since "in" operator doesn't work in this context
+    is_first_prim = firstPrimaryMask(df) # Precomputed COL_IS_FIRST of the cache, regex only for frames without it
     
     # Find first primaries of target cancer and their patients' related entries
-    df_first = df_target_cancer[df_target_cancer[COL_ORD_PRIM].str.contains('One primary only|1st of 2 or more primaries')]
-    n_first = df_first[COL_ID].nunique() 
+    mask_first = is_target & is_first_prim
+    df_first = df[mask_first]
+    n_first = index.nunique(mask_first)
     if export_dfs:
-        df_first.to_excel(F"{ROOT_NAME}_{prefix}_first.xlsx")
+        for name, df_cohort in targetCohorts(df, hist_codes, index=index).items(): # first, first_rel, second, sec_rel
+            exporter.export(df_cohort, F"{ROOT_NAME}_{prefix}_{name}")
     
-    df_gbm_first_rel = df[df[COL_ID].isin(df_first[COL_ID])]
-    if export_dfs:
-        df_gbm_first_rel.to_excel(F"{ROOT_NAME}_{prefix}_first_rel.xlsx")
+    ids_entr_rel_to_first = index.expand(mask_first) # All entries of patients with a first primary of the target cancer
     
     # Debug
     if not n_first == len(df_first): # Each entry in first entry should be unique
         LOG.warning(F"Not all first tumour entries are unique\nLength: {len(df_first)} | Unique: {n_first}")
 
-    if 0: 
-        for pt_id in df_first[df_first[COL_SEQ] != 1][COL_ID]: # Output number of entries for patients where their first GBM primary was not the first SEER entry, FIXME Not sure why there should be any of these in the first place
-            LOG.info(len(df[df[COL_ID] == pt_id]))
+    # Number of entries of patients where their first GBM primary was not the first SEER entry, FIXME Not sure why there should be any of these in the first place
+    n_entries = index.counts[index.patientMask(mask_first & (df[COL_SEQ] != 1).to_numpy())]
+    LOG.info(F"Patients with first primary of target cancer after their first SEER entry: {len(n_entries)} | "
+             F"Entries per patient: {np.bincount(n_entries).tolist()}")
     
-    # Define entries to be removed to get primaries of target cancer that were not the first primaries 
-    ids_entr_rel_to_first = df[COL_ID].isin(df_first[COL_ID])
-    df_not_first = df.drop(df[ids_entr_rel_to_first].index)
-    LOG.info(F"Entries to remove: {ids_entr_rel_to_first.value_counts()[True]}")
-    LOG.info(F"Number of entries removed: {len(df) - len(df_not_first)}")
-    n_not_first = df_not_first[COL_ID].nunique()
+    # Entries not related to first primaries of target cancer, used to get primaries of target cancer that were not the first primaries 
+    mask_not_first = ~ids_entr_rel_to_first
+    LOG.info(F"Entries to remove: {np.count_nonzero(ids_entr_rel_to_first)}")
+    n_not_first = index.nunique(mask_not_first)
 
     # Find second+ primaries of target cancer and their patients' related entries
-    df_second = df_not_first.loc[df_not_first[COL_HIST].isin(hist_codes)]
-    n_gbm_sec = df_second[COL_ID].nunique()
-    if export_dfs:
-        df_second.to_excel(F"{ROOT_NAME}_{prefix}_second.xlsx")
-    
-    df_gbm_sec_rel = df[df[COL_ID].isin(df_second[COL_ID])]
-    if export_dfs:
-        df_gbm_sec_rel.to_excel(F"{ROOT_NAME}_{prefix}_sec_rel.xlsx")
+    mask_second = mask_not_first & is_target
+    n_gbm_sec = index.nunique(mask_second)
 
     # Calculate rates
     if not incidence_20y_first: # If general rate of GBM not given, then define it here
@@ -126,20 +132,17 @@ def reportCancerIncidence(df: DataFrame,
     
     return ratio
 #%%
-reportCancerIncidence(df, incidence_20y_first=None, export_dfs=True)
+reportCancerIncidence(df, incidence_20y_first=None, export_dfs=True, index=pt_index)
+gbm_cohorts = store.checkpoint("gbm_cohorts", targetCohorts, df, inputs=[ROOT_PATH],
+                               params={"hist_codes": GBM_HIST_CODES, "cols": LOAD_COLS}, index=pt_index)
 
 #%% Age
 
-cancer_sites = list(df[COL_AGE].unique())
-cancer_sites.sort()
-site_ratios = []
-for col in cancer_sites:
-    df_temp = df[df[COL_AGE] == col]
-    LOG.info(F"Age: {col} ================================")
-    site_ratios.append(reportCancerIncidence(df_temp)) # Add ratio 
+age_table = stratifiedIncidence(df, [COL_AGE]) # All age strata in one pass
+LOG.info(F"Age strata:\n{age_table.to_string()}")
 
 fig, ax = plt.subplots()
-ax.bar(cancer_sites, site_ratios)
+ax.bar(age_table[COL_AGE].astype(str), age_table["ratio"])
 ax.set_ylabel("Ratio of non-first GBM occurence rate")
 fig.autofmt_xdate(rotation=45)
     
@@ -147,153 +150,97 @@ fig.autofmt_xdate(rotation=45)
 
 #%% 
 
-for col in df["Sex"].unique():
-    df_temp = df[df["Sex"] == col]
-    LOG.info(F"Sex: {col} ================================")
-    reportCancerIncidence(df_temp)
+sex_table = stratifiedIncidence(df, [COL_SEX])
+LOG.info(F"Sex strata:\n{sex_table.to_string()}")
+
+#%% Bootstrap CIs and p-values of the ratio per stratum
+# Resamples patients within each stratum, p_perm compares each stratum's non-first rate with the other strata
+for name, table in [("Age", age_table), ("Sex", sex_table)]:
+    table = bootstrapTable(table, n_resamples=10_000)
+    LOG.info(F"{name} strata with bootstrap CIs:\n{table.to_string()}")
 
 
 #%%
-df_temp = df[df["Age recode with <1 year olds"].isin(['75-79 years', '80-84 years', '85+ years'])]
-reportCancerIncidence(df_temp)
-#%%
-df_temp = df[(df["Sex"] == "Male") & (df["Age recode with <1 year olds"].isin(['75-79 years', '80-84 years', '85+ years']))]
-reportCancerIncidence(df_temp)
+age_75_plus = pd.Series(cohorts.mask(agesFrom("75-79 years")), index=df.index, name="75+") # Compared on COL_AGE_ORD
+older_table = stratifiedIncidence(df, [COL_SEX, age_75_plus])
+LOG.info(F"Sex x 75+ strata:\n{older_table.to_string()}")
+older_counts = older_table.groupby("75+")[["n_patients", "n_target", "n_first", "n_not_first", "n_second"]].sum() # Patients never span sexes so counts add up across sex strata
+older_counts = addRatios(older_counts) # Same reference incidence as older_table
+LOG.info(F"75+ overall: >>> Ratio: {older_counts.loc[True, 'ratio']} <<<\n{older_counts.to_string()}")
 #%%
-df_temp = df[(df["Sex"] == "Male") & (df["Age recode with <1 year olds"].isin(['75-79 years']))]
-reportCancerIncidence(df_temp)
+age_sex_table = stratifiedIncidence(df, [COL_SEX, COL_AGE]) # Includes males aged 75-79
+LOG.info(F"Sex x age strata:\n{age_sex_table.to_string()}")
 #%%
+age_sex_year_table = stratifiedIncidence(df, [COL_SEX, COL_AGE, COL_DIA_YEAR])
 
 
 
-#%%
-def tempFx2(df: DataFrame, frac_gen = 0.000556793063442633):
-    
-    'C61.9-Prostate gland'
-    
-    df_gbm = df.loc[df[COL_HIST].isin(GBM_HIST_CODES)] # df.isin() method used since "in" operator doesn't work in this context
-
-    # df_gbm_first = df_gbm[df_gbm[COL_ORD_PRIM].str.contains('One primary only|1st of 2 or more primaries')]
-    # n_gbm_first = df_gbm_first[COL_ID].nunique() 
-    # assert n_gbm_first == len(df_gbm_first) # Each entry should be unique
+#%% Prostate-first patients
+# Ratio of GBM within the records of patients whose first primary was prostate (ratio_any), per sex and age stratum
 
-    # df_rem = df[COL_ID].isin(df_gbm_first[COL_ID])
-    
-    # n_rem_entries = df_rem.value_counts()[True] # Number of entries to remove
-    # LOG.info(F"Entries to remove: {n_rem_entries} | Excess: {n_rem_entries - len(df_gbm_first)}")
-    # df_no_gbm_first = df.drop(df[df_rem].index)
-    # LOG.info(F"Number of entries removed: {len(df) - len(df_no_gbm_first)}")
-    # n_no_gbm_first = df_no_gbm_first[COL_ID].nunique() 
-    n_cases = df[COL_ID].nunique()
+PROSTATE_FIRST = site(['C61.9-Prostate gland']) & FIRST_PRIMARY
+df_prost = cohorts.frame(PROSTATE_FIRST.patients())
 
-    n_gbm_sec = df_gbm[COL_ID].nunique()
-
-    frac_sec = n_gbm_sec / n_cases
-
-    LOG.info(F"Fraction of secondary GBM: {frac_sec}\nn = {n_gbm_sec}, N = {n_cases}")
-    LOG.info(F">>> Ratio: {frac_sec/frac_gen} <<<")
-
-
-df_pros_entries = df[df["Primary Site - labeled"] == 'C61.9-Prostate gland']
-df_pros_entries2 = df_pros_entries[df_pros_entries[COL_ORD_PRIM].str.contains('One primary only|1st of 2 or more primaries')]
-
-df_prost = df[df[COL_ID].isin(df_pros_entries2[COL_ID])]
-
-df_temp = df_prost[(df_prost["Sex"] == "Male") & (df_prost["Age recode with <1 year olds"].isin(['75-79 years']))]
-tempFx2(df_temp)
+prost_table = stratifiedIncidence(df_prost, [COL_SEX, COL_AGE], incidence_20y_first=0.000556793063442633)
+LOG.info(F"Prostate-first strata:\n{prost_table.to_string()}")
 
 # ====================== Original pipeline 
 #%% Count sites and types for entries 
-df_gbm = df.loc[df[COL_HIST].isin(GBM_HIST_CODES)] # df.isin() method used since "in" operator doesn't work in this context
-df_gbm = df_gbm.loc[df_gbm["Radiation recode"].isin(['None/Unknown', 'Refused (1988+)'])]
-df_gbm = df_gbm.loc[df_gbm["Chemotherapy recode (yes, no/unk)"].isin(['No/Unknown'])]
+GBM_UNTREATED = GBM & UNTREATED # GBM entries without radiation or chemotherapy
+df_gbm = cohorts.frame(GBM_UNTREATED)
 
-gbm_ids = set(df_gbm["Patient ID"].values)
-df_gbm_pt = df.loc[df["Patient ID"].isin(gbm_ids)]
-print(df_gbm_pt["Patient ID"].nunique())
+print(cohorts.nunique(GBM_UNTREATED))
 
 # Isolate non-GBM entries in GBM patients
-df_gbm_rel = df_gbm_pt.loc[~df_gbm_pt[COL_HIST].isin([9440, 9441, 9442, 9445])] # "~" unary operator to invert
-df_gbm_rel.to_csv(F"{ROOT_PATH}_gbm_rel.csv")
+df_gbm_rel = cohorts.frame(GBM_UNTREATED.patients() & ~GBM) # "~" unary operator to invert
+exporter.export(df_gbm_rel, F"{ROOT_PATH}_gbm_rel", fmt="csv")
 
 
-all_site_cnt: Counter[str] = Counter(df[COL_SITE])
-all_type_cnt: Counter[str] = Counter(df[COL_TYPE])
-gbm_site_cnt: Counter[str] = Counter(df_gbm_rel[COL_SITE])
-gbm_type_cnt: Counter[str] = Counter(df_gbm_rel[COL_TYPE])
+counters = store.checkpoint("counters", stageCounters, df, inputs=[ROOT_PATH], params=COUNTER_PARAMS) # Skipped if inputs unchanged
+all_site_cnt, all_type_cnt, gbm_site_cnt, gbm_type_cnt = counters
 
-with open(COUNTERS_PATH, "wb+") as file:
-    pickle.dump([all_site_cnt,
-                 all_type_cnt,
-                 gbm_site_cnt,
-                 gbm_type_cnt,
-                 ], file) # Package counters into single object
+# Counts and all normalizations aligned per site/histology, used by the figures below
+# stageAssociation derives df_gbm_rel from df itself, so the checkpoint key covers the cohort filter through the code version
+association = store.checkpoint("association", stageAssociation, df, inputs=[ROOT_PATH], params=COUNTER_PARAMS)
+site_table, type_table = association["site"], association["type"]
 
-#%% Load data checkpoint
+#%% Count sites and types by streaming the CSV in chunks (low-memory alternative to the cell above, gives the same counters)
 
-with open(COUNTERS_PATH, "rb") as file:
-    counters: list[Counter] = pickle.load(file)
-    [all_site_cnt,
-     all_type_cnt,
-     gbm_site_cnt,
-     gbm_type_cnt,
-     ] = counters # Unpack counters
+if 0:
+    counters = store.checkpoint("counters", streamCounters, ROOT_PATH, inputs=[ROOT_PATH], params=COUNTER_PARAMS, chunksize=1_000_000)
 
+#%% Run independent stages in parallel (alternative to running the cells below one by one)
 
-#%% Visualize raw counts of GBM-related cancers
+if 0:
+    from stages import runStages, PIPELINE_STAGES # Stages are independent except figures, which wait on the association tables
+    stage_results = runStages(PIPELINE_STAGES, ROOT_PATH, backend=BACKEND)
+    all_site_cnt, all_type_cnt, gbm_site_cnt, gbm_type_cnt = stage_results["counters"]
+    site_groups, type_groups = stage_results["survival"]["site_groups"], stage_results["survival"]["type_groups"]
+    f_site_groups, f_type_groups = stage_results["first_survival"]["f_site_groups"], stage_results["first_survival"]["f_type_groups"]
+    site_table, type_table = stage_results["association"]["site"], stage_results["association"]["type"]
 
-site_data = list(zip(*gbm_site_cnt.most_common(15))) # list(zip(*var)) to transpose
-type_data = list(zip(*gbm_type_cnt.most_common(15))) # list(zip(*var)) to transpose
+#%% Incremental update when a new SEER release or correction delta is appended
 
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 7.5))
-ax1.bar(site_data[0], site_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax1.set_xticklabels(ax1.get_xticklabels(), rotation=90, ha="right")
-ax1.set_ylabel("Number of GBM cases")
-ax1.set_xlabel("Tumour site of associated malignancy")
+if 0:
+    from incremental import IncrementalState
+    DELTA_PATH = R"data/SEER RPD delta.csv" # New or corrected records only
+    inc_state = IncrementalState(hist_codes=GBM_HIST_CODES, rad_values=NO_RAD_VALUES, chemo_values=NO_CHEMO_VALUES)
+    if not inc_state.n_records: # First run seeds the state from the full listing
+        inc_state.update(df)
+    inc_state.update(loadCache(DELTA_PATH, cols=LOAD_COLS))
+    inc_state.save()
+    site_table, type_table = inc_state.associationTable("site"), inc_state.associationTable("type")
+    LOG.info(F"Incidence after update: {inc_state.incidence()}")
 
-ax2.bar(type_data[0], type_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax2.set_xticklabels(ax2.get_xticklabels(), rotation=90, ha="right")
-ax2.set_ylabel("Number of GBM cases")
-ax2.set_xlabel("Tumour ICD-O-3 histology code of associated malignancy")
-
-plt.savefig("figures/GBM_assoc.png", bbox_inches="tight")
-
-#%% Visualize incidence-normalized GBM-related cancers
-norm_sites = Counter()
-for site in gbm_site_cnt:
-    norm_count = gbm_site_cnt[site]/all_site_cnt[site]*100 # Calculate % of gbm-related incidences to overall incidence
-    norm_sites[site] = norm_count
-
-
-norm_types = Counter()
-for ctype in gbm_type_cnt:
-    norm_count = gbm_type_cnt[ctype]/all_type_cnt[ctype]*100 # Calculate % of gbm-related incidences to overall incidence
-    norm_types[ctype] = norm_count
-    
-    
-site_data = list(zip(*norm_sites.most_common(15))) # list(zip(*var)) to transpose
-type_data = list(zip(*norm_types.most_common(15))) # list(zip(*var)) to transpose
+#%% Visualize GBM-related cancers
+# Raw counts, incidence-normalized and cumulative survival-normalized (all and first tumours) variants, rendered in one headless batch
+# Unchanged figures are skipped, pass force=True to re-render
 
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 7.5))
-ax1.bar(site_data[0], site_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax1.set_xticklabels(ax1.get_xticklabels(), rotation=90, ha="right")
-ax1.set_ylabel("Percentage of tumours at site associated with GBM")
-ax1.set_xlabel("Tumour site of associated malignancy")
-
-ax2.bar(type_data[0], type_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax2.set_xticklabels(ax2.get_xticklabels(), rotation=90, ha="right")
-ax2.set_ylabel("Percentage of tumours with same histology code associated with GBM")
-ax2.set_xlabel("Tumour ICD-O-3 histology code of associated malignancy")
-
-plt.savefig("figures/GBM_assoc_norm.png", bbox_inches="tight")
+renderFigures(site_table, type_table)
 
 #%% First cases
 df_first = df.loc[df["Record number recode"] == 1] # 6,525,399 first cases 
-df_missed = df_first.loc[df_first["Sequence number"].str.match(R"(One)|(^1st)")] # To match "One primary only" and "1st of 2"
+df_missed = df_first.loc[firstPrimaryMask(df_first)] # "One primary only" and "1st of 2", from COL_IS_FIRST
 print(F"{len(df_first)} first cases, {len(df_missed)} was the first known primary")
 print(F"{100-100*len(df_missed)/len(df_first)}% Missing prior cases")
 # ~11.3% of first cases was missing a prior cancer in SEER dataset
@@ -303,102 +250,50 @@ print(df_missed["Sequence number"].unique())
 
 print(F'{df[COL_SURV].isnull().sum()/len(df)*100}% of entries missing survival data')
 
-site_groups = df.groupby([COL_SITE])[COL_SURV].sum().sort_values(ascending=False)
-type_groups = df.groupby([COL_TYPE])[COL_SURV].sum().sort_values(ascending=False)
+survival = store.checkpoint("survival", stageSurvival, df, inputs=[ROOT_PATH])
+site_groups, type_groups = survival["site_groups"], survival["type_groups"]
 # Note that each entry has its own survival calculated from diagnosis date to death or current cutoff, independent of co-occurring cancers
 # Hence longest survival is always the first entry 
 print(site_groups)
 print(type_groups)
 
-f_site_groups = df_first.groupby([COL_SITE])[COL_SURV].sum().sort_values(ascending=False)
-f_type_groups = df_first.groupby([COL_TYPE])[COL_SURV].sum().sort_values(ascending=False)
+first_survival = store.checkpoint("first_survival", stageFirstSurvival, df, inputs=[ROOT_PATH])
+f_site_groups, f_type_groups = first_survival["f_site_groups"], first_survival["f_type_groups"]
 # Get survival of first tumours only 
 
-#%% Normalize by cumulative risk 
-
-norm_sites = Counter()
-for site in gbm_site_cnt:
-    norm_count = gbm_site_cnt[site]/site_groups[site] # Divides by total months of survival across entire cohort
-    norm_sites[site] = norm_count
-
-
-norm_types = Counter()
-for ctype in gbm_type_cnt:
-    norm_count = gbm_type_cnt[ctype]/type_groups[ctype]*100 # Divides by total months of survival across entire cohort
-    norm_types[ctype] = norm_count
-    
-    
-site_data = list(zip(*norm_sites.most_common(15))) # list(zip(*var)) to transpose
-type_data = list(zip(*norm_types.most_common(15))) # list(zip(*var)) to transpose
-
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 7.5))
-ax1.bar(site_data[0], site_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax1.set_xticklabels(ax1.get_xticklabels(), rotation=90, ha="right")
-ax1.set_ylabel("Incidence of tumours at site associated with GBM normalized by cumulative survival of associated tumour")
-ax1.set_xlabel("Tumour site of associated malignancy")
-
-ax2.bar(type_data[0], type_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax2.set_xticklabels(ax2.get_xticklabels(), rotation=90, ha="right")
-ax2.set_ylabel("Incidence of tumour histology associated with GBM normalized by cumulative survival of associated tumour")
-ax2.set_xlabel("Tumour ICD-O-3 histology code of associated malignancy")
-
-plt.savefig("figures/GBM_assoc_norm_cum.png", bbox_inches="tight")
-
-#%% Normalize by cumulative risk only based on initial cancer 
-
-norm_sites = Counter()
-for site in gbm_site_cnt:
-    norm_count = gbm_site_cnt[site]/f_site_groups[site] # Divides by total months of survival across entire cohort
-    norm_sites[site] = norm_count
-
-
-norm_types = Counter()
-for ctype in gbm_type_cnt:
-    norm_count = gbm_type_cnt[ctype]/f_type_groups[ctype]*100 # Divides by total months of survival across entire cohort
-    norm_types[ctype] = norm_count
-    
-    
-site_data = list(zip(*norm_sites.most_common(15))) # list(zip(*var)) to transpose
-type_data = list(zip(*norm_types.most_common(15))) # list(zip(*var)) to transpose
-
-fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 7.5))
-ax1.bar(site_data[0], site_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax1.set_xticklabels(ax1.get_xticklabels(), rotation=90, ha="right")
-ax1.set_ylabel("Incidence of tumours at site associated with GBM normalized by cumulative survival of associated tumour")
-ax1.set_xlabel("Tumour site of associated malignancy")
-
-ax2.bar(type_data[0], type_data[1])
-plt.draw() # Calculate labels, otherwise .get_xticklabels() doesn't return anything
-ax2.set_xticklabels(ax2.get_xticklabels(), rotation=90, ha="right")
-ax2.set_ylabel("Incidence of tumour histology associated with GBM normalized by cumulative survival of associated tumour")
-ax2.set_xlabel("Tumour ICD-O-3 histology code of associated malignancy")
-
-plt.savefig("figures/GBM_assoc_norm_cum_first.png", bbox_inches="tight")
-
 #%% Percentage of GBM cases that had subsequent cancer 
 
 print(df_gbm.groupby(["Sequence number"])["Patient ID"].count())
 
-# Group by patient ID, count cases
-# For IDs with more than one entry, get max "Record number recode"
-# Check if they had GBM, compare GBM "Record number recode" with max
-
-# Can probably compare rates using chi-squared https://www.medcalc.org/calc/rate_comparison.php
+is_gbm = cohorts.mask(GBM)
+n_after_gbm = pt_index.countAfter(is_gbm) # Records after each patient's first GBM record, -1 if no GBM
+has_gbm = n_after_gbm >= 0
+LOG.info(F"GBM patients with a subsequent cancer: {np.count_nonzero(n_after_gbm > 0)} / {np.count_nonzero(has_gbm)} "
+         F"({np.count_nonzero(n_after_gbm > 0) / np.count_nonzero(has_gbm):.2%})")
+mask_after_gbm = pt_index.after(is_gbm) # Tumours diagnosed after GBM
+df_after_gbm = df[mask_after_gbm]
+years_between = pt_index.intervals(df[COL_DIA_YEAR].to_numpy())[mask_after_gbm] # Years since the previous primary
+LOG.info(F"Sites after GBM:\n{df_after_gbm[COL_SITE].value_counts().head(15).to_string()}\n"
+         F"Median years from previous primary: {np.nanmedian(years_between) if len(years_between) else np.nan}")
+
+# Rates are compared between strata by permutation in bootstrap.bootstrapTable() (p_perm)
 # %%
-df_firsts = df[df[COL_ORD_PRIM].str.contains('One primary only|1st of 2 or more primaries')]
+df_firsts = cohorts.frame(FIRST_PRIMARY).copy()
 LOG.info(F"Number of extra entries: {df_firsts[COL_ID].nunique() - len(df_firsts)}")
 
 #%%
-df_gbm_sec = pd.read_excel(R"data\SEER RPD 17 Nov 2021_gbm_second.xlsx")
+df_gbm_sec = gbm_cohorts["second"] # Same rows as the exported _gbm_second file
 LOG.info(F"Number of non-first GBM cases: {df_gbm_sec[COL_ID].nunique()} | Ref: 8238") 
 #%%
 
 df_firsts["Non-first GBM"] = df_firsts[COL_ID].isin(df_gbm_sec[COL_ID])
 LOG.info(F"Number non-first GBMs that had new neoplasm diagnosed 2000 or later: {df_firsts['Non-first GBM'].sum()}")
-df_firsts.to_csv(R"data\SEER RPD 17 Nov 2021_firsts.csv")
+exporter.export(df_firsts, R"data\SEER RPD 17 Nov 2021_firsts", fmt="csv") # Input of regression.R
+
+#%% Logistic models of non-first GBM (lm_base, lm_site, lm_type of regression.R), fit in memory instead of in R
+
+if 0:
+    models = fitModels(df_firsts)
 # Core
 # 	Age
 # 	Site
@@ -406,4 +301,7 @@ df_firsts.to_csv(R"data\SEER RPD 17 Nov 2021_firsts.csv")
 # Auxilliary 
 # 	Diagnosis year 
 # 	Treatment 
-# 	Sex
\ No newline at end of file
+# 	Sex
+
+#%% Wait for background exports
+exporter.close() # Re-raises write errors and keeps the interpreter from exiting mid-write
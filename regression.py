@@ -0,0 +1,166 @@
+# Logistic regression of non-first GBM on the first-primary cohort, native replacement for the glm models of regression.R
+# Design matrices are built as sparse one-hot matrices straight from categorical codes, so hundreds of site/histology
+# levels don't need dense dummy columns, and the models run on the in-memory df_firsts frame without a CSV round trip
+
+#%% Imports
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+import scipy.sparse as sp
+from scipy import linalg, stats
+
+from internals import LOG, instrument
+from constants import COL_AGE, COL_AGE_ORD, COL_SEX, COL_SITE, COL_TYPE, COL_SURV, COL_RAD, COL_CHEMO
+
+COL_OUTCOME = "Non-first GBM" # Outcome column added to df_firsts in processing.py
+MODEL_VARS = { # Variable name in coefficient tables (as in regression.R): source column
+    "Age": COL_AGE,
+    "Sex": COL_SEX,
+    "Survival.months": COL_SURV,
+    "Site": COL_SITE,
+    "Type_comp": COL_TYPE,
+    "Radiation": COL_RAD,
+    "Chemotherapy": COL_CHEMO,
+}
+MODELS = { # Model name: numeric and factor terms, same formulas as lm_base, lm_site and lm_type in regression.R
+    "base": {"numeric": ["Age", "Survival.months"], "factors": ["Sex", "Radiation", "Chemotherapy"]},
+    "site": {"numeric": ["Age", "Survival.months"], "factors": ["Sex", "Site", "Radiation", "Chemotherapy"]},
+    "type": {"numeric": ["Age", "Survival.months"], "factors": ["Sex", "Type_comp", "Radiation", "Chemotherapy"]},
+}
+
+#%% Design
+
+def condenseFactor(series: Series, threshold: float = 0.02, new_name: str = "Other") -> Series:
+    """
+    Returns series as strings with levels making up threshold or less of values replaced by new_name, as condenseFactor() in regression.R
+
+    Args:
+        series (Series): Factor values
+        threshold (float, optional): Largest proportion of a condensed level. Defaults to 0.02.
+        new_name (str, optional): Name of the merged level. Defaults to "Other".
+    """
+    proportions = series.value_counts(normalize=True)
+    to_condense = proportions.index[proportions <= threshold]
+    values = series.astype(str)
+    return values.where(~series.isin(to_condense), new_name)
+
+def nthLevelThreshold(series: Series, n: int = 100) -> float:
+    """
+    Returns proportion of the nth most common level of series, the threshold regression.R condenses histology types with
+
+    Args:
+        series (Series): Factor values
+        n (int, optional): Rank of level. Defaults to 100.
+    """
+    counts = series.value_counts()
+    return counts.iloc[min(n, len(counts)) - 1] / counts.sum()
+
+def modelFrame(df: DataFrame, type_levels: int = 100) -> DataFrame:
+    """
+    Returns DF of the model variables of MODEL_VARS and the outcome "GBM" from df_firsts, rows with missing values dropped like glm()
+    Age is the integer rank of the sorted age bins, as as.integer() of the ordered factor in regression.R, ranked from the
+    precomputed COL_AGE_ORD column when df has it
+
+    Args:
+        df (DataFrame): First-primary cohort with COL_OUTCOME
+        type_levels (int, optional): Histology types less common than this rank are merged into "Other". Defaults to 100.
+    """
+    frame = DataFrame({name: df[col] for name, col in MODEL_VARS.items()})
+    if COL_AGE_ORD in df.columns: # Missing ages are -1
+        frame["Age"] = df[COL_AGE_ORD].where(df[COL_AGE_ORD] >= 0)
+    frame["Survival.months"] = pd.to_numeric(frame["Survival.months"], errors="coerce")
+    frame["GBM"] = df[COL_OUTCOME].astype(bool)
+    frame = frame.dropna()
+    ages = frame["Age"].to_numpy() if COL_AGE_ORD in df.columns else frame["Age"].astype(str).to_numpy() # Bins sort in age order as text
+    frame["Age"] = np.unique(ages, return_inverse=True)[1] + 1 # 1-based rank of the bins present, like R
+    frame["Type_comp"] = condenseFactor(frame["Type_comp"], nthLevelThreshold(frame["Type_comp"], type_levels))
+    return frame
+
+def designMatrix(frame: DataFrame, numeric: list[str] = [], factors: list[str] = []) -> tuple[sp.csr_matrix, list[str]]:
+    """
+    Returns sparse design matrix with intercept and the names of its columns
+    Factors use treatment contrasts with the first sorted level as reference, columns are named like R, e.g., "SexMale"
+
+    Args:
+        frame (DataFrame): Output of modelFrame()
+        numeric (list[str], optional): Columns entered as is. Defaults to [].
+        factors (list[str], optional): Columns entered as one-hot levels. Defaults to [].
+    """
+    n_rows = len(frame)
+    blocks = [sp.csr_matrix(np.ones((n_rows, 1)))]
+    names = ["(Intercept)"]
+    for col in numeric:
+        blocks.append(sp.csr_matrix(frame[col].to_numpy(dtype=float).reshape(-1, 1)))
+        names.append(col)
+    for col in factors:
+        levels = np.sort(frame[col].astype(str).unique())
+        codes = pd.Categorical(frame[col].astype(str), categories=levels).codes
+        rows = np.flatnonzero(codes > 0) # Reference level is all zeros
+        blocks.append(sp.csr_matrix((np.ones(len(rows)), (rows, codes[rows] - 1)), shape=(n_rows, len(levels) - 1)))
+        names.extend(F"{col}{level}" for level in levels[1:])
+    return sp.hstack(blocks, format="csr"), names
+
+#%% Fitting
+
+def fitLogistic(X: sp.csr_matrix, y: np.ndarray, names: list[str] = None, max_iter: int = 25, tol: float = 1e-8) -> tuple[DataFrame, dict]:
+    """
+    Fits logistic regression by iteratively reweighted least squares, same algorithm and convergence test as R's glm.fit
+    Returns coefficient table (Estimate, Std. Error, z value, Pr(>|z|)) and dict of fit statistics
+
+    Args:
+        X (sp.csr_matrix): Design matrix from designMatrix()
+        y (np.ndarray): Binary outcome
+        names (list[str], optional): Column names of X. Defaults to None.
+        max_iter (int, optional): Maximum IRLS iterations. Defaults to 25.
+        tol (float, optional): Relative deviance change to stop at. Defaults to 1e-8.
+    """
+    y = np.asarray(y, dtype=float)
+    mu = (y + 0.5) / 2 # R's binomial initialization
+    eta = np.log(mu / (1 - mu))
+    deviance_old = np.inf
+    for n_iter in range(1, max_iter + 1):
+        weights = mu * (1 - mu)
+        z = eta + (y - mu) / weights
+        XtW = X.T.multiply(weights).tocsr()
+        information = (XtW @ X).toarray() # p x p, small even with hundreds of levels
+        beta = linalg.solve(information, XtW @ z, assume_a="pos")
+        eta = X @ beta
+        mu = np.clip(1 / (1 + np.exp(-eta)), 1e-15, 1 - 1e-15)
+        deviance = -2 * np.sum(y * np.log(mu) + (1 - y) * np.log(1 - mu))
+        if abs(deviance - deviance_old) / (abs(deviance) + 0.1) < tol:
+            break
+        deviance_old = deviance
+    else:
+        LOG.warning(F"IRLS did not converge in {max_iter} iterations")
+
+    weights = mu * (1 - mu)
+    std_err = np.sqrt(np.diag(linalg.inv((X.T.multiply(weights).tocsr() @ X).toarray())))
+    coefs = DataFrame({"Estimate": beta, "Std. Error": std_err}, index=names)
+    coefs["z value"] = coefs["Estimate"] / coefs["Std. Error"]
+    coefs["Pr(>|z|)"] = 2 * stats.norm.sf(np.abs(coefs["z value"]))
+    p_null = y.mean()
+    null_deviance = -2 * np.sum(y * np.log(p_null) + (1 - y) * np.log(1 - p_null))
+    fit = {"n_obs": len(y), "n_iter": n_iter, "deviance": deviance, "null_deviance": null_deviance,
+           "df_residual": len(y) - X.shape[1], "aic": deviance + 2 * X.shape[1]}
+    return coefs, fit
+
+@instrument()
+def fitModels(df: DataFrame, models: dict[str, dict] = MODELS, type_levels: int = 100) -> dict[str, tuple[DataFrame, dict]]:
+    """
+    Fits every model in models on df_firsts, returns dict of model name to (coefficient table, fit statistics)
+
+    Args:
+        df (DataFrame): First-primary cohort with COL_OUTCOME
+        models (dict[str, dict], optional): Model name to numeric and factor terms. Defaults to MODELS.
+        type_levels (int, optional): Histology types less common than this rank are merged into "Other". Defaults to 100.
+    """
+    frame = modelFrame(df, type_levels=type_levels)
+    y = frame["GBM"].to_numpy()
+    results = {}
+    for name, terms in models.items():
+        X, names = designMatrix(frame, terms.get("numeric", []), terms.get("factors", []))
+        coefs, fit = fitLogistic(X, y, names)
+        LOG.info(F"Model {name} ({fit['n_obs']} obs, {X.shape[1]} coefficients, {fit['n_iter']} iterations, AIC {fit['aic']:.1f}):\n"
+                 F"{coefs.to_string()}")
+        results[name] = (coefs, fit)
+    return results
@@ -0,0 +1,211 @@
+# Dependency-aware runner that executes independent pipeline stages on a process pool
+# Workers read the base frame from a memory-mapped Arrow file of the typed cache instead of receiving a pickled copy
+# Null-free numeric columns are zero-copy views of the mapped file shared by all workers, but categorical codes, booleans and
+# nullable integers are converted into a private copy per worker (1-2 bytes per row and column)
+
+#%% Imports
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
+
+import pandas as pd
+from pandas import DataFrame
+
+from internals import LOG, CACHE_DIR, buildCache, instrument
+from indexing import PatientIndex
+from backends import BACKENDS, PandasBackend, getBackend
+from association import buildAssociationTable
+from plotting import renderSpec
+from constants import (COL_AGE, COL_SEX, COL_SITE, COL_HIST, COL_TYPE, COL_SURV, COL_RAD, COL_CHEMO, COL_ID, COL_SEQ,
+                       COL_IS_FIRST, GBM_HIST_CODES, NO_RAD_VALUES, NO_CHEMO_VALUES)
+
+#%% Runner
+
+class Stage:
+    """
+    One step of the pipeline
+    func is called as func(df, **results_of_deps) where df holds only cols of the base frame (all columns if cols is empty,
+    None if cols is None for stages that only use results of other stages) and results_of_deps maps each dependency name to its return value. func must be a module-level function so it can be sent to workers
+    If backend, func is also passed backend=, the execution backend of the run (backends.getBackend()). df is then None
+    unless the backend is pandas, which runs on df
+    """
+    def __init__(self, name: str, func: Callable, deps: list[str] = [], cols: list[str] = [], backend: bool = False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cols = list(cols) if cols is not None else None
+        self.backend = backend
+
+    def __repr__(self):
+        return F"Stage({self.name}, deps={self.deps})"
+
+def buildArrowCache(file_path: str, cache_dir: str = CACHE_DIR) -> str:
+    """
+    Returns path of an uncompressed Arrow IPC copy of the typed Parquet cache of file_path, writing it if missing
+    Uncompressed Arrow can be memory-mapped, so every worker process reads the same OS pages rather than its own copy
+    Float nulls are stored as NaN, which pandas reads them as anyway, so float columns can also be used without a copy
+
+    Args:
+        file_path (str): Path to source CSV
+        cache_dir (str, optional): Directory to store cache files. Defaults to CACHE_DIR.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+    parquet_path = buildCache(file_path, cache_dir=cache_dir)
+    arrow_path = os.path.splitext(parquet_path)[0] + ".arrow" # Named after the same content hash as the Parquet cache
+    if not os.path.exists(arrow_path):
+        table = pq.read_table(parquet_path)
+        for i, field in enumerate(table.schema):
+            if pa.types.is_floating(field.type) and table.column(i).null_count:
+                table = table.set_column(i, field, pc.fill_null(table.column(i), float("nan")))
+        feather.write_feather(table, arrow_path, compression="uncompressed")
+    return arrow_path
+
+_FRAMES: dict[tuple, DataFrame] = {} # Frames already loaded by this worker process, keyed on (path, cols)
+
+def _loadFrame(arrow_path: str, cols: list[str]) -> DataFrame:
+    # split_blocks keeps every column its own block, so null-free numeric columns stay views of the mapped file instead of
+    # being consolidated into a new 2D block, other columns are converted into memory of this worker
+    key = (arrow_path, tuple(cols))
+    if key not in _FRAMES:
+        import pyarrow as pa
+        table = pa.ipc.open_file(pa.memory_map(arrow_path, "r")).read_all() # Zero-copy read, buffers point into the mapped file
+        if cols:
+            table = table.select(cols)
+        _FRAMES[key] = table.to_pandas(split_blocks=True, self_destruct=True) # table is not used after conversion
+    return _FRAMES[key]
+
+_BACKENDS: dict[tuple, object] = {} # Backends already opened by this worker process, keyed on (name, file_path, cache_dir)
+
+def _loadBackend(backend: str, file_path: str, cache_dir: str):
+    key = (backend, file_path, cache_dir)
+    if key not in _BACKENDS:
+        _BACKENDS[key] = getBackend(backend, file_path, cache_dir=cache_dir)
+    return _BACKENDS[key]
+
+def _runStage(func: Callable, arrow_path: str, cols: list[str], dep_results: dict, backend: str = None, file_path: str = "",
+              cache_dir: str = CACHE_DIR):
+    if backend and backend != "pandas": # Other backends read the source themselves
+        return func(None, backend=_loadBackend(backend, file_path, cache_dir), **dep_results)
+    df = _loadFrame(arrow_path, cols) if cols is not None else None
+    if backend:
+        dep_results["backend"] = PandasBackend(df)
+    return func(df, **dep_results)
+
+def runStages(stages: list[Stage],
+              file_path: str,
+              max_workers: int = None,
+              cache_dir: str = CACHE_DIR,
+              backend: str = "pandas",
+              ) -> dict[str, object]:
+    """
+    Runs stages on a process pool as soon as their dependencies finish, returns dict of stage name to result
+
+    Args:
+        stages (list[Stage]): Stages to run, dependencies must be among them
+        file_path (str): Path to source CSV of the base frame
+        max_workers (int, optional): Number of worker processes. Defaults to number of CPUs.
+        cache_dir (str, optional): Directory to store cache files. Defaults to CACHE_DIR.
+        backend (str, optional): Key of backends.BACKENDS that runs the incidence, counter and survival stages. Defaults to "pandas".
+    """
+    if backend not in BACKENDS:
+        raise ValueError(F"Unknown backend {backend}, choose from {list(BACKENDS)}")
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in by_name]
+        if missing:
+            raise ValueError(F"Stage {stage.name} depends on unknown stages {missing}")
+    
+    arrow_path = buildArrowCache(file_path, cache_dir=cache_dir)
+    results: dict[str, object] = {}
+    pending = dict(by_name)
+    running = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            ready = [stage for stage in pending.values() if all(dep in results for dep in stage.deps)]
+            if not ready and not running:
+                raise ValueError(F"Circular dependencies between stages {list(pending)}")
+            for stage in ready:
+                dep_results = {dep: results[dep] for dep in stage.deps}
+                running[executor.submit(_runStage, stage.func, arrow_path, stage.cols, dep_results,
+                                        backend if stage.backend else None, file_path, cache_dir)] = stage.name
+                del pending[stage.name]
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result() # Re-raises errors from the worker
+                LOG.info(F"Stage finished: {name}")
+    return results
+
+#%% Pipeline stages
+
+def stageIncidence(df: DataFrame, backend=None) -> DataFrame:
+    return (backend or PandasBackend(df)).incidence([], incidence_20y_first=0.000556793)
+
+def stageAge(df: DataFrame, backend=None) -> DataFrame:
+    return (backend or PandasBackend(df)).incidence([COL_AGE])
+
+def stageSex(df: DataFrame, backend=None) -> DataFrame:
+    return (backend or PandasBackend(df)).incidence([COL_SEX])
+
+def _gbmRelated(df: DataFrame) -> DataFrame:
+    # Non-GBM entries of untreated GBM patients, as in the "Count sites and types" cell
+    mask_gbm = (df[COL_HIST].isin(GBM_HIST_CODES)
+                & df[COL_RAD].isin(NO_RAD_VALUES)
+                & df[COL_CHEMO].isin(NO_CHEMO_VALUES)).to_numpy()
+    df_gbm_pt = df[PatientIndex(df).expand(mask_gbm)]
+    return df_gbm_pt.loc[~df_gbm_pt[COL_HIST].isin(GBM_HIST_CODES)]
+
+@instrument()
+def stageCounters(df: DataFrame, backend=None) -> list[Counter]:
+    # Same as the "Count sites and types" cell, counts of the related records are of df_gbm_rel
+    backend = backend or PandasBackend(df)
+    counts = [backend.counts(COL_SITE), backend.counts(COL_TYPE), backend.counts(COL_SITE, related=True), backend.counts(COL_TYPE, related=True)]
+    return [Counter(count.to_dict()) for count in counts]
+
+@instrument()
+def stageSurvival(df: DataFrame, backend=None) -> dict[str, pd.Series]:
+    backend = backend or PandasBackend(df)
+    return {"site_groups": backend.survivalSums(COL_SITE), "type_groups": backend.survivalSums(COL_TYPE)}
+
+@instrument()
+def stageFirstSurvival(df: DataFrame, backend=None) -> dict[str, pd.Series]:
+    backend = backend or PandasBackend(df)
+    return {"f_site_groups": backend.survivalSums(COL_SITE, first_only=True),
+            "f_type_groups": backend.survivalSums(COL_TYPE, first_only=True)}
+
+@instrument()
+def stageAssociation(df: DataFrame) -> dict[str, DataFrame]:
+    df_gbm_rel = _gbmRelated(df)
+    return {"site": buildAssociationTable(df, df_gbm_rel, COL_SITE),
+            "type": buildAssociationTable(df, df_gbm_rel, COL_TYPE)}
+
+def stageFigureRaw(df: DataFrame, association: dict) -> str:
+    return renderSpec(association, "GBM_assoc")
+
+def stageFigureNorm(df: DataFrame, association: dict) -> str:
+    return renderSpec(association, "GBM_assoc_norm")
+
+def stageFigureCum(df: DataFrame, association: dict) -> str:
+    return renderSpec(association, "GBM_assoc_norm_cum")
+
+def stageFigureCumFirst(df: DataFrame, association: dict) -> str:
+    return renderSpec(association, "GBM_assoc_norm_cum_first")
+
+PIPELINE_STAGES = [
+    Stage("incidence", stageIncidence, cols=[COL_ID, COL_HIST, COL_IS_FIRST], backend=True),
+    Stage("age", stageAge, cols=[COL_ID, COL_HIST, COL_IS_FIRST, COL_AGE], backend=True),
+    Stage("sex", stageSex, cols=[COL_ID, COL_HIST, COL_IS_FIRST, COL_SEX], backend=True),
+    Stage("counters", stageCounters, cols=[COL_ID, COL_HIST, COL_RAD, COL_CHEMO, COL_SITE, COL_TYPE], backend=True),
+    Stage("survival", stageSurvival, cols=[COL_SITE, COL_TYPE, COL_SURV], backend=True),
+    Stage("first_survival", stageFirstSurvival, cols=[COL_SITE, COL_TYPE, COL_SURV, COL_SEQ], backend=True),
+    Stage("association", stageAssociation, cols=[COL_ID, COL_HIST, COL_RAD, COL_CHEMO, COL_SITE, COL_TYPE, COL_SURV, COL_SEQ]),
+    Stage("figure_raw", stageFigureRaw, deps=["association"], cols=None),
+    Stage("figure_norm", stageFigureNorm, deps=["association"], cols=None),
+    Stage("figure_cum", stageFigureCum, deps=["association"], cols=None),
+    Stage("figure_cum_first", stageFigureCumFirst, deps=["association"], cols=None),
+]
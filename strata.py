@@ -0,0 +1,116 @@
+#%% Imports
+from typing import Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+from internals import instrument, firstPrimaryMask
+from indexing import PatientIndex
+from constants import COL_ID, COL_HIST, GBM_HIST_CODES
+
+#%% Functions
+
+@instrument()
+def stratifiedIncidence(df: DataFrame,
+                        strata: list[Union[str, Series]] = [],
+                        hist_codes: list[int] = GBM_HIST_CODES,
+                        incidence_20y_first: float = 0.000556793,
+                        ) -> DataFrame:
+    """
+    Returns tidy DF of target cancer counts and ratios for every stratum in one pass
+    Each row matches what reportCancerIncidence() gives for df[df[strata] == stratum], i.e., patients are counted
+    from their records within the stratum only
+
+    Columns:
+        n_patients: patients with any record in stratum
+        n_target: patients with target cancer in stratum
+        n_first: patients whose target cancer was a first primary
+        n_not_first: patients without a first primary of the target cancer
+        n_second: patients without a first primary of the target cancer who had the target cancer
+        incidence_sec: n_second / n_not_first
+        ratio: incidence_sec / incidence_20y_first (non-first target cancer ratio)
+        ratio_any: n_target / n_patients / incidence_20y_first (target cancer ratio within a predefined cohort)
+
+    Args:
+        df (DataFrame): Case listing
+        strata (list[Union[str, Series]], optional): Columns or Series aligned with df to stratify by, as in df.groupby(). 
+        Whole df is one stratum if empty. Defaults to [].
+        hist_codes (list[int], optional): Histology codes of target cancer. Defaults to GBM_HIST_CODES.
+        incidence_20y_first (float, optional): Reference 20 year incidence of target cancer as first cancer. Defaults to 0.000556793.
+    """
+    is_target = df[COL_HIST].isin(hist_codes).to_numpy()
+    is_first = is_target & firstPrimaryMask(df)
+    
+    if strata:
+        grouped = df.groupby(strata, observed=True, sort=True)
+        stratum = grouped.ngroup().to_numpy() # Stratum number of each row, -1 for rows with missing stratum values
+        keys = grouped.size().index
+    else:
+        stratum = np.zeros(len(df), dtype=np.int64)
+        keys = pd.Index(["All"], name="Stratum")
+    n_strata = len(keys)
+    
+    valid = stratum >= 0
+    pt_codes, pt_ids = pd.factorize(df[COL_ID].to_numpy()[valid])
+    # Unique (stratum, patient) pairs, each is one patient as seen from within a stratum
+    pair_key = stratum[valid].astype(np.int64) * max(len(pt_ids), 1) + pt_codes
+    pairs, pair_inv = np.unique(pair_key, return_inverse=True)
+    pair_stratum = pairs // max(len(pt_ids), 1)
+    pair_target = np.bincount(pair_inv, weights=is_target[valid], minlength=len(pairs)) > 0
+    pair_first = np.bincount(pair_inv, weights=is_first[valid], minlength=len(pairs)) > 0
+    
+    def countPairs(pair_mask: np.ndarray) -> np.ndarray:
+        return np.bincount(pair_stratum[pair_mask], minlength=n_strata)
+    
+    table = pd.DataFrame({
+        "n_patients": np.bincount(pair_stratum, minlength=n_strata),
+        "n_target": countPairs(pair_target),
+        "n_first": countPairs(pair_first),
+        "n_not_first": countPairs(~pair_first),
+        "n_second": countPairs(~pair_first & pair_target),
+        }, index=keys)
+    return addRatios(table, incidence_20y_first).reset_index()
+
+def addRatios(table: DataFrame, incidence_20y_first: float = 0.000556793) -> DataFrame:
+    """
+    Adds incidence_sec, ratio and ratio_any columns of stratifiedIncidence() to a table of its count columns, returns table
+
+    Args:
+        table (DataFrame): Table with n_patients, n_target, n_not_first and n_second columns
+        incidence_20y_first (float, optional): Reference 20 year incidence of target cancer as first cancer. Defaults to 0.000556793.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"): # Empty strata give NaN/inf rather than raising
+        table["incidence_sec"] = table["n_second"] / table["n_not_first"]
+        table["ratio"] = table["incidence_sec"] / incidence_20y_first
+        table["ratio_any"] = table["n_target"] / table["n_patients"] / incidence_20y_first
+    return table
+
+@instrument()
+def targetCohorts(df: DataFrame,
+                  hist_codes: list[int] = GBM_HIST_CODES,
+                  index: PatientIndex = None,
+                  ) -> dict[str, DataFrame]:
+    """
+    Returns the target cancer cohorts used by reportCancerIncidence(), keyed by the suffix of their export files
+        first: target cancer entries that were a first primary
+        first_rel: all entries of patients in first
+        second: target cancer entries of patients without a first primary of the target cancer
+        sec_rel: all entries of patients in second
+
+    Args:
+        df (DataFrame): Case listing
+        hist_codes (list[int], optional): Histology codes of target cancer. Defaults to GBM_HIST_CODES.
+        index (PatientIndex, optional): PatientIndex built from df, built here if not given. Defaults to None.
+    """
+    if index is None:
+        index = PatientIndex(df)
+    is_target = df[COL_HIST].isin(hist_codes).to_numpy()
+    mask_first = is_target & firstPrimaryMask(df)
+    mask_first_rel = index.expand(mask_first)
+    mask_second = ~mask_first_rel & is_target
+    return {"first": df[mask_first],
+            "first_rel": df[mask_first_rel],
+            "second": df[mask_second],
+            "sec_rel": df[index.expand(mask_second)],
+            }
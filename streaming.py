@@ -0,0 +1,95 @@
+# Low-memory versions of pipeline stages that stream the case listing in chunks instead of loading it whole
+# Every chunk is coerced like the typed cache (internals.coerceTypes()), so results match the in-memory stages
+
+#%% Imports
+from collections import Counter
+from typing import Iterator
+
+import pandas as pd
+from pandas import DataFrame
+
+from internals import LOG, iterData, coerceTypes, instrument
+from constants import (COL_ID, COL_HIST, COL_RAD, COL_CHEMO, COL_SITE, COL_TYPE,
+                       GBM_HIST_CODES, NO_RAD_VALUES, NO_CHEMO_VALUES)
+
+#%% Functions
+
+def _gbmMask(df: DataFrame, hist_codes: list[int], rad_values: list[str], chemo_values: list[str]):
+    # Same GBM/treatment screen as the in-memory "Count sites and types" cell
+    return (df[COL_HIST].isin(hist_codes)
+            & df[COL_RAD].isin(rad_values)
+            & df[COL_CHEMO].isin(chemo_values))
+
+def _iterTyped(file_path: str, chunksize: int, cols: list[str]) -> Iterator[DataFrame]:
+    # Chunks of iterData() with histology and survival coerced as in the typed cache, e.g., histology read as text in
+    # a chunk with a non-numeric value would otherwise not match integer hist_codes
+    for df in iterData(file_path, chunksize=chunksize, cols=cols):
+        yield coerceTypes(df)
+
+def _addCounts(counter: Counter, values: pd.Series):
+    # value_counts per chunk is much faster than feeding every row into Counter()
+    counter.update(values.value_counts(dropna=False).to_dict())
+
+@instrument()
+def streamGbmRecords(file_path: str,
+                     hist_codes: list[int] = GBM_HIST_CODES,
+                     rad_values: list[str] = NO_RAD_VALUES,
+                     chemo_values: list[str] = NO_CHEMO_VALUES,
+                     cols: list[str] = [],
+                     chunksize: int = 1_000_000,
+                     ) -> DataFrame:
+    """
+    Returns untreated GBM records, filtered chunk by chunk so only GBM rows are ever held in memory together
+
+    Args:
+        file_path (str): Path to CSV or Parquet case listing
+        hist_codes (list[int], optional): Histology codes of target cancer. Defaults to GBM_HIST_CODES.
+        rad_values (list[str], optional): Radiation recode values to keep. Defaults to NO_RAD_VALUES.
+        chemo_values (list[str], optional): Chemotherapy recode values to keep. Defaults to NO_CHEMO_VALUES.
+        cols (list[str], optional): Columns to return, will return all if empty. Defaults to [].
+        chunksize (int, optional): Rows read per chunk. Defaults to 1_000_000.
+    """
+    read_cols = list(dict.fromkeys(cols + [COL_HIST, COL_RAD, COL_CHEMO])) if cols else []
+    chunks = [df[_gbmMask(df, hist_codes, rad_values, chemo_values)]
+              for df in _iterTyped(file_path, chunksize, read_cols)]
+    df_gbm = pd.concat(chunks) if chunks else DataFrame()
+    return df_gbm[cols] if cols else df_gbm
+
+@instrument()
+def streamCounters(file_path: str,
+                   hist_codes: list[int] = GBM_HIST_CODES,
+                   rad_values: list[str] = NO_RAD_VALUES,
+                   chemo_values: list[str] = NO_CHEMO_VALUES,
+                   chunksize: int = 1_000_000,
+                   ) -> list[Counter]:
+    """
+    Returns [all_site_cnt, all_type_cnt, gbm_site_cnt, gbm_type_cnt], same as the in-memory "Count sites and types" cell
+    Makes two passes over the file: the first counts all sites/types and collects untreated GBM patient IDs, 
+    the second counts non-GBM records of those patients. Peak memory is one chunk plus the set of GBM patient IDs
+
+    Args:
+        file_path (str): Path to CSV or Parquet case listing
+        hist_codes (list[int], optional): Histology codes of target cancer. Defaults to GBM_HIST_CODES.
+        rad_values (list[str], optional): Radiation recode values of GBM records to keep. Defaults to NO_RAD_VALUES.
+        chemo_values (list[str], optional): Chemotherapy recode values of GBM records to keep. Defaults to NO_CHEMO_VALUES.
+        chunksize (int, optional): Rows read per chunk. Defaults to 1_000_000.
+    """
+    read_cols = [COL_ID, COL_HIST, COL_RAD, COL_CHEMO, COL_SITE, COL_TYPE]
+    all_site_cnt: Counter[str] = Counter()
+    all_type_cnt: Counter[str] = Counter()
+    gbm_site_cnt: Counter[str] = Counter()
+    gbm_type_cnt: Counter[str] = Counter()
+    
+    gbm_ids = set()
+    for df in _iterTyped(file_path, chunksize, read_cols):
+        _addCounts(all_site_cnt, df[COL_SITE])
+        _addCounts(all_type_cnt, df[COL_TYPE])
+        gbm_ids.update(df.loc[_gbmMask(df, hist_codes, rad_values, chemo_values), COL_ID].tolist())
+    LOG.info(F"Number of untreated GBM patients: {len(gbm_ids)}")
+    
+    for df in _iterTyped(file_path, chunksize, [COL_ID, COL_HIST, COL_SITE, COL_TYPE]):
+        df_rel = df[df[COL_ID].isin(gbm_ids) & ~df[COL_HIST].isin(hist_codes)] # Non-GBM entries in GBM patients
+        _addCounts(gbm_site_cnt, df_rel[COL_SITE])
+        _addCounts(gbm_type_cnt, df_rel[COL_TYPE])
+    
+    return [all_site_cnt, all_type_cnt, gbm_site_cnt, gbm_type_cnt]
@@ -0,0 +1,42 @@
+# Parity of the execution backends with the pandas reference, run with python -m pytest
+# Skipped if duckdb isn't installed, it is only needed for backends.DuckDBBackend
+
+#%% Imports
+import os
+os.environ.setdefault("GBM_LOG_FILE", "0") # Read when internals is first imported, keeps log and trace files out of the repo
+
+import pytest
+pytest.importorskip("duckdb")
+
+from benchmark import generateSeerData
+from backends import getBackend, compareBackends
+from constants import COL_AGE, COL_SEX, COL_DIA_YEAR, COL_SURV
+
+STRATA_LIST = [[], [COL_AGE], [COL_SEX], [COL_AGE, COL_SEX, COL_DIA_YEAR]]
+
+#%% Fixtures
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory) -> str:
+    data_dir = str(tmp_path_factory.mktemp("backends"))
+    generateSeerData(20_000, seed=0).to_csv(os.path.join(data_dir, "synthetic.csv"), index=False)
+    return data_dir
+
+@pytest.fixture(scope="module")
+def reference(data_dir):
+    return getBackend("pandas", os.path.join(data_dir, "synthetic.csv"), cache_dir=data_dir)
+
+#%% Tests
+
+@pytest.mark.parametrize("use_cache", [True, False])
+def test_duckdbMatchesPandas(data_dir, reference, use_cache):
+    duckdb_backend = getBackend("duckdb", os.path.join(data_dir, "synthetic.csv"), use_cache=use_cache, cache_dir=data_dir,
+                                temp_dir=os.path.join(data_dir, "duckdb_tmp"))
+    diffs = compareBackends(reference, duckdb_backend, strata_list=STRATA_LIST)
+    assert diffs.empty, F"DuckDB differs from pandas:\n{diffs.head(20).to_string(index=False)}"
+
+def test_compareBackendsReportsDifferences(data_dir, reference):
+    df = reference.df.copy()
+    df.loc[df.index[:10], COL_SURV] += 1 # Survival sums of the first records' sites and types change
+    diffs = compareBackends(reference, getBackend("pandas", df), strata_list=STRATA_LIST)
+    assert diffs["op"].str.startswith("survivalSums").all() and len(diffs) > 0
@@ -0,0 +1,80 @@
+# Parity of incremental updates with a full recompute, run with python -m pytest
+# The history is fed in as several deltas, the last of which corrects records already in the state
+
+#%% Imports
+import os
+os.environ.setdefault("GBM_LOG_FILE", "0") # Read when internals is first imported, keeps log and trace files out of the repo
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import generateSeerData
+from incremental import IncrementalState
+from association import buildAssociationTable
+from strata import stratifiedIncidence
+from constants import (COL_ID, COL_SEQ, COL_SITE, COL_TYPE, COL_HIST, COL_SURV, COL_RAD, COL_CHEMO,
+                       GBM_HIST_CODES, NO_RAD_VALUES, NO_CHEMO_VALUES)
+
+N_PARTITIONS = 8
+
+#%% Fixtures
+
+@pytest.fixture(scope="module")
+def deltas() -> tuple[pd.DataFrame, list[pd.DataFrame]]:
+    """
+    Returns the final case listing and the deltas that build it: two batches of new records (the second also adding records
+    to patients of the first) and a batch of corrections to existing (COL_ID, COL_SEQ) keys
+    """
+    rng = np.random.default_rng(3)
+    df = generateSeerData(8_000, seed=3)
+    df.loc[df.index[::400], COL_SITE] = None # Missing keys are dropped from association tables, not counted as "nan"
+    df.loc[df.index[7::500], COL_TYPE] = None
+    df[[COL_SITE, COL_TYPE]] = df[[COL_SITE, COL_TYPE]].astype("category") # As stored in the typed cache
+    in_first = rng.random(len(df)) < 0.6
+    corrected = df[in_first].sample(300, random_state=3)
+    corrected[COL_HIST] = np.where(rng.random(len(corrected)) < 0.3, GBM_HIST_CODES[0], corrected[COL_HIST])
+    corrected[COL_RAD] = np.where(rng.random(len(corrected)) < 0.5, NO_RAD_VALUES[0], corrected[COL_RAD])
+    corrected[COL_SURV] = (pd.to_numeric(corrected[COL_SURV], errors="coerce") + 1).astype(str) # Text like the listing
+    corrected[COL_SITE] = corrected[COL_SITE].sample(frac=1, random_state=4).to_numpy()
+    df_final = df.copy()
+    df_final.loc[corrected.index] = corrected
+    return df_final, [df[in_first], df[~in_first], corrected]
+
+def _fullTables(df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    # Association tables as the "Count sites and types" cell builds them
+    is_target = df[COL_HIST].isin(GBM_HIST_CODES)
+    untreated = is_target & df[COL_RAD].isin(NO_RAD_VALUES) & df[COL_CHEMO].isin(NO_CHEMO_VALUES)
+    df_rel = df[df[COL_ID].isin(df.loc[untreated, COL_ID]) & ~is_target]
+    return {"site": buildAssociationTable(df, df_rel, COL_SITE), "type": buildAssociationTable(df, df_rel, COL_TYPE)}
+
+def _aligned(table: pd.DataFrame) -> pd.DataFrame:
+    table = table[table["total"] > 0]
+    table.index = table.index.astype(str)
+    return table.sort_index()
+
+#%% Tests
+
+@pytest.mark.parametrize("reload", [False, True])
+def test_updatesMatchFullRecompute(tmp_path, deltas, reload):
+    df_final, batches = deltas
+    state = IncrementalState(state_dir=str(tmp_path / "incremental"), n_partitions=N_PARTITIONS)
+    for batch in batches:
+        state.update(batch)
+        if reload: # Aggregates and partitions read back from disk between deltas
+            state.save()
+            state = IncrementalState(state_dir=str(tmp_path / "incremental"), n_partitions=N_PARTITIONS)
+    full = IncrementalState(state_dir=str(tmp_path / "full"), n_partitions=N_PARTITIONS)
+    full.update(df_final)
+
+    assert state.n_records == len(df_final)
+    for key, table in _fullTables(df_final).items():
+        expected = _aligned(table)
+        assert "nan" not in _aligned(state.associationTable(key)).index # astype(str) turned NA keys into "nan" on pandas 2
+        pd.testing.assert_frame_equal(_aligned(state.associationTable(key)), expected, check_names=False, check_dtype=False)
+        pd.testing.assert_frame_equal(_aligned(full.associationTable(key)), expected, check_names=False, check_dtype=False)
+
+    expected = stratifiedIncidence(df_final, []).iloc[0]
+    for name, value in state.incidence().items():
+        assert value == pytest.approx(expected[name], nan_ok=True), name
+    assert state.incidence() == pytest.approx(full.incidence(), nan_ok=True)
@@ -0,0 +1,79 @@
+# Parity of the PatientIndex/PatientTimeline queries with a brute-force loop over each patient's records, run with python -m pytest
+
+#%% Imports
+import os
+os.environ.setdefault("GBM_LOG_FILE", "0") # Read when internals is first imported, keeps log and trace files out of the repo
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import generateSeerData
+from indexing import PatientIndex, PatientTimeline
+from constants import COL_ID, COL_SEQ, COL_HIST, COL_DIA_YEAR, GBM_HIST_CODES
+
+#%% Fixtures
+
+@pytest.fixture(scope="module")
+def df() -> pd.DataFrame:
+    df = generateSeerData(5_000, seed=5, gbm_prevalence=0.05)
+    return df.sample(frac=1, random_state=5).reset_index(drop=True) # Records of a patient are scattered and out of sequence
+
+@pytest.fixture(scope="module")
+def timeline(df) -> PatientTimeline:
+    return PatientTimeline(df)
+
+@pytest.fixture(scope="module")
+def by_patient(df) -> dict[int, np.ndarray]:
+    # Row positions of each patient's records in order of COL_SEQ, ties in original row order
+    return {pt_id: rows[np.argsort(df[COL_SEQ].to_numpy()[rows], kind="stable")]
+            for pt_id, rows in df.groupby(COL_ID).indices.items()}
+
+MASKS = {
+    "gbm": lambda df: df[COL_HIST].isin(GBM_HIST_CODES).to_numpy(),
+    "late": lambda df: (df[COL_DIA_YEAR] >= 2010).to_numpy(),
+    "none": lambda df: np.zeros(len(df), dtype=bool),
+    }
+
+#%% Tests
+
+def test_patientsAndEnds(df, timeline, by_patient):
+    assert timeline.patients.tolist() == sorted(by_patient)
+    assert timeline.firstRows().tolist() == [by_patient[pt_id][0] for pt_id in timeline.patients]
+    assert timeline.lastRows().tolist() == [by_patient[pt_id][-1] for pt_id in timeline.patients]
+
+@pytest.mark.parametrize("mask_name", MASKS)
+def test_timelineQueriesMatchBruteForce(df, timeline, by_patient, mask_name):
+    row_mask = MASKS[mask_name](df)
+    first_pos, count_after = [], []
+    after, before = np.zeros(len(df), dtype=bool), np.zeros(len(df), dtype=bool)
+    for pt_id in timeline.patients:
+        rows = by_patient[pt_id]
+        hits = np.flatnonzero(row_mask[rows])
+        pos = int(hits[0]) if len(hits) else -1
+        first_pos.append(pos)
+        count_after.append(len(rows) - pos - 1 if pos >= 0 else -1)
+        if pos >= 0:
+            after[rows[pos + 1:]] = True
+            before[rows[:pos]] = True
+    assert timeline.firstPosition(row_mask).tolist() == first_pos
+    assert timeline.countAfter(row_mask).tolist() == count_after
+    np.testing.assert_array_equal(timeline.after(row_mask), after)
+    np.testing.assert_array_equal(timeline.before(row_mask), before)
+
+    # PatientIndex queries against isin()
+    has_hit = df[COL_ID].isin(df.loc[row_mask, COL_ID])
+    assert timeline.nunique(row_mask) == df.loc[row_mask, COL_ID].nunique()
+    np.testing.assert_array_equal(timeline.expand(row_mask), has_hit.to_numpy())
+    np.testing.assert_array_equal(PatientIndex(df).expand(row_mask), has_hit.to_numpy())
+
+def test_intervalsMatchBruteForce(df, timeline, by_patient):
+    years = df[COL_DIA_YEAR].to_numpy(dtype=float)
+    expected = np.full(len(df), np.nan)
+    for rows in by_patient.values():
+        expected[rows[1:]] = np.diff(years[rows])
+    np.testing.assert_array_equal(timeline.intervals(years), expected)
+
+def test_takeMatchesIsin(df, timeline):
+    pt_ids = df[COL_ID].drop_duplicates().sample(50, random_state=5).tolist() + [-1] # Unknown IDs are dropped
+    pd.testing.assert_frame_equal(timeline.take(df, pt_ids), df[df[COL_ID].isin(pt_ids)])
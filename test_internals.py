@@ -0,0 +1,78 @@
+# Parity of importData() screens compiled into a FilterPlan with the original sequential screens, and merging of slices,
+# run with python -m pytest
+
+#%% Imports
+import os
+os.environ.setdefault("GBM_LOG_FILE", "0") # Read when internals is first imported, keeps log and trace files out of the repo
+
+import pandas as pd
+import pytest
+
+from benchmark import generateSeerData
+from internals import importData, FilterPlan, mergeDfSlices
+from constants import COL_ID, COL_SITE, COL_SEQ, COL_SURV, COL_ORD_PRIM, COL_DIA_YEAR
+
+#%% Fixtures
+
+@pytest.fixture(scope="module")
+def csv_path(tmp_path_factory) -> str:
+    df = generateSeerData(10_000, seed=4)
+    df.loc[df.index[::97], COL_ORD_PRIM] = None # Empty cells and cells without letters fail the text screens
+    df.loc[df.index[5::131], COL_ORD_PRIM] = "12"
+    df.loc[df.index[3::89], COL_SITE] = None
+    csv_path = str(tmp_path_factory.mktemp("internals") / "synthetic.csv")
+    df.to_csv(csv_path, index=False)
+    return csv_path
+
+def _baselineImport(file_path: str, cols: list[str] = [], screen_dupl: list[str] = [], screen_text: list[str] = [],
+                    filt_col: str = "", filt: str = "") -> pd.DataFrame:
+    # Screens of importData() before FilterPlan, each applied to the rows kept by the previous one
+    df = pd.read_csv(file_path)
+    for col in screen_dupl:
+        df = df.drop_duplicates(subset=[col])
+    for col in screen_text:
+        df = df.dropna(subset=[col])
+        df = df[df[col].str.contains(R"[A-Za-z]", regex=True) == True]
+    if filt_col and filt:
+        df = df[df[filt_col].str.contains(R"[A-Za-z]", regex=True) == True]
+        df = df.loc[df[filt_col].str.contains(filt, regex=True, case=False) == True]
+    if screen_dupl or screen_text or (filt_col and filt):
+        df = df.reset_index(drop=True)
+    if cols:
+        df = df[cols]
+    return df
+
+SCREENS = [
+    {},
+    {"screen_dupl": [COL_ID]},
+    {"screen_dupl": [COL_SURV, COL_ID, COL_DIA_YEAR]}, # Order matters, each screen only sees rows kept by the previous ones
+    {"screen_text": [COL_ORD_PRIM, COL_SITE]},
+    {"filt_col": COL_SITE, "filt": "BREAST|prostate"}, # Case insensitive
+    {"filt_col": COL_SITE, "filt": ""}, # Ignored without a pattern
+    {"screen_dupl": [COL_ID], "screen_text": [COL_ORD_PRIM], "filt_col": COL_SITE, "filt": "site 1\\d"},
+    ]
+
+#%% Tests
+
+@pytest.mark.parametrize("screens", SCREENS)
+@pytest.mark.parametrize("cols", [[], [COL_ID, COL_SEQ]])
+def test_importDataMatchesSequentialScreens(csv_path, screens, cols):
+    expected = _baselineImport(csv_path, cols=cols, **screens)
+    pd.testing.assert_frame_equal(importData(csv_path, cols=cols, **screens), expected)
+    pd.testing.assert_frame_equal(importData(csv_path, cols=cols, plan=FilterPlan(**screens)), expected)
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_mergeDfSlicesAcceptsAllNaColumns(tmp_path, stream):
+    pd.DataFrame({COL_ID: [1, 2], COL_SITE: [None, None], COL_SURV: [1.0, 2.0]}).to_csv(tmp_path / "slice_1.csv", index=False)
+    pd.DataFrame({COL_ID: [3, 4], COL_SITE: ["Brain", "Lung"], COL_SURV: [None, None]}).to_csv(tmp_path / "slice_2.csv", index=False)
+    merged = pd.read_parquet(mergeDfSlices("slice_", dir=str(tmp_path), stream=stream))
+    assert merged[COL_SITE].tolist()[2:] == ["Brain", "Lung"] and merged[COL_SURV].tolist()[:2] == [1.0, 2.0]
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_mergeDfSlicesRemovesPartialOutput(tmp_path, stream):
+    for i in range(3):
+        pd.DataFrame({COL_ID: [i], COL_SITE: ["Brain"]}).to_csv(tmp_path / F"slice_{i}.csv", index=False)
+    pd.DataFrame({COL_ID: ["x"], COL_SITE: ["Brain"]}).to_csv(tmp_path / "slice_3.csv", index=False) # Text in a numeric column
+    with pytest.raises(ValueError, match="slice_3"):
+        mergeDfSlices("slice_", dir=str(tmp_path), stream=stream)
+    assert sorted(os.listdir(tmp_path)) == [F"slice_{i}.csv" for i in range(4)]
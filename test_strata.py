@@ -0,0 +1,57 @@
+# Parity of the one-pass stratified incidence table with reportCancerIncidence() run on each stratum's subset, run with python -m pytest
+
+#%% Imports
+import os
+os.environ.setdefault("GBM_LOG_FILE", "0") # Read when internals is first imported, keeps log and trace files out of the repo
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark import generateSeerData
+from internals import loadCache
+from strata import stratifiedIncidence
+from constants import COL_AGE, COL_SEX, COL_DIA_YEAR, COL_ID, COL_HIST, COL_ORD_PRIM, GBM_HIST_CODES
+
+INCIDENCE_20Y_FIRST = 0.000556793
+
+#%% Fixtures
+
+@pytest.fixture(scope="module")
+def df(tmp_path_factory) -> pd.DataFrame:
+    data_dir = str(tmp_path_factory.mktemp("strata"))
+    csv_path = os.path.join(data_dir, "synthetic.csv")
+    generateSeerData(30_000, seed=2, gbm_prevalence=0.03).to_csv(csv_path, index=False) # Enough GBM for most strata to have some
+    return loadCache(csv_path, cache_dir=data_dir)
+
+def _baselineIncidence(df: pd.DataFrame, hist_codes: list[int], incidence_20y_first: float) -> dict[str, float]:
+    # Counts and ratio of reportCancerIncidence() before stratifiedIncidence(), which subsets df step by step
+    df_target_cancer = df.loc[df[COL_HIST].isin(hist_codes)]
+    df_first = df_target_cancer[df_target_cancer[COL_ORD_PRIM].str.contains("One primary only|1st of 2 or more primaries") == True]
+    df_not_first = df.drop(df[df[COL_ID].isin(df_first[COL_ID])].index)
+    n_not_first = df_not_first[COL_ID].nunique()
+    n_second = df_not_first.loc[df_not_first[COL_HIST].isin(hist_codes), COL_ID].nunique()
+    return {"n_patients": df[COL_ID].nunique(), "n_target": df_target_cancer[COL_ID].nunique(), "n_first": df_first[COL_ID].nunique(),
+            "n_not_first": n_not_first, "n_second": n_second,
+            "ratio": n_second / n_not_first / incidence_20y_first if n_not_first else np.nan}
+
+#%% Tests
+
+@pytest.mark.parametrize("strata", [[], [COL_AGE], [COL_SEX], [COL_SEX, COL_AGE], [COL_SEX, COL_AGE, COL_DIA_YEAR]])
+def test_stratifiedIncidenceMatchesBaselinePerSubset(df, strata):
+    table = stratifiedIncidence(df, strata, incidence_20y_first=INCIDENCE_20Y_FIRST)
+    assert table["n_patients"].sum() >= df[COL_ID].nunique() # Every patient is in at least one stratum
+    for _, row in table.iterrows():
+        subset = df
+        for col in strata:
+            subset = subset[subset[col] == row[col]]
+        expected = _baselineIncidence(subset, GBM_HIST_CODES, INCIDENCE_20Y_FIRST)
+        for name, value in expected.items():
+            assert row[name] == pytest.approx(value, nan_ok=True), F"{name} of stratum {row[strata].tolist() if strata else 'All'}"
+
+def test_stratifiedIncidenceOtherTarget(df):
+    hist_codes = [8720, 8721, 8743] # Melanoma, as in the README config
+    table = stratifiedIncidence(df, [COL_SEX], hist_codes=hist_codes, incidence_20y_first=0.005)
+    for _, row in table.iterrows():
+        expected = _baselineIncidence(df[df[COL_SEX] == row[COL_SEX]], hist_codes, 0.005)
+        assert row[list(expected)].to_dict() == pytest.approx(expected, nan_ok=True)
@@ -0,0 +1,51 @@
+# Parity of the streamed stages with the in-memory ones, run with python -m pytest
+# Chunks are kept small so every screen and counter has to carry state across many chunks
+
+#%% Imports
+import os
+os.environ.setdefault("GBM_LOG_FILE", "0") # Read when internals is first imported, keeps log and trace files out of the repo
+
+import pandas as pd
+import pytest
+
+from benchmark import generateSeerData
+from internals import loadCache, importData, iterData, coerceTypes
+from stages import stageCounters
+from streaming import streamCounters
+from constants import COL_ID, COL_SITE, COL_HIST, COL_ORD_PRIM, COL_SURV
+
+CHUNKSIZE = 997 # Not a divisor of the number of rows, so the last chunk is partial
+
+#%% Fixtures
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory) -> str:
+    data_dir = str(tmp_path_factory.mktemp("streaming"))
+    df = generateSeerData(20_000, seed=1)
+    df[COL_HIST] = df[COL_HIST].astype(object)
+    df.loc[df.index[::1500], COL_HIST] = "Blank(s)" # Non-numeric histology in some chunks, coerced to NA like the typed cache
+    df.loc[df.index[::700], COL_ORD_PRIM] = None
+    df.to_csv(os.path.join(data_dir, "synthetic.csv"), index=False)
+    return data_dir
+
+#%% Tests
+
+def test_streamCountersMatchesStageCounters(data_dir):
+    csv_path = os.path.join(data_dir, "synthetic.csv")
+    expected = stageCounters(loadCache(csv_path, cache_dir=data_dir))
+    streamed = streamCounters(csv_path, chunksize=CHUNKSIZE)
+    for name, exp, got in zip(["all_site", "all_type", "gbm_site", "gbm_type"], expected, streamed):
+        assert +got == +exp, F"{name} counters differ" # Unary + drops zero counts of unobserved categories
+
+@pytest.mark.parametrize("screens", [
+    {},
+    {"screen_dupl": [COL_ID]},
+    {"screen_dupl": [COL_ID, COL_SURV], "screen_text": [COL_ORD_PRIM]},
+    {"screen_text": [COL_ORD_PRIM], "filt_col": COL_SITE, "filt": "brain|lung"},
+    ])
+@pytest.mark.parametrize("cols", [[], [COL_ID, COL_SITE]])
+def test_iterDataMatchesImportData(data_dir, screens, cols):
+    csv_path = os.path.join(data_dir, "synthetic.csv")
+    expected = coerceTypes(importData(csv_path, cols=cols, **screens))
+    streamed = pd.concat([coerceTypes(df) for df in iterData(csv_path, chunksize=CHUNKSIZE, cols=cols, **screens)], ignore_index=True)
+    pd.testing.assert_frame_equal(streamed, expected, check_dtype=False) # Dtypes are inferred per chunk, e.g., histology is text only in chunks with "Blank(s)"